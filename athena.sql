@@ -128,3 +128,317 @@ tblproperties (
   'projection.period.values' = '00,06,12,18',
   'storage.location.template' = 's3://youtube-trends-uiuc-v2/categories/creation_date=${creation_date}/period=${period}/'
 );
+
+
+-- Normalized output (collect_most_popular.py --normalized): the snippet of a video is stored once per
+-- period in videos, and every appearance in a chart is a slim row in rankings. With --incremental, a
+-- snippet is only stored when it changed: snippet_creation_date and snippet_period of rankings give the
+-- partition of videos that holds it (both are null in partitions collected before they existed).
+CREATE EXTERNAL TABLE IF NOT EXISTS videos (
+  kind string,
+  id string,
+  snippet struct<
+    publishedAt:timestamp,
+    channelId:string,
+    title:string,
+    description:string,
+    thumbnails:struct<
+      default:struct<
+        url:string,
+        width:int,
+        height:int
+      >,
+      medium:struct<
+        url:string,
+        width:int,
+        height:int
+      >,
+      high:struct<
+        url:string,
+        width:int,
+        height:int
+      >,
+      standard:struct<
+        url:string,
+        width:int,
+        height:int
+      >,
+      maxres:struct<
+        url:string,
+        width:int,
+        height:int
+      >
+    >,
+    channelTitle:string,
+    tags:array<string>,
+    categoryId:string,
+    liveBroadcastContent:string,
+    defaultLanguage:string,
+    localized:struct<
+      title:string,
+      description:string
+    >,
+    defaultAudioLanguage:string
+  >,
+  metadata struct<
+    retrieved_at:timestamp
+  >
+)
+PARTITIONED BY (creation_date String, period String)
+STORED AS ORC
+LOCATION 's3://youtube-trends-uiuc-v2/videos/'
+tblproperties (
+  'orc.compress'='ZLIB',
+  'projection.enabled' = 'true',
+  'projection.creation_date.type' = 'date',
+  'projection.creation_date.range' = '2025-10-01,NOW',
+  'projection.creation_date.format' = 'yyyy-MM-dd',
+  'projection.creation_date.interval' = '1',
+  'projection.creation_date.interval.unit' = 'DAYS',
+  'projection.period.type' = 'enum',
+  'projection.period.values' = '00,06,12,18',
+  'storage.location.template' = 's3://youtube-trends-uiuc-v2/videos/creation_date=${creation_date}/period=${period}/'
+);
+
+
+CREATE EXTERNAL TABLE IF NOT EXISTS rankings (
+  id string,
+  etag string,
+  statistics struct<
+    viewCount:bigint,
+    likeCount:bigint,
+    dislikeCount:bigint,
+    favoriteCount:bigint,
+    commentCount:bigint
+  >,
+  metadata struct<
+    region_code:string,
+    category_id:string,
+    retrieved_at:timestamp,
+    rank:int
+  >,
+  snippet_creation_date string,
+  snippet_period string
+)
+PARTITIONED BY (creation_date String, period String)
+STORED AS ORC
+LOCATION 's3://youtube-trends-uiuc-v2/rankings/'
+tblproperties (
+  'orc.compress'='ZLIB',
+  'projection.enabled' = 'true',
+  'projection.creation_date.type' = 'date',
+  'projection.creation_date.range' = '2025-10-01,NOW',
+  'projection.creation_date.format' = 'yyyy-MM-dd',
+  'projection.creation_date.interval' = '1',
+  'projection.creation_date.interval.unit' = 'DAYS',
+  'projection.period.type' = 'enum',
+  'projection.period.values' = '00,06,12,18',
+  'storage.location.template' = 's3://youtube-trends-uiuc-v2/rankings/creation_date=${creation_date}/period=${period}/'
+);
+
+
+-- Same columns as youtube_trends, rebuilt from the normalized tables.
+CREATE OR REPLACE VIEW youtube_trends_normalized AS
+SELECT
+  v.kind,
+  r.etag,
+  r.id,
+  v.snippet,
+  r.statistics,
+  r.metadata,
+  r.creation_date,
+  r.period
+FROM rankings r
+JOIN videos v
+  ON v.id = r.id
+  AND v.creation_date = coalesce(r.snippet_creation_date, r.creation_date)
+  AND v.period = coalesce(r.snippet_period, r.period);
+
+
+-- Periods collected either way, queried as one table.
+CREATE OR REPLACE VIEW youtube_trends_all AS
+SELECT * FROM youtube_trends
+UNION ALL
+SELECT * FROM youtube_trends_normalized;
+
+
+-- Days compacted by compact_partitions.py: one file per day and table, with the four periods of the day
+-- (period is a column), sorted by region_code, category_id and rank (videos by id), with bloom filters
+-- on id and snippet.channelId. Same rows as the period tables, for a fraction of the bytes scanned by
+-- queries that filter on these columns. Yesterday is compacted once its four periods are uploaded.
+CREATE EXTERNAL TABLE IF NOT EXISTS youtube_trends_daily (
+  kind string,
+  etag string,
+  id string,
+  snippet struct<
+    publishedAt:timestamp,
+    channelId:string,
+    title:string,
+    description:string,
+    thumbnails:struct<
+      default:struct<
+        url:string,
+        width:int,
+        height:int
+      >,
+      medium:struct<
+        url:string,
+        width:int,
+        height:int
+      >,
+      high:struct<
+        url:string,
+        width:int,
+        height:int
+      >,
+      standard:struct<
+        url:string,
+        width:int,
+        height:int
+      >,
+      maxres:struct<
+        url:string,
+        width:int,
+        height:int
+      >
+    >,
+    channelTitle:string,
+    tags:array<string>,
+    categoryId:string,
+    liveBroadcastContent:string,
+    defaultLanguage:string,
+    localized:struct<
+      title:string,
+      description:string
+    >,
+    defaultAudioLanguage:string
+  >,
+  statistics struct<
+    viewCount:bigint,
+    likeCount:bigint,
+    dislikeCount:bigint,
+    favoriteCount:bigint,
+    commentCount:bigint
+  >,
+  metadata struct<
+    region_code:string,
+    category_id:string,
+    retrieved_at:timestamp,
+    rank:int
+  >,
+  period string
+)
+PARTITIONED BY (creation_date String)
+STORED AS ORC
+LOCATION 's3://youtube-trends-uiuc-v2/compacted/most_popular/'
+tblproperties (
+  'orc.compress'='ZLIB',
+  'projection.enabled' = 'true',
+  'projection.creation_date.type' = 'date',
+  'projection.creation_date.range' = '2025-10-01,NOW',
+  'projection.creation_date.format' = 'yyyy-MM-dd',
+  'projection.creation_date.interval' = '1',
+  'projection.creation_date.interval.unit' = 'DAYS',
+  'storage.location.template' = 's3://youtube-trends-uiuc-v2/compacted/most_popular/creation_date=${creation_date}/'
+);
+
+
+CREATE EXTERNAL TABLE IF NOT EXISTS videos_daily (
+  kind string,
+  id string,
+  snippet struct<
+    publishedAt:timestamp,
+    channelId:string,
+    title:string,
+    description:string,
+    thumbnails:struct<
+      default:struct<
+        url:string,
+        width:int,
+        height:int
+      >,
+      medium:struct<
+        url:string,
+        width:int,
+        height:int
+      >,
+      high:struct<
+        url:string,
+        width:int,
+        height:int
+      >,
+      standard:struct<
+        url:string,
+        width:int,
+        height:int
+      >,
+      maxres:struct<
+        url:string,
+        width:int,
+        height:int
+      >
+    >,
+    channelTitle:string,
+    tags:array<string>,
+    categoryId:string,
+    liveBroadcastContent:string,
+    defaultLanguage:string,
+    localized:struct<
+      title:string,
+      description:string
+    >,
+    defaultAudioLanguage:string
+  >,
+  metadata struct<
+    retrieved_at:timestamp
+  >,
+  period string
+)
+PARTITIONED BY (creation_date String)
+STORED AS ORC
+LOCATION 's3://youtube-trends-uiuc-v2/compacted/videos/'
+tblproperties (
+  'orc.compress'='ZLIB',
+  'projection.enabled' = 'true',
+  'projection.creation_date.type' = 'date',
+  'projection.creation_date.range' = '2025-10-01,NOW',
+  'projection.creation_date.format' = 'yyyy-MM-dd',
+  'projection.creation_date.interval' = '1',
+  'projection.creation_date.interval.unit' = 'DAYS',
+  'storage.location.template' = 's3://youtube-trends-uiuc-v2/compacted/videos/creation_date=${creation_date}/'
+);
+
+
+CREATE EXTERNAL TABLE IF NOT EXISTS rankings_daily (
+  id string,
+  etag string,
+  statistics struct<
+    viewCount:bigint,
+    likeCount:bigint,
+    dislikeCount:bigint,
+    favoriteCount:bigint,
+    commentCount:bigint
+  >,
+  metadata struct<
+    region_code:string,
+    category_id:string,
+    retrieved_at:timestamp,
+    rank:int
+  >,
+  snippet_creation_date string,
+  snippet_period string,
+  period string
+)
+PARTITIONED BY (creation_date String)
+STORED AS ORC
+LOCATION 's3://youtube-trends-uiuc-v2/compacted/rankings/'
+tblproperties (
+  'orc.compress'='ZLIB',
+  'projection.enabled' = 'true',
+  'projection.creation_date.type' = 'date',
+  'projection.creation_date.range' = '2025-10-01,NOW',
+  'projection.creation_date.format' = 'yyyy-MM-dd',
+  'projection.creation_date.interval' = '1',
+  'projection.creation_date.interval.unit' = 'DAYS',
+  'storage.location.template' = 's3://youtube-trends-uiuc-v2/compacted/rankings/creation_date=${creation_date}/'
+);
@@ -0,0 +1,113 @@
+# Compares the bytes Athena scans in the period tables and in the compacted daily tables of athena.sql.
+#
+# Every query runs once per table of a pair, on the same day, and the DataScannedInBytes Athena reports
+# is printed side by side. The video and channel of the point lookups are picked from the day itself.
+# Athena bills by bytes scanned, so this is also the cost ratio of the queries.
+#
+# python benchmark/athena_bytes_scanned.py 2025-01-01 --output athena_bytes_scanned.json
+
+import json
+import time
+import argparse
+import boto3
+
+PAIRS = {
+    'most_popular': ('youtube_trends', 'youtube_trends_daily'),
+    'videos': ('videos', 'videos_daily'),
+    'rankings': ('rankings', 'rankings_daily'),
+}
+QUERIES = {
+    'most_popular': {
+        'day': "SELECT count(*) FROM {table} WHERE creation_date = '{day}'",
+        'region': "SELECT count(*) FROM {table} WHERE creation_date = '{day}' AND metadata.region_code = '{region_code}'",
+        'chart': "SELECT id, metadata.rank FROM {table} WHERE creation_date = '{day}' "
+                 "AND metadata.region_code = '{region_code}' AND metadata.category_id = '0' AND metadata.rank <= 10",
+        'video': "SELECT metadata.region_code, metadata.rank FROM {table} WHERE creation_date = '{day}' AND id = '{video_id}'",
+        'channel': "SELECT count(*) FROM {table} WHERE creation_date = '{day}' AND snippet.channelId = '{channel_id}'",
+    },
+    'videos': {
+        'day': "SELECT count(*) FROM {table} WHERE creation_date = '{day}'",
+        'video': "SELECT snippet.title FROM {table} WHERE creation_date = '{day}' AND id = '{video_id}'",
+        'channel': "SELECT count(*) FROM {table} WHERE creation_date = '{day}' AND snippet.channelId = '{channel_id}'",
+    },
+    'rankings': {
+        'day': "SELECT count(*) FROM {table} WHERE creation_date = '{day}'",
+        'region': "SELECT count(*) FROM {table} WHERE creation_date = '{day}' AND metadata.region_code = '{region_code}'",
+        'video': "SELECT metadata.region_code, metadata.rank FROM {table} WHERE creation_date = '{day}' AND id = '{video_id}'",
+    },
+}
+OUTPUT_LOCATION = 's3://youtube-trends-uiuc-admin/athena_results/'
+POLL_INTERVAL = 1
+
+
+class Athena:
+    def __init__(self, database, workgroup, output_location=OUTPUT_LOCATION):
+        self.client = boto3.client('athena')
+        self.database = database
+        self.workgroup = workgroup
+        self.output_location = output_location
+
+    def run(self, query):
+        # Returns the rows (without the header) and the bytes scanned.
+        execution_id = self.client.start_query_execution(
+            QueryString=query, QueryExecutionContext={'Database': self.database}, WorkGroup=self.workgroup,
+            ResultConfiguration={'OutputLocation': self.output_location})['QueryExecutionId']
+        while True:
+            execution = self.client.get_query_execution(QueryExecutionId=execution_id)['QueryExecution']
+            state = execution['Status']['State']
+            if state in ('SUCCEEDED', 'FAILED', 'CANCELLED'):
+                break
+            time.sleep(POLL_INTERVAL)
+        if state != 'SUCCEEDED':
+            raise Exception(f"{state}: {execution['Status'].get('StateChangeReason')}\n{query}")
+        rows = self.client.get_query_results(QueryExecutionId=execution_id)['ResultSet']['Rows'][1:]
+        return [[cell.get('VarCharValue') for cell in row['Data']] for row in rows], \
+            execution['Statistics']['DataScannedInBytes']
+
+
+def get_parameters(athena, day):
+    # A video, its channel and its region, from the top of a chart of the day.
+    rows, _ = athena.run(f"SELECT id, snippet.channelId, metadata.region_code FROM youtube_trends "
+                         f"WHERE creation_date = '{day}' AND metadata.rank = 1 LIMIT 1")
+    if not rows:
+        raise Exception(f"No rows in youtube_trends for {day}.")
+    video_id, channel_id, region_code = rows[0]
+    return {'day': day, 'video_id': video_id, 'channel_id': channel_id, 'region_code': region_code}
+
+
+def benchmark(athena, day, tables):
+    parameters = get_parameters(athena, day)
+    results = {}
+    for table in tables:
+        before, after = PAIRS[table]
+        for name, query in QUERIES[table].items():
+            rows_before, bytes_before = athena.run(query.format(table=before, **parameters))
+            rows_after, bytes_after = athena.run(query.format(table=after, **parameters))
+            if sorted(rows_before) != sorted(rows_after):
+                # The daily table has the period as a column, so the same query must return the same rows.
+                raise Exception(f"{table}/{name} returns different rows from {before} and {after}.")
+            results[f"{table}/{name}"] = {'bytes_before': bytes_before, 'bytes_after': bytes_after}
+            print(f"{table + '/' + name:<26} {bytes_before:>14,} {bytes_after:>14,} "
+                  f"{bytes_after / bytes_before if bytes_before else 0:>7.1%}", flush=True)
+    return {'parameters': parameters, 'queries': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the bytes Athena scans before and after compaction.")
+    parser.add_argument("day", help="YYYY-MM-DD, a compacted day")
+    parser.add_argument("--tables", nargs="+", choices=sorted(PAIRS), default=['most_popular'])
+    parser.add_argument("--database", default='default')
+    parser.add_argument("--workgroup", default='primary')
+    parser.add_argument("--output-location", default=OUTPUT_LOCATION, help="Where Athena writes the query results")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    print(f"{'query':<26} {'bytes before':>14} {'bytes after':>14} {'ratio':>7}")
+    report = benchmark(Athena(args.database, args.workgroup, args.output_location), args.day, args.tables)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
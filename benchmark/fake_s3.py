@@ -0,0 +1,219 @@
+# Local stand-in for the part of S3 the pipeline uses, for benchmarks.
+#
+# Path-style requests only (boto3 uses them for an IP endpoint), no authentication, objects kept as files
+# under a directory: buckets, put/get (with Range)/head/delete object, multipart uploads and
+# ListObjectsV2. Point boto3 at it with AWS_ENDPOINT_URL=http://127.0.0.1:<port>, and set
+# AWS_REQUEST_CHECKSUM_CALCULATION=when_required so bodies are not sent aws-chunked.
+#
+# python benchmark/fake_s3.py --directory ./s3
+
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import argparse
+import threading
+import email.utils
+import urllib.parse
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+S3_NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class FakeS3:
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.uploads_directory = os.path.join(self.directory, '.uploads')
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'bytes_received': {}, 'bytes_sent': {}}
+
+    def count(self, group, bucket, value):
+        with self.lock:
+            self.stats[group][bucket] = self.stats[group].get(bucket, 0) + value
+
+    def get_path(self, bucket, key=''):
+        path = os.path.abspath(os.path.join(self.directory, bucket, key))
+        if not path.startswith(self.directory + os.sep) or bucket.startswith('.'):
+            raise ValueError(f"Invalid object: {bucket}/{key}")
+        return path
+
+    def bucket_exists(self, bucket):
+        return os.path.isdir(self.get_path(bucket))
+
+    def get_etag(self, bucket, key):
+        # Not an MD5, but it changes when the object is replaced, in listings as in responses.
+        path = self.get_path(bucket, key)
+        return f'"{os.path.getmtime(path)}-{os.path.getsize(path)}"'
+
+    def put(self, bucket, key, data):
+        path = self.get_path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temporary_path, 'wb') as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+        return hashlib.md5(data).hexdigest()
+
+    def list(self, bucket, prefix=''):
+        root = self.get_path(bucket)
+        keys = []
+        for directory, _, files in os.walk(root):
+            for name in files:
+                key = os.path.relpath(os.path.join(directory, name), root).replace(os.sep, '/')
+                if key.startswith(prefix) and not key.endswith('.tmp'):
+                    keys.append(key)
+        return sorted(keys)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    s3 = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def parse(self):
+        url = urllib.parse.urlsplit(self.path)
+        bucket, _, key = urllib.parse.unquote(url.path).lstrip('/').partition('/')
+        return bucket, key, dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def send(self, status, body=b'', headers=None, bucket=None):
+        if isinstance(body, str):
+            body = ('<?xml version="1.0" encoding="UTF-8"?>\n' + body).encode('utf-8')
+            headers = dict(headers or {}, **{'Content-Type': 'application/xml'})
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if 'Content-Length' not in (headers or {}):
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+            if bucket:
+                self.s3.count('bytes_sent', bucket, len(body))
+
+    def send_error_code(self, status, code, message=''):
+        self.send(status, f'<Error><Code>{code}</Code><Message>{escape(message)}</Message></Error>')
+
+    def do_PUT(self):
+        bucket, key, query = self.parse()
+        body = self.read_body()
+        self.s3.count('bytes_received', bucket, len(body))
+        with self.s3.lock:
+            self.s3.stats['requests'] += 1
+        if not key:
+            os.makedirs(self.s3.get_path(bucket), exist_ok=True)
+            return self.send(200)
+        if not self.s3.bucket_exists(bucket):
+            return self.send_error_code(404, 'NoSuchBucket', bucket)
+        if 'uploadId' in query:
+            part_path = os.path.join(self.s3.uploads_directory, query['uploadId'], f"{int(query['partNumber']):05d}")
+            if not os.path.isdir(os.path.dirname(part_path)):
+                return self.send_error_code(404, 'NoSuchUpload', query['uploadId'])
+            with open(part_path, 'wb') as f:
+                f.write(body)
+            return self.send(200, headers={'ETag': f'"{hashlib.md5(body).hexdigest()}"'})
+        etag = self.s3.put(bucket, key, body)
+        self.send(200, headers={'ETag': f'"{etag}"'})
+
+    def do_POST(self):
+        bucket, key, query = self.parse()
+        self.read_body()
+        with self.s3.lock:
+            self.s3.stats['requests'] += 1
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            os.makedirs(os.path.join(self.s3.uploads_directory, upload_id))
+            return self.send(200, f'<InitiateMultipartUploadResult xmlns="{S3_NAMESPACE}"><Bucket>{escape(bucket)}'
+                                  f'</Bucket><Key>{escape(key)}</Key><UploadId>{upload_id}</UploadId>'
+                                  f'</InitiateMultipartUploadResult>')
+        if 'uploadId' in query:
+            upload_directory = os.path.join(self.s3.uploads_directory, query['uploadId'])
+            if not os.path.isdir(upload_directory):
+                return self.send_error_code(404, 'NoSuchUpload', query['uploadId'])
+            path = self.s3.get_path(bucket, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as output:
+                for part in sorted(os.listdir(upload_directory)):
+                    with open(os.path.join(upload_directory, part), 'rb') as f:
+                        shutil.copyfileobj(f, output)
+            shutil.rmtree(upload_directory)
+            return self.send(200, f'<CompleteMultipartUploadResult xmlns="{S3_NAMESPACE}"><Bucket>{escape(bucket)}'
+                                  f'</Bucket><Key>{escape(key)}</Key><ETag>"{uuid.uuid4().hex}-1"</ETag>'
+                                  f'</CompleteMultipartUploadResult>')
+        self.send_error_code(400, 'InvalidRequest', 'Unsupported POST')
+
+    def do_GET(self):
+        bucket, key, query = self.parse()
+        with self.s3.lock:
+            self.s3.stats['requests'] += 1
+        if bucket == '_stats':
+            with self.s3.lock:
+                return self.send(200, json.dumps(self.s3.stats).encode('utf-8'))
+        if not self.s3.bucket_exists(bucket):
+            return self.send_error_code(404, 'NoSuchBucket', bucket)
+        if not key:
+            prefix = query.get('prefix', '')
+            contents = ''.join(f'<Contents><Key>{escape(k)}</Key><ETag>{escape(self.s3.get_etag(bucket, k))}</ETag>'
+                               f'<Size>{os.path.getsize(self.s3.get_path(bucket, k))}</Size></Contents>'
+                               for k in self.s3.list(bucket, prefix))
+            return self.send(200, f'<ListBucketResult xmlns="{S3_NAMESPACE}"><Name>{escape(bucket)}</Name>'
+                                  f'<Prefix>{escape(prefix)}</Prefix><IsTruncated>false</IsTruncated>'
+                                  f'{contents}</ListBucketResult>')
+        path = self.s3.get_path(bucket, key)
+        if not os.path.isfile(path):
+            return self.send_error_code(404, 'NoSuchKey', key)
+        size = os.path.getsize(path)
+        headers = {'Last-Modified': email.utils.formatdate(os.path.getmtime(path), usegmt=True),
+                   'ETag': self.s3.get_etag(bucket, key), 'Accept-Ranges': 'bytes'}
+        if self.command == 'HEAD':
+            return self.send(200, headers=dict(headers, **{'Content-Length': str(size)}))
+        with open(path, 'rb') as f:
+            byte_range = self.headers.get('Range')
+            if byte_range:
+                start, _, end = byte_range.replace('bytes=', '').partition('-')
+                start, end = int(start), min(int(end) if end else size - 1, size - 1)
+                f.seek(start)
+                headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+                return self.send(206, f.read(end - start + 1), headers, bucket)
+            self.send(200, f.read(), headers, bucket)
+
+    do_HEAD = do_GET
+
+    def do_DELETE(self):
+        bucket, key, query = self.parse()
+        with self.s3.lock:
+            self.s3.stats['requests'] += 1
+        if 'uploadId' in query:
+            shutil.rmtree(os.path.join(self.s3.uploads_directory, query['uploadId']), ignore_errors=True)
+        elif key and os.path.isfile(self.s3.get_path(bucket, key)):
+            os.remove(self.s3.get_path(bucket, key))
+        self.send(204)
+
+
+def serve(s3, port=0):
+    handler = type('FakeS3Handler', (Handler,), {'s3': s3})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local S3 stand-in for benchmarks.")
+    parser.add_argument("--port", type=int, default=0, help="0 picks a free port")
+    parser.add_argument("--directory", default='./s3', help="Where the objects are stored")
+    args = parser.parse_args()
+    server = serve(FakeS3(args.directory), args.port)
+    # The benchmark reads the address from the first line.
+    print(f"http://127.0.0.1:{server.server_address[1]}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
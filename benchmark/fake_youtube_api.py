@@ -0,0 +1,345 @@
+# Local stand-in for the three YouTube Data API v3 endpoints the collector calls, for benchmarks.
+#
+# Responses are replayed from backup.json files (plain, .bz2, .gz or .zst, segments included): every
+# record of a backup is a response with the request params that produced it, so pagination replays
+# exactly as it was crawled. Without a backup, a synthetic dataset of the same shape is generated.
+# Latency, errors (403/429/503/ECONNRESET/404) and a daily quota per key can be injected, and
+# batch requests (POST /batch) and If-None-Match revalidation are supported like the real API.
+#
+# python benchmark/fake_youtube_api.py --backup backup.json.bz2 --latency-ms 80 --errors 503=0.02,ECONNRESET=0.01
+
+import os
+import sys
+import json
+import time
+import email
+import random
+import socket
+import struct
+import argparse
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sinks import open_source
+
+RESPONSE_TYPES = {
+    'youtube#i18nRegionListResponse': 'regions',
+    'youtube#videoCategoryListResponse': 'categories',
+    'youtube#videoListResponse': 'videos',
+}
+PATHS = {
+    '/youtube/v3/i18nRegions': 'regions',
+    '/youtube/v3/videoCategories': 'categories',
+    '/youtube/v3/videos': 'videos',
+}
+ERRORS = ('403', '429', '503', 'ECONNRESET', '404')
+ERROR_BODIES = {
+    403: ('quotaExceeded', "The request cannot be completed because you have exceeded your quota."),
+    404: ('notFound', "Requested entity was not found."),
+    429: ('rateLimitExceeded', "Too many requests."),
+    503: ('backendError', "The service is currently unavailable."),
+}
+# Params that do not select a response.
+IGNORED_PARAMS = ('key', 'alt', 'prettyPrint', 'fields')
+
+
+def get_request_key(response_type, params):
+    return json.dumps([response_type, sorted((k, str(v)) for k, v in params.items() if k not in IGNORED_PARAMS)])
+
+
+def load_backup(paths):
+    responses = {}
+    skipped = 0
+    for path in paths:
+        with open_source(path) as f:
+            for line in f:
+                record = json.loads(line)
+                metadata = record.pop('metadata', {})
+                response_type = RESPONSE_TYPES.get(record.get('kind'))
+                if response_type is None or 'request_params' not in metadata:
+                    skipped += 1
+                    continue
+                responses[get_request_key(response_type, metadata['request_params'])] = record
+    if skipped:
+        print(f"{skipped} records without a known kind or request params were skipped.", file=sys.stderr)
+    return responses
+
+
+def get_synthetic_video(rng, video_id, category_id):
+    thumbnails = {name: {'url': f'https://i.ytimg.com/vi/{video_id}/{name}.jpg', 'width': width, 'height': height}
+                  for name, width, height in (('default', 120, 90), ('medium', 320, 180), ('high', 480, 360),
+                                              ('standard', 640, 480), ('maxres', 1280, 720))}
+    title = ' '.join(rng.choice(('music', 'live', 'official', 'trailer', 'highlights', 'vlog', 'news', 'reaction'))
+                     for _ in range(6))
+    description = ' '.join(f'word{rng.randrange(5000)}' for _ in range(rng.randrange(20, 200)))
+    return {
+        'kind': 'youtube#video',
+        'etag': f'etag-{video_id}',
+        'id': video_id,
+        'snippet': {
+            'publishedAt': f'2024-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}T12:00:00Z',
+            'channelId': f'UC{rng.randrange(10 ** 9):022d}',
+            'title': title,
+            'description': description,
+            'thumbnails': thumbnails,
+            'channelTitle': f'channel {rng.randrange(10000)}',
+            'tags': [f'tag{rng.randrange(1000)}' for _ in range(rng.randrange(0, 15))],
+            'categoryId': category_id,
+            'liveBroadcastContent': 'none',
+            'localized': {'title': title, 'description': description}
+        },
+        'statistics': {
+            'viewCount': str(rng.randrange(10 ** 8)),
+            'likeCount': str(rng.randrange(10 ** 6)),
+            'favoriteCount': '0',
+            'commentCount': str(rng.randrange(10 ** 5))
+        }
+    }
+
+
+def generate_responses(regions=10, categories=8, pages=4, page_size=50, videos=5000, seed=0):
+    # Same shape as a real crawl: every region has the same categories, the last one is not assignable,
+    # and the charts of different regions share videos.
+    rng = random.Random(seed)
+    region_codes = [f'R{i:03d}' for i in range(regions)]
+    category_ids = [str(i + 1) for i in range(categories)]
+    responses = {get_request_key('regions', {'part': 'snippet'}): {
+        'kind': 'youtube#i18nRegionListResponse',
+        'etag': 'etag-regions',
+        'items': [{'kind': 'youtube#i18nRegion', 'etag': f'etag-{code}', 'id': code,
+                   'snippet': {'gl': code, 'name': f'Region {code}'}} for code in region_codes]
+    }}
+    pool = [get_synthetic_video(rng, f'video{i:07d}', rng.choice(category_ids)) for i in range(videos)]
+    for region_code in region_codes:
+        responses[get_request_key('categories', {'part': 'snippet', 'regionCode': region_code})] = {
+            'kind': 'youtube#videoCategoryListResponse',
+            'etag': f'etag-categories-{region_code}',
+            'items': [{'kind': 'youtube#videoCategory', 'etag': f'etag-category-{category_id}', 'id': category_id,
+                       'snippet': {'title': f'Category {category_id}', 'assignable': category_id != category_ids[-1],
+                                   'channelId': 'UCBR8-60-B28hp2BmDPdntcQ'}}
+                      for category_id in category_ids]
+        }
+        for category_id in category_ids[:-1]:
+            chart = rng.sample(pool, min(len(pool), pages * page_size))
+            for page in range(pages):
+                params = {'part': 'snippet,statistics', 'chart': 'mostPopular', 'regionCode': region_code,
+                          'maxResults': page_size, 'videoCategoryId': category_id}
+                if page:
+                    params['pageToken'] = f'page{page}'
+                response = {
+                    'kind': 'youtube#videoListResponse',
+                    'etag': f'etag-{region_code}-{category_id}-{page}',
+                    'items': chart[page * page_size:(page + 1) * page_size],
+                    'pageInfo': {'totalResults': len(chart), 'resultsPerPage': page_size}
+                }
+                if page + 1 < pages:
+                    response['nextPageToken'] = f'page{page + 1}'
+                responses[get_request_key('videos', params)] = response
+    return responses
+
+
+def parse_error_rates(value):
+    # "503=0.02,ECONNRESET=0.01" -> {'503': 0.02, 'ECONNRESET': 0.01}
+    rates = {}
+    for item in filter(None, (value or '').split(',')):
+        error, rate = item.split('=')
+        if error not in ERRORS:
+            raise argparse.ArgumentTypeError(f"Unknown error {error}, expected one of {', '.join(ERRORS)}")
+        rates[error] = float(rate)
+    return rates
+
+
+class FakeYouTubeApi:
+    def __init__(self, responses, latency=0.0, jitter=0.0, error_rates=None, quota_per_key=None,
+                 retry_after=None, seed=0):
+        self.responses = responses
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rates = error_rates or {}
+        self.quota_per_key = quota_per_key
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.used = {}
+        self.stats = {'http_requests': 0, 'api_calls': 0, 'batch_requests': 0, 'bytes_sent': 0,
+                      'statuses': {}, 'injected': {}}
+
+    def count(self, name, value=1, group=None):
+        with self.lock:
+            stats = self.stats[group] if group else self.stats
+            stats[name] = stats.get(name, 0) + value
+
+    def draw_error(self, response_type):
+        with self.lock:
+            for error, rate in self.error_rates.items():
+                # The API only answers 404 to videos.list, for the charts it does not have.
+                if error == '404' and response_type != 'videos':
+                    continue
+                if self.rng.random() < rate:
+                    self.stats['injected'][error] = self.stats['injected'].get(error, 0) + 1
+                    return error
+        return None
+
+    def wait(self):
+        if self.latency or self.jitter:
+            with self.lock:
+                delay = self.latency + self.rng.uniform(0, self.jitter)
+            time.sleep(delay)
+
+    def get_error_response(self, status):
+        reason, message = ERROR_BODIES[status]
+        body = {'error': {'code': status, 'message': message,
+                          'errors': [{'message': message, 'domain': 'youtube.quota', 'reason': reason}]}}
+        headers = {}
+        if status in (429, 503) and self.retry_after is not None:
+            headers['Retry-After'] = str(self.retry_after)
+        return status, headers, body
+
+    def call(self, path, params, if_none_match=None):
+        # Answers one API call with (status, headers, body), or None to reset the connection.
+        self.count('api_calls')
+        response_type = PATHS.get(path)
+        if response_type is None:
+            return self.get_error_response(404)
+        error = self.draw_error(response_type)
+        if error == 'ECONNRESET':
+            return None
+        elif error is not None:
+            return self.get_error_response(int(error))
+        if self.quota_per_key is not None:
+            with self.lock:
+                key = params.get('key')
+                self.used[key] = self.used.get(key, 0) + 1
+                if self.used[key] > self.quota_per_key:
+                    return self.get_error_response(403)
+        response = self.responses.get(get_request_key(response_type, params))
+        if response is None:
+            return self.get_error_response(404)
+        etag = response.get('etag')
+        if etag is not None and if_none_match == etag:
+            return 304, {'ETag': etag}, None
+        return 200, {'ETag': etag} if etag else {}, response
+
+    def call_batch(self, content_type, body):
+        # A multipart/mixed body of application/http parts, answered part by part.
+        message = email.message_from_bytes(b'Content-Type: ' + content_type.encode('utf-8') + b'\r\n\r\n' + body)
+        boundary = f'batch_{self.rng.getrandbits(64):016x}'
+        parts = []
+        for part in message.get_payload():
+            request_line, _, rest = part.get_payload().partition('\n')
+            headers = email.message_from_string(rest)
+            url = urllib.parse.urlsplit(request_line.split(' ')[1])
+            params = dict(urllib.parse.parse_qsl(url.query))
+            answer = self.call(url.path, params, headers.get('If-None-Match'))
+            if answer is None:
+                # A reset inside a batch resets the whole batch.
+                return None
+            status, response_headers, response = answer
+            self.count(str(status), group='statuses')
+            content = json.dumps(response) if response is not None else ''
+            lines = [f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}',
+                     'Content-Type: application/json; charset=UTF-8']
+            lines += [f'{name}: {value}' for name, value in response_headers.items()]
+            parts.append(f'--{boundary}\r\nContent-Type: application/http\r\n'
+                         f'Content-ID: <response-{part["Content-ID"][1:-1]}>\r\n\r\n'
+                         + '\r\n'.join(lines) + f'\r\nContent-Length: {len(content.encode("utf-8"))}\r\n\r\n'
+                         + content + '\r\n')
+        payload = (''.join(parts) + f'--{boundary}--\r\n').encode('utf-8')
+        return 200, {'Content-Type': f'multipart/mixed; boundary={boundary}'}, payload
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    api = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def reset(self):
+        # SO_LINGER with a zero timeout makes close() send a RST: the client sees ECONNRESET.
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.connection.close()
+        self.close_connection = True
+
+    def send(self, status, headers, body):
+        if isinstance(body, bytes):
+            content = body
+        else:
+            content = json.dumps(body).encode('utf-8') if body is not None else b''
+            headers = dict(headers, **{'Content-Type': 'application/json; charset=UTF-8'})
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        self.api.count('bytes_sent', len(content))
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/_stats':
+            with self.api.lock:
+                return self.send(200, {}, self.api.stats)
+        self.api.count('http_requests')
+        self.api.wait()
+        answer = self.api.call(url.path, dict(urllib.parse.parse_qsl(url.query)), self.headers.get('If-None-Match'))
+        if answer is None:
+            return self.reset()
+        self.api.count(str(answer[0]), group='statuses')
+        self.send(*answer)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.api.count('http_requests')
+        self.api.count('batch_requests')
+        self.api.wait()
+        if urllib.parse.urlsplit(self.path).path != '/batch':
+            return self.send(*self.api.get_error_response(404))
+        answer = self.api.call_batch(self.headers.get('Content-Type', ''), body)
+        if answer is None:
+            return self.reset()
+        self.send(*answer)
+
+
+def serve(api, port=0):
+    handler = type('FakeYouTubeApiHandler', (Handler,), {'api': api})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake YouTube Data API for benchmarks.")
+    parser.add_argument("--port", type=int, default=0, help="0 picks a free port")
+    parser.add_argument("--backup", nargs="*", default=[],
+                        help="backup.json files to replay (any compression); synthetic data when none")
+    parser.add_argument("--regions", type=int, default=10, help="Synthetic regions")
+    parser.add_argument("--categories", type=int, default=8, help="Synthetic categories per region")
+    parser.add_argument("--pages", type=int, default=4, help="Synthetic pages per chart")
+    parser.add_argument("--videos", type=int, default=5000, help="Synthetic distinct videos")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Added to every HTTP request")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Uniform random latency added on top")
+    parser.add_argument("--errors", type=parse_error_rates, default={},
+                        help=f"Error rates per call, e.g. 503=0.02,ECONNRESET=0.01 ({', '.join(ERRORS)})")
+    parser.add_argument("--quota-per-key", type=int, help="Calls allowed per developer key before 403")
+    parser.add_argument("--retry-after", type=int, help="Retry-After seconds sent with 429 and 503")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.backup:
+        responses = load_backup(args.backup)
+    else:
+        responses = generate_responses(args.regions, args.categories, args.pages, videos=args.videos, seed=args.seed)
+    api = FakeYouTubeApi(responses, latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                         error_rates=args.errors, quota_per_key=args.quota_per_key,
+                         retry_after=args.retry_after, seed=args.seed)
+    server = serve(api, args.port)
+    # The benchmark reads the address from the first line.
+    print(f"http://127.0.0.1:{server.server_address[1]}/ {len(responses)} responses", flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# Micro-benchmark of the record path of the collector: one page of videos.list results written to the backup
+# and to most_popular.json, as crawl_most_popular writes it.
+#
+# 'json' is the path before the record sinks: json.dumps per record, a newline concatenated, one write per
+# record to a text file, and the response serialized again for the backup. 'sink' is the current one:
+# dump_record (orjson when installed), one write per page to a binary buffered output, and the raw bytes of
+# the response reused for the backup. The report gives the time and the memory allocated per page.
+#
+# python benchmark/record_sink_benchmark.py --pages 2000
+# python benchmark/record_sink_benchmark.py --backup ~/backup.json.bz2   (the first videos.list page of a backup)
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIRECTORY))
+sys.path.insert(0, BENCHMARK_DIRECTORY)
+
+from sinks import open_sink, open_source, RawResponse, orjson
+from collect_most_popular import add_dicts_to_file, add_response_to_file, add_video_metadata, \
+    get_videos_request_params, get_retrieved_at
+from fake_youtube_api import generate_responses
+
+PAGES = 1000
+# Pages whose allocations are traced, which is much slower than running them.
+TRACED_PAGES = 20
+
+
+def load_page(backup=None):
+    # The raw bytes of a videos.list page, compact as the API sends them to the collector.
+    if backup is not None:
+        with open_source(backup) as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get('kind') == 'youtube#videoListResponse':
+                    record.pop('metadata', None)
+                    break
+            else:
+                raise Exception(f"No videos.list page in {backup}.")
+    else:
+        record = next(response for response in generate_responses(regions=1, categories=2, pages=1).values()
+                      if response['kind'] == 'youtube#videoListResponse')
+    return json.dumps(record, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def write_page_json(outputs, page, raw, retrieved_at, request_params):
+    add_dict_to_file_json(outputs['backup'], page, retrieved_at, request_params=request_params)
+    for rank, video in enumerate(page.get('items', []), start=1):
+        add_dict_to_file_json(outputs['most_popular'], add_video_metadata(video, 'US', '0', rank), retrieved_at)
+
+
+def add_dict_to_file_json(file_handler, record, retrieved_at, request_params=None):
+    if 'metadata' not in record:
+        record['metadata'] = dict()
+    record['metadata']['retrieved_at'] = retrieved_at
+    if request_params is not None:
+        record['metadata']['request_params'] = request_params
+    file_handler.write(json.dumps(record) + '\n')
+
+
+def write_page_sink(outputs, page, raw, retrieved_at, request_params):
+    page = RawResponse(page)
+    page.raw = raw
+    add_response_to_file(outputs['backup'], page, retrieved_at, request_params=request_params)
+    add_dicts_to_file(outputs['most_popular'], [add_video_metadata(video, 'US', '0', rank)
+                                                for rank, video in enumerate(page.get('items', []), start=1)],
+                      retrieved_at)
+
+
+PATHS = {
+    'json': (write_page_json, lambda path: open(path, 'w')),
+    'sink': (write_page_sink, open_sink),
+}
+
+
+def run(name, raw, pages, directory):
+    write_page, open_output = PATHS[name]
+    retrieved_at = get_retrieved_at()
+    request_params = get_videos_request_params('US', '0')
+    outputs = {table: open_output(os.path.join(directory, f'{name}_{table}.json'))
+               for table in ('backup', 'most_popular')}
+    try:
+        # Parsing is the same in both paths, so it is left out of the time.
+        elapsed = 0
+        for _ in range(pages):
+            page = json.loads(raw)
+            started = time.perf_counter()
+            write_page(outputs, page, raw, retrieved_at, request_params)
+            elapsed += time.perf_counter() - started
+        for output in outputs.values():
+            output.flush()
+        written = {table: os.path.getsize(os.path.join(directory, f'{name}_{table}.json')) // pages
+                   for table in outputs}
+        peak = 0
+        for _ in range(TRACED_PAGES):
+            page = json.loads(raw)
+            tracemalloc.start()
+            write_page(outputs, page, raw, retrieved_at, request_params)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+    finally:
+        for output in outputs.values():
+            output.close()
+    return {'seconds_per_page': elapsed / pages, 'pages_per_second': pages / elapsed,
+            'mb_per_second': sum(written.values()) * pages / elapsed / 1024 / 1024,
+            'peak_bytes_per_page': peak, 'bytes_per_page': written}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the serialization and writes of a videos.list page.")
+    parser.add_argument("--pages", type=int, default=PAGES, help="Pages written by every path")
+    parser.add_argument("--backup", help="Take the page from this backup instead of a synthetic one")
+    parser.add_argument("--output", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    raw = load_page(args.backup)
+    print(f"Page of {len(raw):,} bytes, {len(json.loads(raw).get('items', []))} videos, "
+          f"orjson {'installed' if orjson is not None else 'not installed'}.")
+    report = {'page_bytes': len(raw), 'orjson': orjson is not None, 'paths': {}}
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'path':<6} {'us/page':>9} {'pages/s':>9} {'MB/s':>8} {'peak KB':>9}")
+        for name in PATHS:
+            result = report['paths'][name] = run(name, raw, args.pages, directory)
+            print(f"{name:<6} {result['seconds_per_page'] * 1e6:>9.1f} {result['pages_per_second']:>9.0f} "
+                  f"{result['mb_per_second']:>8.1f} {result['peak_bytes_per_page'] / 1024:>9.1f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+# End-to-end benchmark of collect_most_popular() and upload_most_popular(), without quota or AWS.
+#
+# Starts the fake YouTube API (fake_youtube_api.py) and the S3 stand-in (fake_s3.py), seeds the admin
+# bucket with benchmark credentials, points the collector at the fake API through its discovery
+# document, then runs the collector and the uploader, each in its own process so its peak RSS is its own.
+# The report gives wall time, API requests/sec, peak RSS and the bytes written at every stage.
+# With --upload-segments the collector uploads its segments to the S3 stand-in while it crawls, and there
+# is no upload phase.
+#
+# python benchmark/run_benchmark.py --latency-ms 80 --jitter-ms 40 --errors 503=0.01,ECONNRESET=0.005
+# python benchmark/run_benchmark.py --backup ~/backup.json.bz2 --max-workers 16 --batch-size 10 --output report.json
+# python benchmark/run_benchmark.py --upload-segments --segment-size-mb 4
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import logging
+import tempfile
+import subprocess
+import urllib.request
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY = os.path.dirname(BENCHMARK_DIRECTORY)
+sys.path.insert(0, REPOSITORY)
+
+from segment_uploader import SEGMENT_SIZE
+
+ADMIN_BUCKET = 'youtube-trends-uiuc-admin'
+BUCKETS = (ADMIN_BUCKET, 'youtube-trends-uiuc-v2', 'youtube-trends-uiuc-backup-v2')
+PERIODS = ('00', '06', '12', '18')
+DISCOVERY_FILE = 'youtube_v3_discovery.json'
+# Files of the run directory that are not pipeline outputs.
+OWN_FILES = (DISCOVERY_FILE, 'journal.jsonl', 'phases.json', 'quota_usage.json', 'response_cache.json')
+# The collector backs off for up to minutes between retries, which would hide everything else in a benchmark.
+BACKOFF_SCALE = 0.01
+
+
+def start_server(script, arguments, cwd):
+    # The servers print their address on their first line.
+    process = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIRECTORY, script)] + arguments,
+                               cwd=cwd, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line:
+        raise Exception(f"{script} did not start.")
+    return process, line.split()[0]
+
+
+def get_json(url):
+    with urllib.request.urlopen(url) as response:
+        return json.loads(response.read())
+
+
+def get_environment(s3_url):
+    environment = dict(os.environ)
+    environment.pop('AWS_PROFILE', None)
+    environment.update({
+        'AWS_ENDPOINT_URL': s3_url,
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'AWS_SESSION_TOKEN': 'benchmark',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        # The stand-in reads plain bodies, not aws-chunked ones with trailing checksums.
+        'AWS_REQUEST_CHECKSUM_CALCULATION': 'when_required',
+        'AWS_RESPONSE_CHECKSUM_VALIDATION': 'when_required',
+    })
+    return environment
+
+
+def seed_s3(environment):
+    import boto3
+    s3 = boto3.session.Session(aws_access_key_id='benchmark', aws_secret_access_key='benchmark',
+                               region_name='us-east-1').resource('s3', endpoint_url=environment['AWS_ENDPOINT_URL'])
+    for bucket in BUCKETS:
+        s3.create_bucket(Bucket=bucket)
+    for name, prefix in (('credentials.json', 'benchmark-key'), ('credentials_emergency.json', 'benchmark-emergency')):
+        credentials = {period: f'{prefix}-{period}' for period in PERIODS}
+        s3.Object(ADMIN_BUCKET, name).put(Body=json.dumps(credentials).encode('utf-8'))
+
+
+def write_discovery_document(directory, api_url):
+    # The collector reads ./youtube_v3_discovery.json before anything else, so a copy whose root URL is
+    # the fake API sends every request (batches included) there.
+    from googleapiclient.discovery_cache import get_static_doc
+    document = json.loads(get_static_doc('youtube', 'v3'))
+    for field in ('rootUrl', 'baseUrl', 'mtlsRootUrl'):
+        document[field] = api_url
+    with open(os.path.join(directory, DISCOVERY_FILE), 'w') as f:
+        json.dump(document, f)
+
+
+def get_file_sizes(directory):
+    return {name: os.path.getsize(os.path.join(directory, name)) for name in sorted(os.listdir(directory))
+            if os.path.isfile(os.path.join(directory, name)) and name not in OWN_FILES
+            and not name.endswith(('.log', '_metrics.json', '_metrics.prom'))}
+
+
+def run_phase_process(phase, config, directory, environment):
+    # Returns the exit code, the wall time and the peak memory of the phase, measured like run_conversion does.
+    with open(os.path.join(directory, f'{phase}.log'), 'a') as log:
+        started = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--phase', phase,
+                                    '--phase-config', json.dumps(config)],
+                                   cwd=directory, env=environment, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - started
+    result = {'exit_code': os.waitstatus_to_exitcode(status), 'wall_seconds': elapsed,
+              'peak_rss_mb': usage.ru_maxrss / 1024}
+    with open(os.path.join(directory, 'phases.json')) as f:
+        result.update(json.load(f).get(phase, {}))
+    metrics_file = os.path.join(directory, f'{phase}_most_popular_metrics.json')
+    if os.path.exists(metrics_file):
+        with open(metrics_file) as f:
+            result['metrics'] = json.load(f)
+    return result
+
+
+def save_phase_result(phase, result):
+    results = {}
+    if os.path.exists('./phases.json'):
+        with open('./phases.json') as f:
+            results = json.load(f)
+    results[phase] = result
+    with open('./phases.json', 'w') as f:
+        json.dump(results, f)
+
+
+def run_phase(phase, config):
+    # Runs in the child process, from the run directory.
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(message)s')
+    result = {}
+    try:
+        if phase == 'collect':
+            import collect_most_popular as collector
+            import retry_policy
+            retry_policy.BACKOFFS = {error_class: backoff._replace(base=backoff.base * config['backoff_scale'],
+                                                                   cap=backoff.cap * config['backoff_scale'])
+                                     for error_class, backoff in retry_policy.BACKOFFS.items()}
+            collector.collect_most_popular(max_workers=config['max_workers'], use_key_pool=config['key_pool'],
+                                           backup_compression=config['backup_compression'],
+                                           normalized=config['normalized'], use_cache=config['cache'],
+                                           batch_size=config['batch_size'],
+                                           upload_segments=config['upload_segments'],
+                                           segment_size=config['segment_size_mb'] * 1024 * 1024)
+        elif phase == 'upload':
+            import upload_most_popular as uploader
+            from metrics import metrics
+            with open('./collect_most_popular_metrics.json') as f:
+                collected = json.load(f)
+            try:
+                uploader.upload_most_popular(collected['creation_date'], collected['period'],
+                                             orc_backend=config['orc_backend'], parquet=config['parquet'])
+            finally:
+                metrics.publish('upload_most_popular', collected['creation_date'], collected['period'])
+    except Exception as e:
+        logging.exception(e)
+        result['error'] = str(e)
+    save_phase_result(phase, result)
+    sys.exit(1 if 'error' in result else 0)
+
+
+def print_report(report):
+    print(f"\n{'phase':<10}{'wall (s)':>10}{'peak RSS (Mb)':>15}  outcome")
+    for phase in ('collect', 'upload'):
+        result = report['phases'].get(phase)
+        if result is not None:
+            print(f"{phase:<10}{result['wall_seconds']:>10.2f}{result['peak_rss_mb']:>15.1f}  "
+                  f"{result.get('error') or 'ok'}")
+    api = report['api']
+    print(f"\nAPI: {api['http_requests']} HTTP requests ({api['batch_requests']} batches), {api['api_calls']} calls, "
+          f"{api['requests_per_second']:.1f} requests/s, {api['calls_per_second']:.1f} calls/s, "
+          f"{api['bytes_sent'] / 1024 / 1024:.1f} Mb served")
+    print(f"     statuses {api['statuses']}, injected {api['injected']}")
+    print("\nBytes written:")
+    for stage, files in report['files'].items():
+        for name, size in files.items():
+            print(f"  {stage:<10}{name:<40}{size / 1024 / 1024:>10.2f} Mb")
+    for phase in ('collect', 'upload'):
+        stages = report['phases'].get(phase, {}).get('metrics', {}).get('stages', {})
+        for stage, values in stages.items():
+            if values['bytes']:
+                print(f"  {phase:<10}{stage:<40}{values['bytes'] / 1024 / 1024:>10.2f} Mb in {values['seconds']:.2f}s "
+                      f"({values['bytes_per_second'] / 1024 / 1024:.1f} Mb/s)")
+            else:
+                print(f"  {phase:<10}{stage:<40}{'':>13} in {values['seconds']:.2f}s")
+    for bucket, size in sorted(report['s3']['bytes_received'].items()):
+        print(f"  {'s3':<10}{bucket:<40}{size / 1024 / 1024:>10.2f} Mb")
+
+
+def benchmark(args):
+    directory = args.workdir or tempfile.mkdtemp(prefix='most_popular_benchmark_')
+    run_directory = os.path.join(directory, 'run')
+    os.makedirs(run_directory, exist_ok=True)
+    servers = []
+    try:
+        api_arguments = ['--latency-ms', str(args.latency_ms), '--jitter-ms', str(args.jitter_ms),
+                         '--seed', str(args.seed), '--regions', str(args.regions),
+                         '--categories', str(args.categories), '--pages', str(args.pages),
+                         '--videos', str(args.videos)]
+        if args.backup:
+            api_arguments += ['--backup'] + [os.path.abspath(path) for path in args.backup]
+        if args.errors:
+            api_arguments += ['--errors', args.errors]
+        if args.quota_per_key:
+            api_arguments += ['--quota-per-key', str(args.quota_per_key)]
+        api_process, api_url = start_server('fake_youtube_api.py', api_arguments, directory)
+        servers.append(api_process)
+        s3_process, s3_url = start_server('fake_s3.py', ['--directory', os.path.join(directory, 's3')], directory)
+        servers.append(s3_process)
+
+        environment = get_environment(s3_url)
+        seed_s3(environment)
+        write_discovery_document(run_directory, api_url)
+
+        config = {
+            'max_workers': args.max_workers, 'batch_size': args.batch_size, 'key_pool': not args.no_key_pool,
+            'cache': args.cache, 'normalized': args.normalized, 'backup_compression': args.backup_compression,
+            'backoff_scale': args.backoff_scale, 'orc_backend': args.orc_backend, 'parquet': args.parquet,
+            'upload_segments': args.upload_segments, 'segment_size_mb': args.segment_size_mb,
+        }
+        report = {'config': dict(config, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, errors=args.errors,
+                                 backup=args.backup), 'phases': {}, 'files': {}}
+        report['phases']['collect'] = run_phase_process('collect', config, run_directory, environment)
+        api = get_json(api_url + '_stats')
+        wall_seconds = report['phases']['collect']['wall_seconds']
+        api['requests_per_second'] = api['http_requests'] / wall_seconds
+        api['calls_per_second'] = api['api_calls'] / wall_seconds
+        report['api'] = api
+        report['files']['collect'] = collected = get_file_sizes(run_directory)
+        # Segments are already in S3 when the collector is done.
+        if not args.skip_upload and not args.upload_segments and report['phases']['collect']['exit_code'] == 0:
+            report['phases']['upload'] = run_phase_process('upload', config, run_directory, environment)
+            report['files']['upload'] = {name: size for name, size in get_file_sizes(run_directory).items()
+                                         if collected.get(name) != size}
+        report['s3'] = get_json(s3_url + '/_stats')
+        report['directory'] = directory
+    finally:
+        for process in servers:
+            process.terminate()
+            process.wait()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print_report(report)
+    if not args.keep and not args.workdir:
+        shutil.rmtree(directory)
+    else:
+        print(f"\nFiles kept in {directory}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the collector and the uploader against local stand-ins.")
+    parser.add_argument("--backup", nargs="*", default=[],
+                        help="backup.json files to replay (any compression); synthetic data when none")
+    parser.add_argument("--regions", type=int, default=10, help="Synthetic regions")
+    parser.add_argument("--categories", type=int, default=8, help="Synthetic categories per region")
+    parser.add_argument("--pages", type=int, default=4, help="Synthetic pages per chart")
+    parser.add_argument("--videos", type=int, default=5000, help="Synthetic distinct videos")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Latency of every API request")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Uniform random latency added on top")
+    parser.add_argument("--errors", help="Error rates per API call, e.g. 403=0.001,429=0.01,503=0.01,"
+                                         "ECONNRESET=0.005,404=0.01")
+    parser.add_argument("--quota-per-key", type=int, help="API calls allowed per developer key before 403")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-workers", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--no-key-pool", action="store_true")
+    parser.add_argument("--cache", action="store_true", help="Use the response cache (off, so runs compare)")
+    parser.add_argument("--normalized", action="store_true")
+    parser.add_argument("--backup-compression", default='bz2')
+    parser.add_argument("--backoff-scale", type=float, default=BACKOFF_SCALE,
+                        help="Factor applied to the backoff of the collector's retry policy")
+    parser.add_argument("--orc-backend", choices=('java', 'pyarrow'), default='pyarrow')
+    parser.add_argument("--parquet", action="store_true")
+    parser.add_argument("--skip-upload", action="store_true")
+    parser.add_argument("--upload-segments", action="store_true",
+                        help="Upload the segments of the outputs while collecting, instead of the upload phase")
+    parser.add_argument("--segment-size-mb", type=int, default=SEGMENT_SIZE // 1024 // 1024,
+                        help="Size at which a segment is uploaded (with --upload-segments)")
+    parser.add_argument("--workdir", help="Run in this directory and keep it (default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary directory")
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    parser.add_argument("--phase", help=argparse.SUPPRESS)
+    parser.add_argument("--phase-config", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.phase:
+        run_phase(args.phase, json.loads(args.phase_config))
+    else:
+        benchmark(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# Progress journal of collect_most_popular, so a failed run can resume where it stopped.
+#
+# Completed units (the region list, the categories of a region, and every videos.list page of a
+# (region_code, category_id) pair) are kept in memory until the next checkpoint. At a checkpoint the
+# collector makes its outputs durable and the journal appends one line with those units and the
+# position of every output (a byte offset, or a segment number when segments are uploaded).
+# When segments are uploaded, a checkpoint is only taken once a segment is full, and its line is appended
+# once the segments it points at are in S3, without the crawl waiting for them (see segment_uploader.py).
+# Whatever was written after the last checkpoint is truncated on resume and collected again.
+# With the normalized output, the ids of the videos already seen are journaled as well, with the
+# [hash, creation_date, period] of their stored snippet in incremental runs.
+
+import os
+import json
+import time
+import logging
+import functools
+import boto3
+
+JOURNAL_FILE = './journal.jsonl'
+JOURNAL_BUCKET = 'youtube-trends-uiuc-admin'
+CHECKPOINT_INTERVAL = 60
+
+
+class Journal:
+    def __init__(self, creation_date, period, path=JOURNAL_FILE, s3_copy=False, s3_location=None,
+                 interval=CHECKPOINT_INTERVAL, clock=time.monotonic):
+        # s3_location is the (bucket, key prefix) of the copy, when it is not kept with those of other runs.
+        self.creation_date = creation_date
+        self.period = period
+        self.path = path
+        self.s3_copy = s3_copy
+        self.s3_location = s3_location
+        self.interval = interval
+        self.clock = clock
+        self.last_commit = clock()
+        self.pending = {'categories': {}, 'pages': [], 'videos': []}
+
+    def get_s3_location(self):
+        if self.s3_location is not None:
+            bucket, prefix = self.s3_location
+            return bucket, f"{prefix}/{os.path.basename(self.path)}"
+        return JOURNAL_BUCKET, \
+            f"journals/creation_date={self.creation_date}/period={self.period}/{os.path.basename(self.path)}"
+
+    def start(self, resume=False):
+        self.resumed = False
+        self.complete = False
+        self.region_codes = None
+        self.categories = {}
+        self.pages = {}
+        self.videos = {}
+        self.offsets = {}
+        lines = []
+        if resume:
+            if not os.path.exists(self.path) and self.s3_copy:
+                try:
+                    boto3.client('s3').download_file(*self.get_s3_location(), self.path)
+                except Exception as e:
+                    logging.info(f"No journal copy in S3 ({e}).")
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    lines = [json.loads(line) for line in f if line.strip()]
+        if lines and lines[0].get('creation_date') == self.creation_date and lines[0].get('period') == self.period:
+            for entry in lines[1:]:
+                self.replay(entry)
+            self.resumed = True
+            logging.info(f"Resuming from {len(lines) - 1} checkpoints: {len(self.categories)} regions and "
+                         f"{sum(1 for progress in self.pages.values() if progress is None)} pairs done.")
+        else:
+            with open(self.path, 'w') as f:
+                f.write(json.dumps({'creation_date': self.creation_date, 'period': self.period}) + '\n')
+        self.pending = {'categories': {}, 'pages': [], 'videos': []}
+        return self
+
+    def replay(self, entry):
+        if 'region_codes' in entry:
+            self.region_codes = entry['region_codes']
+        self.categories.update(entry.get('categories', {}))
+        for video in entry.get('videos', []):
+            if isinstance(video, str):
+                self.videos[video] = None
+            else:
+                self.videos[video[0]] = video[1:]
+        for page in entry.get('pages', []):
+            pair = (page['region_code'], page['category_id'])
+            if page['next_page_token']:
+                self.pages[pair] = (page['next_page_token'], page['next_rank'])
+            else:
+                self.pages[pair] = None
+        self.offsets = entry.get('offsets', self.offsets)
+        self.complete = entry.get('complete', self.complete)
+
+    def get_page_progress(self, region_code, category_id):
+        # (pageToken, rank) to continue from, (None, 1) for a new pair, or None when the pair is done.
+        return self.pages.get((region_code, category_id), (None, 1))
+
+    def record_regions(self, region_codes):
+        self.region_codes = region_codes
+        self.pending['region_codes'] = region_codes
+
+    def record_categories(self, region_code, category_ids):
+        self.categories[region_code] = category_ids
+        self.pending['categories'][region_code] = category_ids
+
+    def record_page(self, region_code, category_id, page_token, next_page_token, next_rank):
+        self.pages[(region_code, category_id)] = (next_page_token, next_rank) if next_page_token else None
+        self.pending['pages'].append({
+            'region_code': region_code,
+            'category_id': category_id,
+            'page_token': page_token,
+            'next_page_token': next_page_token,
+            'next_rank': next_rank
+        })
+
+    def record_video(self, video_id, snippet=None):
+        # True the first time a video is seen in this run (normalized output).
+        if video_id in self.videos:
+            return False
+        self.videos[video_id] = snippet
+        self.pending['videos'].append(video_id if snippet is None else [video_id] + snippet)
+        return True
+
+    def is_due(self):
+        return self.clock() - self.last_commit >= self.interval
+
+    def commit(self, offsets, complete=False, when_durable=None):
+        # Must only be called once everything written before it is durable at the given offsets, or with
+        # when_durable, which is given the function appending the line and runs it once they are.
+        entry = dict(self.pending)
+        entry['offsets'] = offsets
+        if complete:
+            entry['complete'] = True
+        self.pending = {'categories': {}, 'pages': [], 'videos': []}
+        self.last_commit = self.clock()
+        if when_durable is None:
+            self.append(entry)
+        else:
+            when_durable(functools.partial(self.append, entry))
+
+    def append(self, entry):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if self.s3_copy:
+            boto3.client('s3').upload_file(self.path, *self.get_s3_location())
+        self.offsets = entry['offsets']
+        self.complete = entry.get('complete', False)
@@ -1,3 +1,4 @@
+import sys
 import ssl
 import smtplib
 from email.message import EmailMessage
@@ -15,13 +16,14 @@ def count_running_instances():
 
 MAX_EC2_INSTANCES_RUNNING = 10
 
-def start_new_instance():
+def start_new_instance(event=None):
+    # event is passed to the create_ec2_instance Lambda.
     try:
         if count_running_instances() < MAX_EC2_INSTANCES_RUNNING:
             boto3.client('lambda').invoke(
                 FunctionName='create_ec2_instance',
                 InvocationType='Event',
-                Payload=b'{}'
+                Payload=json.dumps(event or {}).encode('utf-8')
             )
     except Exception:
         print("Error while trying to start a new instance.")
@@ -47,113 +49,189 @@ try:
     import requests
     import logging
     import time
+    import httplib2
     import googleapiclient.discovery
-    from googleapiclient.errors import HttpError, UnknownApiNameOrVersion
+    import googleapiclient.model
+    from googleapiclient.errors import HttpError
+    try:
+        from googleapiclient.discovery_cache import get_static_doc
+    except ImportError:
+        get_static_doc = None
     import datetime
-    from socket import error as socket_error
-    import errno
+    import os
+    import argparse
+    import threading
+    import contextlib
+    import concurrent.futures
+    from key_pool import DeveloperKeyPool, get_key_id, QUOTA_COSTS
+    from metrics import metrics
+    from sinks import open_sink, checkpoint_sink, get_sink_path, dump_record, dump_response, RawResponse, \
+        COMPRESSIONS
+    from segment_uploader import SegmentUploader, SegmentedWriter, SEGMENT_SIZE
+    from checkpoint import Journal, CHECKPOINT_INTERVAL, JOURNAL_FILE
+    from response_cache import ResponseCache, CACHE_TTL
+    from retry_policy import RetryPolicy, RETRY_BUDGET, classify_error, get_error_label, get_error_reason, \
+        get_retry_after
+    from snippet_index import SnippetIndex, get_snippet_hash, upload_index
+    from manifest import Manifest, save_manifest, upload_manifest, MANIFEST_FILE
+
+    MAX_CONCURRENT_REQUESTS = 8
+    BACKUP_COMPRESSION = 'bz2'
+
+    DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/youtube/v3/rest"
+    DISCOVERY_FILE = './youtube_v3_discovery.json'
+    HTTP_TIMEOUT = 60
+    # Number of videos.list calls sent together through a BatchHttpRequest (1 = no batching).
+    BATCH_SIZE = 1
+
+    thread_local = threading.local()
+    discovery_document = None
+    discovery_lock = threading.Lock()
+
 
-    WAIT_WHEN_SERVICE_UNAVAILABLE = 30
-    WAIT_WHEN_CONNECTION_RESET_BY_PEER = 60
-    WAIT_WHEN_UNKNOWN_ERROR = 180
-    WAIT_LONGER_WHEN_UNKNOWN_ERROR = 600
+    class RawJsonModel(googleapiclient.model.JsonModel):
+        # Asks for compact responses and keeps their bytes next to the parsed body, for the backup.
+        def request(self, headers, path_params, query_params, *args, **kwargs):
+            return super().request(headers, path_params, dict(query_params, prettyPrint='false'), *args, **kwargs)
 
+        def deserialize(self, content):
+            body = super().deserialize(content)
+            if isinstance(body, dict):
+                body = RawResponse(body)
+                # The parts of a batch response are decoded by the client before they get here.
+                body.raw = (content.encode('utf-8') if isinstance(content, str) else content).strip()
+            return body
 
-    def get_youtube_client(developer_key):
+
+    def get_discovery_document():
+        # Parsed once per process and kept on disk, so building a client needs no network.
+        global discovery_document
+        with discovery_lock:
+            if discovery_document is None:
+                if os.path.exists(DISCOVERY_FILE):
+                    with open(DISCOVERY_FILE) as f:
+                        content = f.read()
+                else:
+                    # Recent versions of google-api-python-client ship the document; older ones need a download.
+                    content = get_static_doc("youtube", "v3") if get_static_doc is not None else None
+                    if content is None:
+                        page = requests.get(DISCOVERY_URL, timeout=60)
+                        page.raise_for_status()
+                        content = page.text
+                    with open(DISCOVERY_FILE, 'w') as f:
+                        f.write(content)
+                discovery_document = json.loads(content)
+            return discovery_document
+
+    def get_youtube_client(developer_key, new_connection=False, retry_policy=None):
+        # Every thread reuses one keep-alive connection for all its clients, even after a key switch.
+        # new_connection drops it, e.g. after the connection was reset by the peer.
+        retry_policy = retry_policy or RetryPolicy()
         unknown_error = 0
         youtube = None
         no_response = True
         while no_response:
             try:
-                youtube = googleapiclient.discovery.build(serviceName="youtube",
-                                                          version="v3",
-                                                          developerKey=developer_key,
-                                                          cache_discovery=False)
+                if new_connection or getattr(thread_local, 'http', None) is None:
+                    thread_local.http = httplib2.Http(timeout=HTTP_TIMEOUT)
+                youtube = googleapiclient.discovery.build_from_document(get_discovery_document(),
+                                                                        developerKey=developer_key,
+                                                                        http=thread_local.http,
+                                                                        model=RawJsonModel())
                 no_response = False
-            except UnknownApiNameOrVersion as e:
-                page = requests.get("https://www.googleapis.com/discovery/v1/apis/youtube/v3/rest")
-                service = json.loads(page.text)
-                youtube = googleapiclient.discovery.build_from_document(service=service,
-                                                                        developerKey=developer_key)
             except Exception as e:
                 logging.error(e)
                 unknown_error += 1
-                if unknown_error <= 3:
-                    time.sleep(WAIT_WHEN_UNKNOWN_ERROR)
-                else:
+                new_connection = True
+                if not retry_policy.backoff('unknown', unknown_error, 'client'):
                     raise
 
         return youtube
 
 
-    def get_response_from_youtube(response_type, request_params, youtube=None, developer_key=None):
-        if developer_key is None:
+    def get_response_from_youtube(response_type, request_params, youtube=None, developer_key=None, key_pool=None,
+                                  cache=None, retry_policy=None):
+        if cache is not None:
+            response = cache.get_fresh(response_type, request_params)
+            if response is not None:
+                return response, youtube, developer_key
+        if developer_key is None and key_pool is None:
             developer_key = read_developer_key()
-        if youtube is None:
-            youtube = get_youtube_client(developer_key=developer_key)
+        # A policy of its own for a call made outside of a run, e.g. from a shell.
+        retry_policy = retry_policy or RetryPolicy()
+        attempts = {}
         no_response = True
-        unknown_error = 0
-        connection_reset_by_peer = 0
-        service_unavailable = 0
         response = None
         while no_response:
+            if key_pool is not None:
+                # Every call is charged to a key of the pool, which rotates before a key runs out.
+                pooled_developer_key = key_pool.acquire(response_type, preferred=developer_key)
+                if pooled_developer_key != developer_key:
+                    developer_key = pooled_developer_key
+                    youtube = None
+            if youtube is None:
+                youtube = get_youtube_client(developer_key=developer_key, retry_policy=retry_policy)
+            if response_type == "regions":
+                request = youtube.i18nRegions().list(**request_params)
+            elif response_type == "videos":
+                request = youtube.videos().list(**request_params)
+            elif response_type == "categories":
+                request = youtube.videoCategories().list(**request_params)
+            else:
+                raise Exception("Unknown response type")
+            etag = cache.get_etag(response_type, request_params) if cache is not None else None
+            if etag is not None:
+                request.headers['If-None-Match'] = etag
+            retry_policy.before_call(response_type)
+            metrics.increment('quota_units_total', QUOTA_COSTS.get(response_type, 1), response_type=response_type)
+            started = time.perf_counter()
             try:
-                if response_type == "regions":
-                    request = youtube.i18nRegions().list(**request_params)
-                elif response_type == "videos":
-                    request = youtube.videos().list(**request_params)
-                elif response_type == "categories":
-                    request = youtube.videoCategories().list(**request_params)
-                else:
-                    raise Exception("Unknown response type")
-                response = request.execute()
+                try:
+                    response = request.execute()
+                finally:
+                    metrics.observe_latency(response_type, time.perf_counter() - started)
+                retry_policy.record_success(response_type)
                 no_response = False
-            except socket_error as e:
-                if e.errno != errno.ECONNRESET:
-                    logging.info("Other socket error!")
-                    raise
+                if cache is not None:
+                    cache.store(response_type, request_params, response)
+            except Exception as e:
+                error_class = classify_error(e)
+                # Only the errors that are retried count as failures of the endpoint.
+                if error_class in retry_policy.backoffs:
+                    retry_policy.record_failure(response_type)
                 else:
-                    connection_reset_by_peer = connection_reset_by_peer + 1
-                    logging.info("Connection reset by peer! {}".format(connection_reset_by_peer))
-                    if connection_reset_by_peer <= 10:
-                        time.sleep(WAIT_WHEN_CONNECTION_RESET_BY_PEER)
-                        youtube = get_youtube_client(developer_key=developer_key)
-                    else:
-                        raise
-            except HttpError as e:
-                if "403" in str(e):
-                    logging.info(f"403 - Quota Exceeded. Credential: {developer_key}")
+                    retry_policy.record_success(response_type)
+                if error_class == 'not_modified' and cache is not None:
+                    logging.info("304 - Not Modified, using the cached response.")
+                    response = cache.revalidated(response_type, request_params)
+                    no_response = False
+                elif error_class == 'quota' and key_pool is not None:
+                    logging.info(f"403 - Quota Exceeded. Credential: {get_key_id(developer_key)}")
+                    metrics.increment('retries_total', error='403')
+                    key_pool.mark_exhausted(developer_key)
+                elif error_class == 'quota':
+                    logging.info(f"403 - Quota Exceeded. Credential: {get_key_id(developer_key)}")
+                    metrics.increment('retries_total', error='403')
                     emergency_developer_key = read_developer_key(emergency=True)
                     if emergency_developer_key != developer_key:
                         developer_key = emergency_developer_key
-                        youtube = get_youtube_client(developer_key=developer_key)
-                    else:
-                        raise
-                elif "503" in str(e):
-                    logging.info("503 - Service unavailable")
-                    service_unavailable = service_unavailable + 1
-                    if service_unavailable <= 10:
-                        time.sleep(WAIT_WHEN_SERVICE_UNAVAILABLE)
+                        youtube = get_youtube_client(developer_key=developer_key, retry_policy=retry_policy)
                     else:
                         raise
-                elif "429" in str(e):
-                    logging.info("429 - Too Many Requests")
-                    service_unavailable = service_unavailable + 1
-                    if service_unavailable <= 10:
-                        time.sleep(WAIT_WHEN_SERVICE_UNAVAILABLE)
-                    else:
+                elif error_class in retry_policy.backoffs:
+                    label = get_error_label(e)
+                    attempts[error_class] = attempts.get(error_class, 0) + 1
+                    # Not the error itself: its message holds the URI of the request, with the developer key.
+                    logging.info(f"{label} ({error_class}, {get_error_reason(e)}) on {response_type}, "
+                                 f"attempt {attempts[error_class]}")
+                    metrics.increment('retries_total', error=label)
+                    if not retry_policy.backoff(error_class, attempts[error_class], label, get_retry_after(e)):
                         raise
+                    if error_class == 'connection_reset':
+                        youtube = get_youtube_client(developer_key=developer_key, new_connection=True,
+                                                     retry_policy=retry_policy)
                 else:
-                    logging.info("Unknown HttpError")
-                    raise
-            except Exception as e:
-                logging.error(e)
-                unknown_error += 1
-                if unknown_error <= 5:
-                    time.sleep(WAIT_WHEN_UNKNOWN_ERROR)
-                elif unknown_error <= 15:
-                    time.sleep(WAIT_LONGER_WHEN_UNKNOWN_ERROR)
-                else:
+                    # 404 is handled by the caller, other statuses and socket errors are not retried.
                     raise
         return response, youtube, developer_key
 
@@ -170,12 +248,32 @@ try:
             return '18'
 
     def add_dict_to_file(file_handler, record, retrieved_at, request_params=None):
-        if 'metadata' not in record:
-            record['metadata'] = dict()
-        record['metadata']['retrieved_at'] = retrieved_at
+        add_dicts_to_file(file_handler, [record], retrieved_at, request_params=request_params)
+
+    def add_dicts_to_file(file_handler, records, retrieved_at, request_params=None):
+        # The records of a page reach the output in one write.
+        if not records:
+            return
+        for record in records:
+            if 'metadata' not in record:
+                record['metadata'] = dict()
+            record['metadata']['retrieved_at'] = retrieved_at
+            if request_params is not None:
+                record['metadata']['request_params'] = request_params
+        file_handler.write(b''.join([dump_record(record) for record in records]))
+        # The outputs of the collector count their records for the manifest (see manifest.py).
+        if hasattr(file_handler, 'count_record'):
+            for record in records:
+                file_handler.count_record(record)
+
+    def add_response_to_file(file_handler, response, retrieved_at, request_params=None):
+        # A response goes to the backup as it was received, with its metadata added as its last key.
+        metadata = {'retrieved_at': retrieved_at}
         if request_params is not None:
-            record['metadata']['request_params'] = request_params
-        file_handler.write(json.dumps(record) + '\n')
+            metadata['request_params'] = request_params
+        file_handler.write(dump_response(response, metadata))
+        if hasattr(file_handler, 'count_record'):
+            file_handler.count_record({'metadata': metadata})
 
     def read_developer_key(emergency=False):
         period = get_period()
@@ -204,96 +302,467 @@ try:
         }
         return unspecified_category
 
-    def collect_most_popular():
-        with open('./backup.json', 'w') as backup_json:
-            retrieved_at = datetime.datetime.now(datetime.UTC).strftime("%Y-%m-%d %H:%M:%S.%f") + "000Z"
-            request_params = {'part': 'snippet'}
-            regions, youtube, developer_key = get_response_from_youtube(response_type="regions",
-                                                                        request_params=request_params)
-            add_dict_to_file(backup_json, regions, retrieved_at, request_params=request_params)
-
-            with open('./regions.json', 'w') as regions_json:
-                region_codes = []
-                for region in regions.get('items', []):
-                    region_codes.append(region['id'])
-                    add_dict_to_file(regions_json, region, retrieved_at)
-                region_codes.sort()
-
-            with open('./categories.json', 'w') as categories_json:
-                with open('./most_popular.json', 'w') as most_popular_json:
-                    for region_code in region_codes:
-                        retrieved_at = datetime.datetime.now(datetime.UTC).strftime("%Y-%m-%d %H:%M:%S.%f") + "000Z"
-                        request_params = {
-                            'part': 'snippet',
-                            'regionCode': region_code
-                        }
-                        categories, youtube, developer_key = get_response_from_youtube(response_type="categories",
-                                                                                       request_params=request_params,
-                                                                                       youtube=youtube,
-                                                                                       developer_key=developer_key)
-                        add_dict_to_file(backup_json, categories, retrieved_at, request_params=request_params)
-
-                        # The next two lines artificially add a "zero" category.
-                        # It corresponds to a call to videos.list(most_popular) when no category is specified.
-                        category_ids = ['0', ]
-                        add_dict_to_file(categories_json, get_unspecified_category(region_code), retrieved_at)
-
-                        for category in categories.get('items', []):
-                            if category['snippet']['assignable']:
-                                category_ids.append(category['id'])
-                            category['metadata'] = dict()
-                            category['metadata']['region_code'] = region_code
-                            add_dict_to_file(categories_json, category, retrieved_at)
-                        category_ids.sort()
-
-                        for category_id in category_ids:
-                            rank = 1
-                            next_page_token = None
-                            more_pages = True
-
-                            # Loop through all pages for this region
-                            while more_pages:
-                                retrieved_at = datetime.datetime.now(datetime.UTC).strftime("%Y-%m-%d %H:%M:%S.%f") + "000Z"
-                                request_params = {
-                                    'part': 'snippet,statistics',
-                                    'chart': 'mostPopular',
-                                    'regionCode': region_code,
-                                    'maxResults': 50,
-                                    'videoCategoryId': category_id
-                                }
-                                if next_page_token:
-                                    request_params['pageToken'] = next_page_token
-                                try:
-                                    videos, youtube, developer_key = get_response_from_youtube(response_type="videos",
-                                                                                               request_params=request_params,
-                                                                                               youtube=youtube,
-                                                                                               developer_key=developer_key)
-                                    add_dict_to_file(backup_json, videos, retrieved_at, request_params=request_params)
-                                except HttpError as e:
-                                    if "Requested entity was not found." in str(e):
-                                        logging.info("404 - Requested entity was not found.")
-                                        videos = {}
-                                    else:
-                                        raise
-
-                                # Process items in the current page
-                                for video in videos.get('items', []):
-                                    video['snippet']['publishedAt'] = video['snippet']['publishedAt'].replace('Z', '.000000000Z').replace('T', ' ')
-                                    video['metadata'] = dict()
-                                    video['metadata']['region_code'] = region_code
-                                    video['metadata']['category_id'] = category_id
-                                    video['metadata']['rank'] = rank
-                                    rank = rank + 1
-                                    add_dict_to_file(most_popular_json, video, retrieved_at)
-
-                                # Check if there's a next page
-                                next_page_token = videos.get('nextPageToken')
-                                if not next_page_token:
-                                    more_pages = False
+    def get_retrieved_at():
+        return datetime.datetime.now(datetime.UTC).strftime("%Y-%m-%d %H:%M:%S.%f") + "000Z"
+
+    def get_thread_client(developer_key):
+        # googleapiclient (httplib2) is not thread-safe, so every worker keeps its own client.
+        # The client is built lazily by get_response_from_youtube on the first call of the thread.
+        return getattr(thread_local, 'youtube', None), getattr(thread_local, 'developer_key', None) or developer_key
+
+    def fetch_regions(key_pool=None, cache=None, retry_policy=None):
+        retrieved_at = get_retrieved_at()
+        request_params = {'part': 'snippet'}
+        regions, _, developer_key = get_response_from_youtube(response_type="regions",
+                                                              request_params=request_params,
+                                                              key_pool=key_pool,
+                                                              cache=cache,
+                                                              retry_policy=retry_policy)
+        return regions, retrieved_at, request_params, developer_key
+
+    def add_regions_to_files(backup_json, regions_json, regions, retrieved_at, request_params):
+        add_response_to_file(backup_json, regions, retrieved_at, request_params=request_params)
+        region_codes = [region['id'] for region in regions.get('items', [])]
+        add_dicts_to_file(regions_json, regions.get('items', []), retrieved_at)
+        region_codes.sort()
+        return region_codes
+
+    def fetch_categories(region_code, developer_key, key_pool=None, cache=None, retry_policy=None):
+        youtube, developer_key = get_thread_client(developer_key)
+        retrieved_at = get_retrieved_at()
+        request_params = {
+            'part': 'snippet',
+            'regionCode': region_code
+        }
+        categories, youtube, developer_key = get_response_from_youtube(response_type="categories",
+                                                                       request_params=request_params,
+                                                                       youtube=youtube,
+                                                                       developer_key=developer_key,
+                                                                       key_pool=key_pool,
+                                                                       cache=cache,
+                                                                       retry_policy=retry_policy)
+        thread_local.youtube, thread_local.developer_key = youtube, developer_key
+        return region_code, categories, retrieved_at, request_params
+
+    def get_videos_request_params(region_code, category_id, page_token=None):
+        request_params = {
+            'part': 'snippet,statistics',
+            'chart': 'mostPopular',
+            'regionCode': region_code,
+            'maxResults': 50,
+            'videoCategoryId': category_id
+        }
+        if page_token:
+            request_params['pageToken'] = page_token
+        return request_params
+
+    def fetch_most_popular(region_code, category_id, developer_key, key_pool=None, page_token=None, rank=1,
+                           cache=None, retry_policy=None):
+        youtube, developer_key = get_thread_client(developer_key)
+        pages = []
+        next_page_token = page_token
+        more_pages = True
+
+        # Loop through all pages for this region and category
+        while more_pages:
+            retrieved_at = get_retrieved_at()
+            request_params = get_videos_request_params(region_code, category_id, next_page_token)
+            try:
+                videos, youtube, developer_key = get_response_from_youtube(response_type="videos",
+                                                                           request_params=request_params,
+                                                                           youtube=youtube,
+                                                                           developer_key=developer_key,
+                                                                           key_pool=key_pool,
+                                                                           cache=cache,
+                                                                           retry_policy=retry_policy)
+                thread_local.youtube, thread_local.developer_key = youtube, developer_key
+            except HttpError as e:
+                if classify_error(e) == 'not_found':
+                    logging.info("404 - Requested entity was not found.")
+                    videos = None
+                else:
+                    raise
+            pages.append((videos, retrieved_at, request_params))
+
+            # Check if there's a next page
+            next_page_token = videos.get('nextPageToken') if videos else None
+            if not next_page_token:
+                more_pages = False
+        return region_code, category_id, rank, pages
+
+    def fetch_most_popular_batch(pairs, developer_key, key_pool=None, cache=None, retry_policy=None):
+        # pairs holds (region_code, category_id, page_token, rank) tuples, and one
+        # (region_code, category_id, rank, pages) tuple is returned per pair, as fetch_most_popular does.
+        # The pages of a pair are chained by pageToken, so every round sends the next page of each unfinished pair.
+        if len(pairs) == 1:
+            region_code, category_id, page_token, rank = pairs[0]
+            return [fetch_most_popular(region_code, category_id, developer_key, key_pool, page_token, rank, cache,
+                                       retry_policy)]
+        retry_policy = retry_policy or RetryPolicy()
+        results = [(region_code, category_id, rank, []) for region_code, category_id, _, rank in pairs]
+        page_tokens = {i: page_token for i, (_, _, page_token, _) in enumerate(pairs)}
+        while page_tokens:
+            youtube, developer_key = get_thread_client(developer_key)
+            if developer_key is None and key_pool is None:
+                # The regions and categories came from the cache, so no call has read the key yet.
+                developer_key = read_developer_key()
+                youtube = None
+            if key_pool is not None:
+                pooled_developer_key = key_pool.acquire("videos", preferred=developer_key, count=len(page_tokens))
+                if pooled_developer_key != developer_key:
+                    developer_key = pooled_developer_key
+                    youtube = None
+            if youtube is None:
+                youtube = get_youtube_client(developer_key=developer_key, retry_policy=retry_policy)
+            thread_local.youtube, thread_local.developer_key = youtube, developer_key
+
+            responses = {}
+
+            def callback(request_id, response, exception):
+                responses[int(request_id)] = (response, exception)
+
+            batch = youtube.new_batch_http_request(callback=callback)
+            batch_params = {}
+            for i, page_token in page_tokens.items():
+                batch_params[i] = get_videos_request_params(pairs[i][0], pairs[i][1], page_token)
+                batch.add(youtube.videos().list(**batch_params[i]), request_id=str(i))
+            retrieved_at = get_retrieved_at()
+            retry_policy.before_call('videos')
+            metrics.increment('quota_units_total', QUOTA_COSTS['videos'] * len(page_tokens), response_type='videos')
+            started = time.perf_counter()
+            try:
+                batch.execute()
+                retry_policy.record_success('videos')
+            except Exception as e:
+                logging.info(f"Batch request failed ({get_error_label(e)}), fetching its pairs one by one.")
+                retry_policy.record_failure('videos')
+                responses = {}
+            finally:
+                metrics.observe_latency('videos_batch', time.perf_counter() - started)
+
+            next_page_tokens = {}
+            for i, page_token in page_tokens.items():
+                region_code, category_id, _, _ = pairs[i]
+                pages = results[i][3]
+                response, exception = responses.get(i, (None, None))
+                if i in responses and exception is None:
+                    pages.append((response, retrieved_at, batch_params[i]))
+                    if response.get('nextPageToken'):
+                        next_page_tokens[i] = response['nextPageToken']
+                elif exception is not None and classify_error(exception) == 'not_found':
+                    logging.info("404 - Requested entity was not found.")
+                    pages.append((None, retrieved_at, batch_params[i]))
+                else:
+                    # Other errors (403, 429, 503...) go through the retries of get_response_from_youtube.
+                    pages.extend(fetch_most_popular(region_code, category_id, developer_key, key_pool,
+                                                    page_token, 1, cache, retry_policy)[3])
+            page_tokens = next_page_tokens
+        return results
+
+    def add_category_metadata(category, region_code):
+        category['metadata'] = dict()
+        category['metadata']['region_code'] = region_code
+        return category
+
+    def add_video_metadata(video, region_code, category_id, rank):
+        video['snippet']['publishedAt'] = video['snippet']['publishedAt'].replace('Z', '.000000000Z').replace('T', ' ')
+        video['metadata'] = dict()
+        video['metadata']['region_code'] = region_code
+        video['metadata']['category_id'] = category_id
+        video['metadata']['rank'] = rank
+        return video
+
+    def collect_most_popular(max_workers=MAX_CONCURRENT_REQUESTS, use_key_pool=True,
+                             backup_compression=BACKUP_COMPRESSION, compression_workers=None,
+                             upload_segments=False, segment_size=SEGMENT_SIZE,
+                             resume=False, journal_s3=False, checkpoint_interval=CHECKPOINT_INTERVAL,
+                             normalized=False, use_cache=True, cache_ttl=CACHE_TTL, batch_size=BATCH_SIZE,
+                             retry_budget=RETRY_BUDGET, creation_date=None, period=None, region_codes=None,
+                             shard=None, incremental=False, segments_location=None):
+        # shard is (index, count) for a worker of a sharded run (see collect_shards.py), which crawls the
+        # region_codes of its shard for the creation_date and period of the coordinator. segments_location is
+        # the (bucket, key prefix) that keeps its segments and the copy of its journal for the coordinator.
+        creation_date = creation_date or datetime.datetime.now(datetime.UTC).strftime("%Y-%m-%d")
+        period = period or get_period()
+        # The incremental output is the normalized one, without the snippets that did not change.
+        normalized = normalized or incremental
+        run_name = 'collect_most_popular' if shard is None else f'collect_most_popular_shard_{shard[0]:03d}'
+        journal_file = JOURNAL_FILE if shard is None else f'./journal_shard_{shard[0]:03d}.jsonl'
+        journal = Journal(creation_date, period, path=journal_file, s3_copy=journal_s3, s3_location=segments_location,
+                          interval=checkpoint_interval).start(resume=resume)
+        if journal.resumed and not upload_segments:
+            # Local outputs can only be resumed on the instance that wrote them. A journal whose outputs are
+            # not all there, complete or not, is ignored.
+            paths = {get_sink_path(f'./{table}.json', backup_compression if table == 'backup' else 'none'): offset
+                     for table, offset in journal.offsets.items()}
+            if journal.complete:
+                paths[MANIFEST_FILE] = 0
+            for path, offset in paths.items():
+                if not os.path.exists(path) or os.path.getsize(path) < offset:
+                    logging.info(f"{path} does not match the journal, starting over.")
+                    journal.start(resume=False)
+                    break
+        compression_workers = compression_workers or os.cpu_count() or 1
+        uploader = None
+        manifest = None
+        if upload_segments:
+            uploader = SegmentUploader(creation_date, period, location=segments_location)
+        else:
+            manifest = Manifest(creation_date, period)
+        if journal.complete:
+            logging.info("The journal says this period was already collected.")
+            if uploader is not None:
+                # The instance that uploaded the last segment may have stopped before the manifest.
+                save_segments_manifest(uploader)
+            return
+
+        def open_output(table):
+            # backup.json is the largest output, so it is compressed while it is written.
+            compression = backup_compression if table == 'backup' else 'none'
+            offset = journal.offsets.get(table, 0) if journal.resumed else None
+            if uploader is not None:
+                # Also clears the segments of a run that stopped before its journal reached S3.
+                uploader.discard(table, after=offset or 0)
+                return SegmentedWriter(table, uploader, compression=compression,
+                                       compression_workers=compression_workers, segment_size=segment_size,
+                                       start_number=offset or 0)
+            sink = open_sink(f'./{table}.json', compression, workers=compression_workers, offset=offset)
+            return manifest.open(table, get_sink_path(f'./{table}.json', compression), sink,
+                                 resumed=offset is not None)
+
+        key_pool = DeveloperKeyPool.from_s3(period, shard=shard) if use_key_pool else None
+        cache = ResponseCache.load(ttl=cache_ttl) if use_cache else None
+        index = SnippetIndex.load() if incremental else None
+        try:
+            with metrics.stage('crawl'):
+                crawl_most_popular(max_workers, key_pool, open_output, journal, normalized=normalized, cache=cache,
+                                   batch_size=batch_size, retry_policy=RetryPolicy(budget=retry_budget),
+                                   region_codes=region_codes, index=index, uploader=uploader)
+            if manifest is not None:
+                manifest.save()
+            if index is not None:
+                index.update(journal.videos, creation_date)
+                logging.info(f"{len(index)} videos in the snippet index.")
+            if uploader is not None:
+                with metrics.stage('upload_segments'):
+                    logging.info(f"{len(uploader.close())} segments uploaded.")
+                save_segments_manifest(uploader)
+                if index is not None:
+                    # The snippets are in S3, so the index can point at them. Otherwise upload_most_popular does it.
+                    upload_index()
+        finally:
+            if index is not None:
+                index.close()
+            if cache is not None:
+                logging.info(f"Response cache: {cache.stats}")
+                for outcome, count in cache.stats.items():
+                    metrics.increment('response_cache_total', count, outcome=outcome)
+                cache.save()
+            if key_pool is not None:
+                # Persist what this run spent, so the next period knows what is left on every key.
+                logging.info(f"Quota units used per key: {key_pool.usage()}")
+                key_pool.save()
+            metrics.try_publish(run_name, creation_date, period, log=logging.error)
+
+    def save_segments_manifest(uploader):
+        # upload_most_popular uploads the manifest of a run that did not upload its outputs itself. That of
+        # segments kept at a location is uploaded by whoever merges them.
+        segments_manifest = uploader.get_manifest()
+        save_manifest(segments_manifest)
+        if uploader.location is None:
+            upload_manifest(segments_manifest, uploader.creation_date, uploader.period)
+        return segments_manifest
+
+    def split_video(video):
+        ranking = {
+            'id': video['id'],
+            'etag': video.get('etag'),
+            'statistics': video.get('statistics', {}),
+            'metadata': video['metadata']
+        }
+        video = {
+            'kind': video.get('kind'),
+            'id': video['id'],
+            'snippet': video['snippet']
+        }
+        return video, ranking
+
+    @contextlib.contextmanager
+    def get_executor(max_workers):
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            yield executor
+        finally:
+            # When the crawl fails, the queued requests are dropped instead of being run before the error surfaces.
+            executor.shutdown(cancel_futures=True)
+
+    def crawl_most_popular(max_workers, key_pool, open_output, journal, normalized=False, cache=None,
+                           batch_size=BATCH_SIZE, retry_policy=None, region_codes=None, index=None, uploader=None):
+        developer_key = None
+        chart_tables = ['videos', 'rankings'] if normalized else ['most_popular']
+        tables = ['backup', 'regions', 'categories'] + chart_tables
+        with contextlib.ExitStack() as stack:
+            outputs = {table: stack.enter_context(open_output(table)) for table in tables}
+            executor = stack.enter_context(get_executor(max_workers))
+            backup_json = outputs['backup']
+            regions_json = outputs['regions']
+            categories_json = outputs['categories']
+
+            def checkpoint(complete=False):
+                if uploader is not None:
+                    # Every checkpoint uploads the open segments: it waits for a full one rather than the interval.
+                    due = any(output.full_segments for output in outputs.values())
+                else:
+                    due = journal.is_due()
+                if complete or due:
+                    journal.commit({table: checkpoint_sink(output) for table, output in outputs.items()},
+                                   complete=complete, when_durable=uploader.after_uploads if uploader else None)
+
+            if journal.region_codes is not None:
+                region_codes = journal.region_codes
+            elif region_codes is not None:
+                # A shard of a sharded run crawls the regions it was given. The coordinator wrote regions.json.
+                region_codes = sorted(region_codes)
+                journal.record_regions(region_codes)
+            else:
+                regions, retrieved_at, request_params, developer_key = fetch_regions(key_pool, cache, retry_policy)
+                region_codes = add_regions_to_files(backup_json, regions_json, regions, retrieved_at, request_params)
+                journal.record_regions(region_codes)
+
+            def is_new_snippet(video):
+                # The snippet of a video is stored once per run, the first time the video shows up. An
+                # incremental run skips it when the index says the same snippet is already stored.
+                if video['id'] in journal.videos:
+                    return False
+                if index is None:
+                    journal.record_video(video['id'])
+                    return True
+                snippet_hash = get_snippet_hash(video['snippet'])
+                snippet = index.get(video['id'])
+                written = snippet is None or snippet[0] != snippet_hash
+                if written:
+                    snippet = [snippet_hash, journal.creation_date, journal.period]
+                metrics.increment('snippets_total', outcome='written' if written else 'unchanged')
+                journal.record_video(video['id'], snippet)
+                return written
+
+            video_futures = []
+            pending_pairs = []
+
+            def submit_pairs(region_code, category_ids, flush=False):
+                for category_id in category_ids:
+                    progress = journal.get_page_progress(region_code, category_id)
+                    if progress is not None:
+                        page_token, rank = progress
+                        pending_pairs.append((region_code, category_id, page_token, rank))
+                while len(pending_pairs) >= batch_size or (flush and pending_pairs):
+                    video_futures.append(executor.submit(fetch_most_popular_batch, pending_pairs[:batch_size],
+                                                         developer_key, key_pool, cache, retry_policy))
+                    del pending_pairs[:batch_size]
+
+            # Regions whose categories were collected before a resume go straight to the videos.
+            for region_code in region_codes:
+                if region_code in journal.categories:
+                    submit_pairs(region_code, journal.categories[region_code])
+
+            for region_code, categories, retrieved_at, request_params in executor.map(
+                    lambda code: fetch_categories(code, developer_key, key_pool, cache, retry_policy),
+                    [code for code in region_codes if code not in journal.categories]):
+                add_response_to_file(backup_json, categories, retrieved_at, request_params=request_params)
+
+                # The next two lines artificially add a "zero" category.
+                # It corresponds to a call to videos.list(most_popular) when no category is specified.
+                category_ids = ['0', ]
+                category_records = [get_unspecified_category(region_code)]
+
+                for category in categories.get('items', []):
+                    if category['snippet']['assignable']:
+                        category_ids.append(category['id'])
+                    category_records.append(add_category_metadata(category, region_code))
+                add_dicts_to_file(categories_json, category_records, retrieved_at)
+                category_ids.sort()
+                journal.record_categories(region_code, category_ids)
+                submit_pairs(region_code, category_ids)
+                checkpoint()
+            submit_pairs(None, [], flush=True)
+
+            # Results are written as soon as they arrive, so finished pages never pile up in memory.
+            # Ranks are assigned per (region, category) page sequence, which every future holds entirely.
+            for future in concurrent.futures.as_completed(video_futures):
+                for region_code, category_id, rank, pages in future.result():
+                    for videos, retrieved_at, request_params in pages:
+                        if videos is not None:
+                            add_response_to_file(backup_json, videos, retrieved_at, request_params=request_params)
+                            # Process items in the current page, whose records are written together per table.
+                            records = {table: [] for table in chart_tables}
+                            for video in videos.get('items', []):
+                                video = add_video_metadata(video, region_code, category_id, rank)
+                                if normalized:
+                                    video, ranking = split_video(video)
+                                    if is_new_snippet(video):
+                                        records['videos'].append(video)
+                                    snippet = journal.videos[video['id']]
+                                    ranking['snippet_creation_date'] = snippet[1] if snippet else journal.creation_date
+                                    ranking['snippet_period'] = snippet[2] if snippet else journal.period
+                                    records['rankings'].append(ranking)
+                                else:
+                                    records['most_popular'].append(video)
+                                rank = rank + 1
+                            for table, page_records in records.items():
+                                add_dicts_to_file(outputs[table], page_records, retrieved_at)
+                        journal.record_page(region_code, category_id, request_params.get('pageToken'),
+                                            videos.get('nextPageToken') if videos else None, rank)
+                checkpoint()
+            checkpoint(complete=True)
+
+    def main():
+        parser = argparse.ArgumentParser(description="Collect most popular videos.")
+        parser.add_argument("--max-workers", type=int, default=MAX_CONCURRENT_REQUESTS,
+                            help="Number of concurrent requests to the YouTube API (1 = sequential)")
+        parser.add_argument("--no-key-pool", action="store_true",
+                            help="Use only the key of the current period, as before the key pool existed")
+        parser.add_argument("--backup-compression", choices=COMPRESSIONS, default=BACKUP_COMPRESSION,
+                            help="Compression applied to backup.json while it is written")
+        parser.add_argument("--compression-workers", type=int, default=None,
+                            help="Threads compressing backup.json in parallel (default: one per core, 1 = single stream)")
+        parser.add_argument("--upload-segments", action="store_true",
+                            help="Roll the outputs into segments and upload them to S3 while collecting")
+        parser.add_argument("--segment-size-mb", type=int, default=SEGMENT_SIZE // 1024 // 1024,
+                            help="Size at which a segment is closed and uploaded")
+        parser.add_argument("--resume", action="store_true",
+                            help="Continue from the journal of an interrupted run of the same period, if there is one")
+        parser.add_argument("--journal-s3", action="store_true",
+                            help="Keep a copy of the journal in S3, so another instance can resume (with --upload-segments)")
+        parser.add_argument("--checkpoint-interval", type=int, default=CHECKPOINT_INTERVAL,
+                            help="Seconds between checkpoints (without --upload-segments)")
+        parser.add_argument("--normalized", action="store_true",
+                            help="Write videos.json (one snippet per video) and rankings.json instead of most_popular.json")
+        parser.add_argument("--incremental", action="store_true",
+                            help="Normalized output that writes only the snippets that changed since they were last stored")
+        parser.add_argument("--no-cache", action="store_true",
+                            help="Always fetch the regions and categories instead of using the response cache")
+        parser.add_argument("--cache-ttl-hours", type=float, default=CACHE_TTL / 3600,
+                            help="Age under which a cached response is used without asking the API")
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                            help="videos.list calls sent together in one batch HTTP request (1 = no batching)")
+        parser.add_argument("--retry-budget-hours", type=float, default=RETRY_BUDGET / 3600,
+                            help="Time after the start of the run past which failed calls are not retried")
+        args = parser.parse_args()
+        collect_most_popular(max_workers=args.max_workers, use_key_pool=not args.no_key_pool,
+                             backup_compression=args.backup_compression,
+                             compression_workers=args.compression_workers,
+                             upload_segments=args.upload_segments,
+                             segment_size=args.segment_size_mb * 1024 * 1024,
+                             resume=args.resume, journal_s3=args.journal_s3,
+                             checkpoint_interval=args.checkpoint_interval,
+                             normalized=args.normalized, use_cache=not args.no_cache,
+                             cache_ttl=args.cache_ttl_hours * 3600, batch_size=args.batch_size,
+                             retry_budget=args.retry_budget_hours * 3600, incremental=args.incremental)
 
     if __name__ == '__main__':
-        collect_most_popular()
+        main()
 except Exception as e:
-    start_new_instance()
+    # A run that uploads segments is resumed from them by the next instance, which must upload them too.
+    start_new_instance({'upload_segments': True} if '--upload-segments' in sys.argv else None)
     send_gmail('Error! Please check AWS', f'Hi, my friend!\n\nThe script collect_most_popular.py has just failed with this error:\n\n{str(e)}\n\nYou need to visit AWS EC2 to see what happened.\n\nAll the best,\nAdmin.')
     raise e
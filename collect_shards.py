@@ -0,0 +1,201 @@
+# Sharded collection: a coordinator splits the regions of a period across workers that crawl at the same time.
+#
+# The coordinator fetches the region list and writes regions.json and the first record of the backup. Every
+# worker gets a shard of the regions (round robin over the sorted codes, so big and small regions are mixed)
+# and runs collect_most_popular on it, with keys of its own (see DeveloperKeyPool.from_s3) and a journal of
+# its own, in a directory of its own. The workers run as local processes or on EC2 instances (see
+# work_queue.py). A worker on EC2 uploads its outputs in segments to the prefix of its task, next to the copy
+# of its journal, so the instance started when it fails resumes it. When they are all done, merge_shards
+# appends their outputs to the coordinator's files, which then look like those of an unsharded run, so
+# upload_most_popular.py uploads them as usual.
+#
+# python collect_shards.py coordinator --shards 4 --queue local
+# python collect_shards.py worker s3://youtube-trends-uiuc-admin/shards/.../task.json   (on a worker instance)
+
+import os
+import json
+import shutil
+import logging
+import argparse
+import datetime
+from collect_most_popular import collect_most_popular, fetch_regions, add_regions_to_files, get_period, \
+    send_gmail, count_running_instances, MAX_EC2_INSTANCES_RUNNING, MAX_CONCURRENT_REQUESTS, BACKUP_COMPRESSION, \
+    BATCH_SIZE, DISCOVERY_FILE
+from key_pool import DeveloperKeyPool
+from metrics import metrics
+from response_cache import ResponseCache
+from retry_policy import RetryPolicy
+from sinks import open_sink, get_sink_path, COMPRESSIONS
+from manifest import Manifest, load_manifest, MANIFEST_FILE
+from work_queue import LocalWorkQueue, Ec2WorkQueue, run_ec2_task, SHARDS_DIRECTORY
+
+SHARDS = 4
+QUEUES = ('local', 'ec2')
+
+
+def get_tables(normalized=False):
+    return ['categories'] + (['videos', 'rankings'] if normalized else ['most_popular'])
+
+
+def split_regions(region_codes, shards):
+    return [codes for codes in (sorted(region_codes)[i::shards] for i in range(shards)) if codes]
+
+
+def run_shard(task):
+    # Runs in the process (or on the instance) of a worker.
+    directory = os.path.abspath(task['directory'])
+    os.makedirs(directory, exist_ok=True)
+    if os.path.exists(DISCOVERY_FILE) and not os.path.exists(os.path.join(directory, DISCOVERY_FILE)):
+        # The document the coordinator used, so workers build their clients without downloading it.
+        shutil.copy(DISCOVERY_FILE, directory)
+    os.chdir(directory)
+    options = task['options']
+    location = task.get('location')
+    collect_most_popular(creation_date=task['creation_date'], period=task['period'],
+                         region_codes=task['region_codes'], shard=(task['shard'], task['shards']),
+                         resume=True, upload_segments=location is not None, journal_s3=location is not None,
+                         segments_location=location, **options)
+    if location is not None:
+        # The segments are under the location already, with their manifests.
+        manifest = load_manifest()
+        return {'shard': task['shard'], 'directory': directory,
+                'files': {os.path.basename(MANIFEST_FILE): os.path.getsize(MANIFEST_FILE)},
+                'segments': [segment['file'] for entry in manifest['tables'].values() for segment in entry['segments']]}
+    compression = options.get('backup_compression', BACKUP_COMPRESSION)
+    files = [os.path.basename(get_sink_path('./backup.json', compression)), os.path.basename(MANIFEST_FILE)] + \
+            [f'{table}.json' for table in get_tables(options.get('normalized', False))]
+    return {'shard': task['shard'], 'directory': directory,
+            'files': {name: os.path.getsize(name) for name in files}}
+
+
+def get_shard_outputs(result, shard_manifest, table, name):
+    # The files of a table in the directory of a shard, the file name or its segments in order, with the
+    # manifest entry of the table. A table of which a shard wrote no record has no segment.
+    entry = shard_manifest['tables'].get(table)
+    if entry is None:
+        return [], None
+    names = [segment['file'] for segment in entry['segments']] if 'segments' in entry else [name]
+    return [os.path.join(result['directory'], name) for name in names], entry
+
+
+def merge_shards(results, manifest, normalized=False, backup_compression=BACKUP_COMPRESSION):
+    # Appends the outputs of the shards, in shard order, to the files of the coordinator. The counts of the
+    # merged files are those of the shard manifests, their checksums those of the bytes written here.
+    results = sorted(results, key=lambda result: result['shard'])
+    shard_manifests = [load_manifest(os.path.join(result['directory'], MANIFEST_FILE)) for result in results]
+    backup_name = os.path.basename(get_sink_path('./backup.json', backup_compression))
+    with manifest.open('backup', backup_name, open(backup_name, 'ab'), resumed=True) as backup:
+        for result, shard_manifest in zip(results, shard_manifests):
+            paths, entry = get_shard_outputs(result, shard_manifest, 'backup', backup_name)
+            for path in paths:
+                # Compressed streams can be concatenated: the result reads as one backup.
+                with open(path, 'rb') as f:
+                    shutil.copyfileobj(f, backup)
+            if entry is not None:
+                backup.add(entry)
+    for table in get_tables(normalized):
+        video_ids = set()
+        with manifest.open(table, f'./{table}.json', open(f'./{table}.json', 'w')) as output:
+            for result, shard_manifest in zip(results, shard_manifests):
+                paths, entry = get_shard_outputs(result, shard_manifest, table, f'{table}.json')
+                if table != 'videos':
+                    for path in paths:
+                        with open(path) as f:
+                            shutil.copyfileobj(f, output)
+                    if entry is not None:
+                        output.add(entry)
+                    continue
+                # A video in the charts of several shards is stored once, as in an unsharded run.
+                for path in paths:
+                    with open(path) as f:
+                        for line in f:
+                            video = json.loads(line)
+                            if video['id'] not in video_ids:
+                                video_ids.add(video['id'])
+                                output.write(line)
+                                output.count_record(video)
+    manifest.save()
+
+
+def coordinate(creation_date, period, shards=SHARDS, queue='local', max_workers=MAX_CONCURRENT_REQUESTS,
+               use_key_pool=True, backup_compression=BACKUP_COMPRESSION, normalized=False, use_cache=True,
+               batch_size=BATCH_SIZE):
+    if queue == 'ec2' and shards > MAX_EC2_INSTANCES_RUNNING - 1:
+        raise Exception(f"{shards} shards need more instances than the {MAX_EC2_INSTANCES_RUNNING} allowed.")
+
+    key_pool = DeveloperKeyPool.from_s3(period) if use_key_pool else None
+    cache = ResponseCache.load() if use_cache else None
+    with metrics.stage('fetch_regions'):
+        regions, retrieved_at, request_params, _ = fetch_regions(key_pool, cache, RetryPolicy())
+    if key_pool is not None:
+        key_pool.save()
+    if cache is not None:
+        cache.save()
+    manifest = Manifest(creation_date, period)
+    with manifest.open('backup', get_sink_path('./backup.json', backup_compression),
+                       open_sink('./backup.json', backup_compression)) as backup_json, \
+            manifest.open('regions', './regions.json', open_sink('./regions.json')) as regions_json:
+        region_codes = add_regions_to_files(backup_json, regions_json, regions, retrieved_at, request_params)
+
+    shard_regions = split_regions(region_codes, shards)
+    options = {'max_workers': max_workers, 'use_key_pool': use_key_pool, 'backup_compression': backup_compression,
+               'normalized': normalized, 'use_cache': use_cache, 'batch_size': batch_size}
+    tasks = [{'creation_date': creation_date, 'period': period, 'shard': i, 'shards': len(shard_regions),
+              'region_codes': codes, 'options': options} for i, codes in enumerate(shard_regions)]
+    logging.info(f"{len(region_codes)} regions split into {len(tasks)} shards.")
+    if queue == 'ec2':
+        work_queue = Ec2WorkQueue(creation_date, period, count_instances=count_running_instances,
+                                  max_instances=MAX_EC2_INSTANCES_RUNNING)
+    else:
+        work_queue = LocalWorkQueue(run_shard, directory=SHARDS_DIRECTORY)
+    with metrics.stage('collect_shards'):
+        results = work_queue.run(tasks)
+    with metrics.stage('merge_shards'):
+        merge_shards(results, manifest, normalized=normalized, backup_compression=backup_compression)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collect most popular videos with several workers.")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    coordinator = subparsers.add_parser("coordinator", help="Split the regions, run the shards and merge them")
+    coordinator.add_argument("--shards", type=int, default=SHARDS, help="Number of workers")
+    coordinator.add_argument("--queue", choices=QUEUES, default='local',
+                             help="local runs the workers as processes, ec2 starts an instance per worker")
+    coordinator.add_argument("--max-workers", type=int, default=MAX_CONCURRENT_REQUESTS,
+                             help="Concurrent requests of every worker")
+    coordinator.add_argument("--no-key-pool", action="store_true", help="Use only the key of the current period")
+    coordinator.add_argument("--backup-compression", choices=COMPRESSIONS, default=BACKUP_COMPRESSION)
+    coordinator.add_argument("--normalized", action="store_true",
+                             help="Write videos.json and rankings.json instead of most_popular.json")
+    coordinator.add_argument("--no-cache", action="store_true", help="Do not use the response cache")
+    coordinator.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                             help="videos.list calls sent together in one batch HTTP request")
+    worker = subparsers.add_parser("worker", help="Run the shard of a task written by an EC2 coordinator")
+    worker.add_argument("task", help="s3:// URL of the task.json of the shard")
+    args = parser.parse_args()
+
+    if args.mode == 'worker':
+        # Failures are reported by the coordinator, which gets them through result.json.
+        run_ec2_task(args.task, run_shard)
+        return
+
+    try:
+        creation_date = datetime.datetime.now(datetime.UTC).strftime("%Y-%m-%d")
+        period = get_period()
+        try:
+            results = coordinate(creation_date, period, shards=args.shards, queue=args.queue,
+                                 max_workers=args.max_workers, use_key_pool=not args.no_key_pool,
+                                 backup_compression=args.backup_compression, normalized=args.normalized,
+                                 use_cache=not args.no_cache, batch_size=args.batch_size)
+            for result in results:
+                print(f"Shard {result['shard']}: {result['files']}", flush=True)
+        finally:
+            metrics.try_publish('collect_shards', creation_date, period)
+    except Exception as e:
+        send_gmail('Error! Please check AWS', f'Hi, my friend!\n\nThe script collect_shards.py has just failed with this error:\n\n{str(e)}\n\nYou need to visit AWS EC2 to see what happened.\n\nAll the best,\nAdmin.')
+        raise e
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+# Compacts the four period partitions of a day into one sorted ORC file per table, for cheaper Athena scans.
+#
+# Every period adds small, unsorted ORC files to every table, so a query on one video, region or channel
+# reads all of them. The compacted file of a day holds its four periods (period becomes a column), sorted
+# by region_code, category_id and rank (videos by id), in stripes and row groups small enough for Athena
+# to skip most of them with their min/max statistics. id and snippet.channelId also get bloom filters,
+# which skip the row groups of point lookups that the sort order does not help.
+# Files go to compacted/<table>/creation_date=<day>/<table>.orc, read by the *_daily tables of athena.sql.
+# The ORC files a day was compacted from are recorded with their ETags in compacted/_sources/, so a day is
+# compacted again when its partitions change, e.g. after rebuild_partitions.py.
+#
+# A day does not have to fit in memory: its rows are first spilled into buckets of consecutive sort keys
+# (compressed Arrow IPC files), then every bucket is sorted and appended to the ORC file, in order.
+#
+# python compact_partitions.py 2025-01-01 2025-01-31 --workers 4
+# python compact_partitions.py   (the last days whose four periods are uploaded, if they changed since compacted)
+
+import os
+import json
+import time
+import shutil
+import argparse
+import datetime
+import collections
+import concurrent.futures
+import boto3
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.orc
+import orc_writer
+from segment_uploader import DATA_BUCKET, TRANSFER_CONFIG
+from schemas import get_struct
+from manifest import download_manifest
+from partitions import PERIODS, get_days
+
+TABLES = ('most_popular', 'videos', 'rankings')
+COMPACTED_PREFIX = 'compacted'
+# Outside of the compacted/<table>/ locations of athena.sql.
+SOURCES_PREFIX = f'{COMPACTED_PREFIX}/_sources'
+# Days looked at when no date is given: yesterday, and the days before it that may have been rebuilt.
+LOOKBACK_DAYS = 7
+COMPACT_DIRECTORY = './compact'
+COMPACT_WORKERS = 1
+CHART_SORT_KEYS = (('metadata', 'region_code'), ('metadata', 'category_id'), ('metadata', 'rank'), ('period',))
+SORT_KEYS = {
+    'most_popular': CHART_SORT_KEYS,
+    'rankings': CHART_SORT_KEYS,
+    'videos': (('id',), ('period',)),
+}
+BLOOM_FILTER_COLUMNS = {
+    'most_popular': (('id',), ('snippet', 'channelId')),
+    'videos': (('id',), ('snippet', 'channelId')),
+    'rankings': (('id',),),
+}
+# Smaller than the 64MB and 10000 rows of the writer defaults: a region spans a few row groups of a few
+# stripes, and the rest of the file is skipped.
+STRIPE_SIZE = 16 * 1024 * 1024
+ROW_INDEX_STRIDE = 5000
+BLOOM_FILTER_FPP = 0.01
+# Rows sorted in memory at once.
+ROWS_PER_BUCKET = 50000
+SPILL_COMPRESSION = 'zstd'
+
+
+def get_compacted_key(table, creation_date):
+    return f"{COMPACTED_PREFIX}/{table}/creation_date={creation_date}/{table}.orc"
+
+
+def get_sources_key(creation_date):
+    return f"{SOURCES_PREFIX}/creation_date={creation_date}/sources.json"
+
+
+def get_period_objects(s3, table, creation_date, period):
+    # The ORC files of a period partition, by key, with their ETags.
+    prefix = f"{table}/creation_date={creation_date}/period={period}/"
+    return {obj.key: obj.e_tag for obj in s3.Bucket(DATA_BUCKET).objects.filter(Prefix=prefix)
+            if obj.key.endswith('.orc')}
+
+
+def get_period_keys(s3, table, creation_date, period):
+    return sorted(get_period_objects(s3, table, creation_date, period))
+
+
+def get_sources(s3, table, creation_date):
+    sources = {}
+    for period in PERIODS:
+        sources.update(get_period_objects(s3, table, creation_date, period))
+    return sources
+
+
+def is_period_uploaded(s3, creation_date, period):
+    # The manifest of a period is uploaded once its upload is over, with what the upload checked, or by a run
+    # that uploaded segments. Every table it lists, whatever the layout, must then be in S3: each of its
+    # segments, or a converted file whose row count matched the manifest. The backup is not compacted.
+    manifest = download_manifest(creation_date, period, s3=s3)
+    if manifest is None:
+        return False
+    checks = manifest.get('checks', {})
+    for table, entry in manifest['tables'].items():
+        if table in ('backup', 'compressed_backup'):
+            continue
+        objects = get_period_objects(s3, table, creation_date, period)
+        if 'segments' in entry:
+            if any(segment['key'] not in objects for segment in entry['segments']):
+                return False
+        elif not checks.get(table, {}).get('valid') or not objects:
+            return False
+    return True
+
+
+def is_day_uploaded(s3, creation_date):
+    return all(is_period_uploaded(s3, creation_date, period) for period in PERIODS)
+
+
+def load_compacted_sources(s3, creation_date):
+    try:
+        content = s3.Object(DATA_BUCKET, get_sources_key(creation_date)).get()['Body'].read()
+    except s3.meta.client.exceptions.NoSuchKey:
+        return {}
+    return json.loads(content.decode('utf-8'))['tables']
+
+
+def save_compacted_sources(s3, creation_date, sources):
+    # Merged with the tables compacted before, which a run with --tables leaves as they are.
+    tables = dict(load_compacted_sources(s3, creation_date), **sources)
+    s3.Object(DATA_BUCKET, get_sources_key(creation_date)).put(
+        Body=json.dumps({'creation_date': creation_date, 'tables': tables}, indent=1).encode('utf-8'))
+
+
+def is_day_compacted(s3, creation_date, tables=TABLES):
+    # Compacted from the ORC files the partitions of the day hold now, and not from older ones.
+    compacted = load_compacted_sources(s3, creation_date)
+    return all(table in compacted and compacted[table] == get_sources(s3, table, creation_date)
+               for table in tables)
+
+
+def get_compacted_schema(table):
+    return orc_writer.get_schema(get_struct(table)).append(pa.field('period', pa.string()))
+
+
+def get_column(table, path):
+    column = table[path[0]]
+    for name in path[1:]:
+        column = pc.struct_field(column, name)
+    return column
+
+
+def read_stripes(files, schema):
+    # files holds (period, path) pairs. One stripe at a time, with the period added as a column.
+    period_schema = pa.schema(list(schema)[:-1])
+    for period, path in files:
+        orc_file = pyarrow.orc.ORCFile(path)
+        for i in range(orc_file.nstripes):
+            stripe = pa.Table.from_batches([orc_file.read_stripe(i)]).cast(period_schema)
+            yield stripe.append_column('period', pa.array([period] * stripe.num_rows, pa.string()))
+
+
+def get_buckets(files, first_key):
+    # Splits the sorted values of the first sort key into buckets of about ROWS_PER_BUCKET rows.
+    counts = collections.Counter()
+    for _, path in files:
+        column = get_column(pyarrow.orc.ORCFile(path).read(columns=[first_key[0]]), first_key)
+        for item in pc.value_counts(column.combine_chunks()).to_pylist():
+            counts[item['values']] += item['counts']
+    values = sorted(value for value in counts if value is not None)
+    buckets = []
+    rows = 0
+    for value in values:
+        if rows >= ROWS_PER_BUCKET or not buckets:
+            buckets.append(0)
+            rows = 0
+        rows += counts[value]
+        buckets[-1] += 1
+    # The bucket of every value, by its position in values.
+    return pa.array(values, pa.string()), pa.array([i for i, size in enumerate(buckets) for _ in range(size)],
+                                                   pa.int32())
+
+
+def compact_table(table, files, orc_file, directory):
+    schema = get_compacted_schema(table)
+    sort_keys = SORT_KEYS[table]
+    values, bucket_of_value = get_buckets(files, sort_keys[0])
+    spill_files = {}
+    writers = {}
+    options = pa.ipc.IpcWriteOptions(compression=SPILL_COMPRESSION)
+    try:
+        for stripe in read_stripes(files, schema):
+            if stripe.num_rows == 0:
+                continue
+            # Rows without a value for the key (none are expected) go to the first bucket.
+            positions = pc.fill_null(pc.index_in(get_column(stripe, sort_keys[0]), value_set=values), 0)
+            buckets = pc.take(bucket_of_value, positions)
+            for bucket in pc.unique(buckets).to_pylist():
+                if bucket not in writers:
+                    spill_files[bucket] = os.path.join(directory, f'{table}-{bucket:05d}.arrow')
+                    writers[bucket] = pa.ipc.new_file(spill_files[bucket], schema, options=options)
+                writers[bucket].write_table(stripe.filter(pc.equal(buckets, bucket)))
+        for writer in writers.values():
+            writer.close()
+
+        rows = 0
+        with pyarrow.orc.ORCWriter(orc_file, compression=orc_writer.ORC_COMPRESSION, stripe_size=STRIPE_SIZE,
+                                   row_index_stride=ROW_INDEX_STRIDE, bloom_filter_fpp=BLOOM_FILTER_FPP,
+                                   bloom_filter_columns=[orc_writer.get_orc_column_id(schema, path)
+                                                        for path in BLOOM_FILTER_COLUMNS[table]]) as writer:
+            for bucket in sorted(spill_files):
+                with pa.memory_map(spill_files[bucket]) as source:
+                    rows_of_bucket = pa.ipc.open_file(source).read_all()
+                keys = pa.table({str(i): get_column(rows_of_bucket, path) for i, path in enumerate(sort_keys)})
+                indices = pc.sort_indices(keys, sort_keys=[(str(i), 'ascending') for i in range(len(sort_keys))])
+                writer.write(rows_of_bucket.take(indices))
+                rows += rows_of_bucket.num_rows
+                os.remove(spill_files[bucket])
+            if rows == 0:
+                writer.write(schema.empty_table())
+        return rows
+    finally:
+        for path in spill_files.values():
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def compact_day(creation_date, tables=TABLES, dry_run=False, directory=COMPACT_DIRECTORY, keep=False):
+    s3 = boto3.resource('s3')
+    started = time.perf_counter()
+    work_directory = os.path.join(directory, f"creation_date={creation_date}")
+    os.makedirs(work_directory, exist_ok=True)
+    results = {}
+    sources = {}
+    try:
+        for table in tables:
+            files = []
+            sources[table] = {}
+            for period in PERIODS:
+                objects = get_period_objects(s3, table, creation_date, period)
+                sources[table].update(objects)
+                for key in sorted(objects):
+                    path = os.path.join(work_directory, f"{table}-{period}-{len(files):05d}.orc")
+                    s3.Bucket(DATA_BUCKET).download_file(key, path, Config=TRANSFER_CONFIG)
+                    files.append((period, path))
+            if not files:
+                if not dry_run:
+                    # Not in the layout of the day (anymore): no compacted file either.
+                    s3.Object(DATA_BUCKET, get_compacted_key(table, creation_date)).delete()
+                continue
+            orc_file = os.path.join(work_directory, f'{table}.orc')
+            rows = compact_table(table, files, orc_file, work_directory)
+            results[table] = {'files': len(files), 'rows': rows,
+                              'bytes_before': sum(os.path.getsize(path) for _, path in files),
+                              'bytes_after': os.path.getsize(orc_file)}
+            if not dry_run:
+                s3.Bucket(DATA_BUCKET).upload_file(orc_file, get_compacted_key(table, creation_date),
+                                                   Config=TRANSFER_CONFIG)
+            for _, path in files:
+                os.remove(path)
+        if not dry_run:
+            # The ETags listed before the downloads: a file replaced since then makes the day compacted again.
+            save_compacted_sources(s3, creation_date, sources)
+    finally:
+        # A dry run keeps its files, to be inspected.
+        if not keep and not dry_run:
+            shutil.rmtree(work_directory, ignore_errors=True)
+    return {'creation_date': creation_date, 'tables': results, 'seconds': time.perf_counter() - started}
+
+
+def compact_days(days, tables=TABLES, workers=COMPACT_WORKERS, dry_run=False, directory=COMPACT_DIRECTORY,
+                 keep=False):
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=1) as executor:
+        futures = {executor.submit(compact_day, day, tables, dry_run, directory, keep): day for day in days}
+        for future in concurrent.futures.as_completed(futures):
+            day = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"creation_date={day} failed: {e}", flush=True)
+                failed.append(day)
+                continue
+            print(f"creation_date={day} compacted in {result['seconds']:.1f}s: {result['tables']}", flush=True)
+    if failed:
+        raise Exception(f"{len(failed)} days could not be compacted: {', '.join(sorted(failed))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact the periods of a day into one sorted ORC file per table.")
+    parser.add_argument("start_date", nargs="?",
+                        help=f"YYYY-MM-DD (default: the last {LOOKBACK_DAYS} days whose periods are all uploaded, "
+                             "if their partitions changed since they were compacted)")
+    parser.add_argument("end_date", nargs="?", help="YYYY-MM-DD, included (default: start_date)")
+    parser.add_argument("--tables", nargs="+", choices=TABLES, default=list(TABLES))
+    parser.add_argument("--workers", type=int, default=COMPACT_WORKERS, help="Days compacted at the same time")
+    parser.add_argument("--dry-run", action="store_true", help="Write the ORC files locally without uploading them")
+    parser.add_argument("--directory", default=COMPACT_DIRECTORY, help="Where days are compacted")
+    parser.add_argument("--keep", action="store_true", help="Keep the local files of every day")
+    parser.add_argument("--force", action="store_true",
+                        help="Compact the days even if their partitions did not change since they were compacted")
+    args = parser.parse_args()
+
+    s3 = boto3.resource('s3')
+    if args.start_date:
+        days = list(get_days(args.start_date, args.end_date or args.start_date))
+    else:
+        yesterday = datetime.datetime.now(datetime.UTC).date() - datetime.timedelta(days=1)
+        days = [day for day in get_days((yesterday - datetime.timedelta(days=LOOKBACK_DAYS - 1)).isoformat(),
+                                        yesterday.isoformat())
+                if is_day_uploaded(s3, day)]
+    if not args.force:
+        days = [day for day in days if not is_day_compacted(s3, day, args.tables)]
+    if not days:
+        print("Nothing to compact.")
+        return
+    compact_days(days, tables=args.tables, workers=args.workers, dry_run=args.dry_run, directory=args.directory,
+                 keep=args.keep)
+
+
+if __name__ == '__main__':
+    main()
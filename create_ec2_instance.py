@@ -9,14 +9,33 @@ su ubuntu -c 'mkdir .aws'
 su ubuntu -c 'printf "[default]\\nregion=us-west-2" > /home/ubuntu/.aws/config'
 su ubuntu -c 'wget https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/init_script.sh'
 su ubuntu -c 'chmod +x /home/ubuntu/init_script.sh'
-su ubuntu -c 'sudo apt-get update -y'
+{shard_environment}su ubuntu -c 'sudo apt-get update -y'
 su ubuntu -c 'sudo apt-get install -y screen'
 su ubuntu -c "screen -dmS youtube_trends sh -c '/home/ubuntu/init_script.sh 2>&1 | tee output.txt; exec bash'"
 """
 
+def get_shard_environment(event):
+    # {"shards": N} starts the coordinator of a sharded run (see collect_shards.py), and
+    # {"shard_task": "s3://..."} one of its workers. {"upload_segments": true} starts a run that uploads
+    # its segments while collecting, and resumes from them. init_script.sh reads the variables from shard.env.
+    variables = {}
+    if event and event.get('shards'):
+        variables['SHARDS'] = str(int(event['shards']))
+    if event and event.get('shard_task'):
+        variables['SHARD_TASK'] = event['shard_task']
+    if event and event.get('upload_segments'):
+        variables['UPLOAD_SEGMENTS'] = 'true'
+    if not variables:
+        return ''
+    content = ''.join(f"{name}={value}\\n" for name, value in variables.items())
+    return f"su ubuntu -c 'printf \"{content}\" > /home/ubuntu/shard.env'\n"
+
+
 def lambda_handler(event, context):
     ec2 = boto3.resource('ec2')
     instance_name = f"YT {datetime.datetime.now(datetime.UTC).strftime('%Y-%m-%d %H')}"
+    if event and event.get('shard_task'):
+        instance_name += f" {event['shard_task'].rstrip('/').split('/')[-2]}"
     ec2.create_instances(
         ImageId='ami-0836fd4a4a0b4f6ec',
         InstanceType='t4g.nano',
@@ -24,7 +43,7 @@ def lambda_handler(event, context):
         MaxCount=1,
         KeyName='Dec9-2019-key',
         InstanceInitiatedShutdownBehavior='terminate',
-        UserData=INIT_SCRIPT,
+        UserData=INIT_SCRIPT.replace('{shard_environment}', get_shard_environment(event)),
         SecurityGroupIds=['sg-0b6d936cbbaab78f2',],
         BlockDeviceMappings=[
             {
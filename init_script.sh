@@ -17,6 +17,22 @@ cd /home/ubuntu
 wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/collect_most_popular.py
 wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/requirements.txt
 wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/upload_most_popular.py
+wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/key_pool.py
+wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/orc_writer.py
+wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/sinks.py
+wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/segment_uploader.py
+wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/checkpoint.py
+wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/response_cache.py
+wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/metrics.py
+wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/retry_policy.py
+wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/manifest.py
+wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/stage_scheduler.py
+wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/work_queue.py
+wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/collect_shards.py
+wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/compact_partitions.py
+wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/partitions.py
+wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/schemas.py
+wget -nv --tries=12 --waitretry=10 --retry-connrefused -c https://raw.githubusercontent.com/youtube-trends-uiuc/most_popular_collector_v2/refs/heads/main/snippet_index.py
 python3 -m venv ./venv
 source ./venv/bin/activate
 
@@ -44,15 +60,44 @@ if [ "$SUCCESS" = false ]; then
     echo "Failed to install requirements after $MAX_RETRIES attempts."
 fi
 
+# shard.env is written by the create_ec2_instance Lambda for the instances of a sharded run, or of a run
+# that uploads segments.
+SHARDS=""
+SHARD_TASK=""
+UPLOAD_SEGMENTS=""
+if [ -f ./shard.env ]; then
+    source ./shard.env
+fi
+
 # make sure it will not erase the instance if one of the scripts fail
 set -euo pipefail
+if [ -n "$SHARD_TASK" ]; then
+    # A worker of a sharded run: the coordinator merges and uploads what it collects.
+    python3 ./collect_shards.py worker "$SHARD_TASK" 2>&1 | tee ./collect_shards.log && \
+    sudo shutdown -h now
+    exit 0
+fi
+UPLOAD_OUTPUTS=true
+if [ -n "$SHARDS" ]; then
+    COLLECT_COMMAND="./collect_shards.py coordinator --shards $SHARDS --queue ec2"
+elif [ -n "$UPLOAD_SEGMENTS" ]; then
+    # The instance started when a run fails has none of its files: the segments and the journal are in S3 at
+    # every checkpoint, so it resumes from there. The segments are uploaded while collecting.
+    COLLECT_COMMAND="./collect_most_popular.py --upload-segments --resume --journal-s3"
+    UPLOAD_OUTPUTS=false
+else
+    COLLECT_COMMAND="./collect_most_popular.py --resume"
+fi
 # where to find how to format the timestamp in orc-tools: https://docs.oracle.com/javase/8/docs/api/java/time/format/DateTimeFormatter.html
-python3 ./collect_most_popular.py 2>&1 | tee ./collect_most_popular.log && \
-wget -nv --tries=60 --waitretry=60 --retry-connrefused -c \
-  "https://repo1.maven.org/maven2/org/apache/orc/orc-tools/2.2.2/orc-tools-2.2.2-uber.jar" \
-  -O ./orc-tools-uber.jar || \
-python3 -c "import boto3; boto3.client('s3').download_file('youtube-trends-uiuc-admin', 'orc-tools-2.2.2-uber.jar', './orc-tools-uber.jar')" || true && \
-python3 ./upload_most_popular.py 2>&1 | tee ./upload_most_popular.log && \
+python3 $COLLECT_COMMAND 2>&1 | tee ./collect_most_popular.log && \
+if [ "$UPLOAD_OUTPUTS" = true ]; then
+    wget -nv --tries=60 --waitretry=60 --retry-connrefused -c \
+      "https://repo1.maven.org/maven2/org/apache/orc/orc-tools/2.2.2/orc-tools-2.2.2-uber.jar" \
+      -O ./orc-tools-uber.jar || \
+    python3 -c "import boto3; boto3.client('s3').download_file('youtube-trends-uiuc-admin', 'orc-tools-2.2.2-uber.jar', './orc-tools-uber.jar')" || true && \
+    python3 ./upload_most_popular.py 2>&1 | tee ./upload_most_popular.log
+fi && \
+{ python3 ./compact_partitions.py 2>&1 | tee ./compact_partitions.log || echo "Compaction failed, the next run tries again."; } && \
 sudo shutdown -h now
 # java -jar ./orc-tools-uber.jar convert most_popular.json -s 'struct<kind:string,etag:string,id:string,snippet:struct<publishedAt:timestamp,title:string,description:string,channelId:string,channelTitle:string,categoryId:string,tags:array<string>,liveBroadcastContent:string,defaultLanguage:string,defaultAudioLanguage:string,localized:struct<title:string,description:string>,thumbnails:struct<default:struct<url:string,width:int,height:int>,medium:struct<url:string,width:int,height:int>,high:struct<url:string,width:int,height:int>,standard:struct<url:string,width:int,height:int>,maxres:struct<url:string,width:int,height:int>>>,statistics:struct<viewCount:bigint,likeCount:bigint,dislikeCount:bigint,favoriteCount:bigint,commentCount:bigint>,metadata:struct<region_code:string,category_id:string,retrieved_at:timestamp,rank:int>>' -o most_popular.orc -t "yyyy-MM-dd HH:mm:ss.nX" 2>&1 | tee ./orc_most_popular_output.log && \
 # java -jar ./orc-tools-uber.jar convert regions.json -s 'struct<id:string,snippet:struct<name:string>,metadata:struct<retrieved_at:timestamp>>' -o regions.orc -t "yyyy-MM-dd HH:mm:ss.nX" 2>&1 | tee ./orc_regions_output.log && \
@@ -0,0 +1,212 @@
+import json
+import time
+import hashlib
+import logging
+import datetime
+import threading
+from zoneinfo import ZoneInfo
+import boto3
+
+ADMIN_BUCKET = 'youtube-trends-uiuc-admin'
+# Every run keeps what it spent in quota_usage/quota_day=<day>/<writer>.json, which no other run writes.
+QUOTA_USAGE_PREFIX = 'quota_usage'
+QUOTA_USAGE_FILE = './quota_usage.json'
+
+# Every key gets 10,000 units per day. The day resets at midnight Pacific Time.
+DAILY_QUOTA_UNITS = 10000
+QUOTA_TIMEZONE = ZoneInfo('America/Los_Angeles')
+# Stop using a key before it runs out, so the next period still has some room on it.
+QUOTA_RESERVE_UNITS = 100
+# https://developers.google.com/youtube/v3/determine_quota_cost
+QUOTA_COSTS = {
+    'regions': 1,     # i18nRegions.list
+    'categories': 1,  # videoCategories.list
+    'videos': 1,      # videos.list
+}
+# Short-term token bucket per key, so requests are spread across keys instead of bursting on one.
+BUCKET_CAPACITY_UNITS = 20
+BUCKET_REFILL_UNITS_PER_SECOND = 10
+
+
+class QuotaExhausted(Exception):
+    pass
+
+
+def get_key_id(developer_key):
+    # Never log or persist the key itself.
+    return hashlib.sha256(developer_key.encode('utf-8')).hexdigest()[:12]
+
+
+def get_quota_day():
+    return datetime.datetime.now(QUOTA_TIMEZONE).strftime("%Y-%m-%d")
+
+
+def read_credentials(object_name):
+    s3 = boto3.resource('s3')
+    content_object = s3.Object(ADMIN_BUCKET, object_name)
+    file_content = content_object.get()['Body'].read().decode('utf-8')
+    return json.loads(file_content)
+
+
+class DeveloperKeyPool:
+    def __init__(self, developer_keys, emergency_keys=(), preferred_key=None, used_units=None, writer='default',
+                 daily_quota=DAILY_QUOTA_UNITS, reserve=QUOTA_RESERVE_UNITS,
+                 capacity=BUCKET_CAPACITY_UNITS, refill_rate=BUCKET_REFILL_UNITS_PER_SECOND,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.keys = []
+        for developer_key in list(developer_keys) + list(emergency_keys):
+            if developer_key not in self.keys:
+                self.keys.append(developer_key)
+        if not self.keys:
+            raise QuotaExhausted("No developer keys available.")
+        self.emergency_keys = set(emergency_keys) - set(developer_keys)
+        self.preferred_key = preferred_key
+        self.writer = writer
+        self.daily_quota = daily_quota
+        self.reserve = reserve
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.clock = clock
+        self.sleep = sleep
+        self.quota_day = get_quota_day()
+        used_units = used_units or {}
+        self.used = {k: used_units.get(get_key_id(k), 0) for k in self.keys}
+        self.spent_since_save = {k: 0 for k in self.keys}
+        self.exhausted = set()
+        self.tokens = {k: float(capacity) for k in self.keys}
+        self.last_refill = {k: clock() for k in self.keys}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_s3(cls, period, shard=None, **kwargs):
+        credentials = read_credentials('credentials.json')
+        emergency_credentials = read_credentials('credentials_emergency.json')
+        # The key assigned to this period comes first, then the others, then the emergency keys.
+        preferred_key = credentials[period]
+        developer_keys = [preferred_key] + [credentials[p] for p in sorted(credentials) if p != period]
+        emergency_keys = [emergency_credentials[p] for p in sorted(emergency_credentials)]
+        if shard is not None:
+            # Every worker of a sharded run (index, count) gets keys of its own, or shares one when there are
+            # fewer keys than workers. The emergency keys stay shared.
+            index, count = shard
+            developer_keys = developer_keys[index::count] or [developer_keys[index % len(developer_keys)]]
+            preferred_key = developer_keys[0]
+        writer = f"period={period}" if shard is None else f"period={period}_shard={shard[0]:03d}"
+        return cls(developer_keys, emergency_keys, preferred_key=preferred_key,
+                   used_units=load_quota_usage(), writer=writer, **kwargs)
+
+    def remaining(self, developer_key):
+        return self.daily_quota - self.used[developer_key]
+
+    def _refill(self, developer_key, now):
+        elapsed = now - self.last_refill[developer_key]
+        self.tokens[developer_key] = min(self.capacity, self.tokens[developer_key] + elapsed * self.refill_rate)
+        self.last_refill[developer_key] = now
+
+    def _candidates(self, cost):
+        usable = [k for k in self.keys
+                  if k not in self.exhausted and self.remaining(k) - cost >= self.reserve]
+        regular = [k for k in usable if k not in self.emergency_keys]
+        return regular or usable
+
+    def acquire(self, response_type, preferred=None, count=1):
+        # count > 1 charges several calls sent together (batch requests) to the same key.
+        cost = QUOTA_COSTS.get(response_type, 1) * count
+        # A batch bigger than a bucket waits for a full bucket and leaves it in debt.
+        needed = min(cost, self.capacity)
+        while True:
+            with self.lock:
+                if get_quota_day() != self.quota_day:
+                    # What was spent before midnight is not saved: it counts against the day that is over.
+                    self.quota_day = get_quota_day()
+                    self.used = {k: 0 for k in self.keys}
+                    self.spent_since_save = {k: 0 for k in self.keys}
+                    self.exhausted = set()
+                candidates = self._candidates(cost)
+                if not candidates:
+                    raise QuotaExhausted("All developer keys are out of quota.")
+                now = self.clock()
+                for k in candidates:
+                    self._refill(k, now)
+                # Stick to the caller's key while its bucket has tokens, so clients are not rebuilt needlessly.
+                order = sorted(candidates, key=lambda k: (k != preferred, k != self.preferred_key, -self.tokens[k]))
+                for k in order:
+                    if self.tokens[k] >= needed:
+                        self.tokens[k] -= cost
+                        self.used[k] += cost
+                        self.spent_since_save[k] += cost
+                        return k
+                wait = min((needed - self.tokens[k]) / self.refill_rate for k in candidates)
+            self.sleep(wait)
+
+    def mark_exhausted(self, developer_key):
+        with self.lock:
+            logging.info(f"Developer key {get_key_id(developer_key)} is out of quota, rotating.")
+            self.exhausted.add(developer_key)
+
+    def usage(self):
+        with self.lock:
+            return {get_key_id(k): self.used[k] for k in self.keys}
+
+    def save(self):
+        with self.lock:
+            spent = {get_key_id(k): units for k, units in self.spent_since_save.items() if units}
+            self.spent_since_save = {k: 0 for k in self.keys}
+            quota_day = self.quota_day
+        # Only this run writes its object, so instances running at the same time cannot lose each other's
+        # units. The instance that resumes a failed run adds to what the failed one saved.
+        usage = load_writer_usage(quota_day, self.writer)
+        for key_id, units in spent.items():
+            usage[key_id] = usage.get(key_id, 0) + units
+        save_quota_usage(usage, quota_day, self.writer)
+        return usage
+
+
+def get_usage_key(quota_day, writer):
+    return f"{QUOTA_USAGE_PREFIX}/quota_day={quota_day}/{writer}.json"
+
+
+def load_local_usage(quota_day, writer=None):
+    try:
+        with open(QUOTA_USAGE_FILE) as f:
+            content = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if content.get('quota_day') != quota_day or writer not in (None, content.get('writer')):
+        return {}
+    return content.get('units', {})
+
+
+def load_quota_usage():
+    # Units spent today per key, by all the runs.
+    quota_day = get_quota_day()
+    usage = {}
+    try:
+        for summary in boto3.resource('s3').Bucket(ADMIN_BUCKET).objects.filter(
+                Prefix=f"{QUOTA_USAGE_PREFIX}/quota_day={quota_day}/"):
+            content = json.loads(summary.get()['Body'].read().decode('utf-8'))
+            for key_id, units in content.get('units', {}).items():
+                usage[key_id] = usage.get(key_id, 0) + units
+    except Exception as e:
+        logging.info(f"No quota usage found in S3 ({e}), trying the local copy.")
+        return load_local_usage(quota_day)
+    return usage
+
+
+def load_writer_usage(quota_day, writer):
+    s3 = boto3.resource('s3')
+    try:
+        content = s3.Object(ADMIN_BUCKET, get_usage_key(quota_day, writer)).get()['Body'].read()
+    except s3.meta.client.exceptions.NoSuchKey:
+        return {}
+    except Exception as e:
+        logging.info(f"Could not read the quota usage of {writer} ({e}), trying the local copy.")
+        return load_local_usage(quota_day, writer)
+    return json.loads(content.decode('utf-8')).get('units', {})
+
+
+def save_quota_usage(usage, quota_day, writer):
+    content = json.dumps({'quota_day': quota_day, 'writer': writer, 'units': usage})
+    with open(QUOTA_USAGE_FILE, 'w') as f:
+        f.write(content)
+    boto3.resource('s3').Object(ADMIN_BUCKET, get_usage_key(quota_day, writer)).put(Body=content.encode('utf-8'))
@@ -0,0 +1,177 @@
+# Write-time manifest of the collector outputs, checked by upload_most_popular.py before it uploads them.
+#
+# Every output of the collector is wrapped in a ManifestWriter, and add_dict_to_file counts every record
+# it writes: records per file, per region and per (region, category). The writer also keeps the size and a
+# running CRC32 of the bytes that reach the disk, which for backup.json.bz2 is the compressed stream.
+# The collector saves manifest.json at the end of the crawl. The uploader then checks every ORC file
+# against it by the row count of its footer, and the backup by the CRC32 of its compressed stream, in one
+# streaming pass and without decompressing it. The manifest is uploaded next to the run metrics, so a
+# partition can be audited without downloading it.
+# After a resume, the counts of the outputs are rebuilt from what is left of them on disk.
+# A run that uploads segments has a manifest per segment instead (see segment_uploader.py), checked when
+# the segment is uploaded. The manifest of the run lists them, and adds them up per table.
+
+import os
+import json
+import zlib
+import boto3
+from sinks import open_source, get_file_crc32
+
+MANIFEST_FILE = './manifest.json'
+MANIFEST_BUCKET = 'youtube-trends-uiuc-v2'
+MANIFEST_PREFIX = 'manifests'
+
+
+def get_record_keys(record):
+    # Region and category of a record: its metadata in the tables, its request params in the backup.
+    metadata = record.get('metadata') or {}
+    request_params = metadata.get('request_params') or {}
+    return metadata.get('region_code', request_params.get('regionCode')), \
+        metadata.get('category_id', request_params.get('videoCategoryId'))
+
+
+class FileManifest:
+    def __init__(self, path):
+        self.file = os.path.basename(path)
+        self.records = 0
+        self.regions = {}
+        self.categories = {}
+
+    def count_record(self, record):
+        self.records += 1
+        region_code, category_id = get_record_keys(record)
+        if region_code is not None:
+            self.regions[region_code] = self.regions.get(region_code, 0) + 1
+            if category_id is not None:
+                key = f"{region_code}/{category_id}"
+                self.categories[key] = self.categories.get(key, 0) + 1
+
+    def add(self, other):
+        # Counts of another manifest of the same table, e.g. of a shard.
+        self.records += other['records']
+        for name, counts in (('regions', self.regions), ('categories', self.categories)):
+            for key, count in other[name].items():
+                counts[key] = counts.get(key, 0) + count
+
+    def to_dict(self, crc32, size):
+        return {'file': self.file, 'records': self.records, 'bytes': size, 'crc32': crc32,
+                'regions': dict(sorted(self.regions.items())), 'categories': dict(sorted(self.categories.items()))}
+
+
+class ManifestWriter(FileManifest):
+    # Wraps an output of open_sink. The bytes of an uncompressed output are checksummed here, those of a
+    # compressed one by its CompressedSink, which sees the compressed stream.
+    def __init__(self, path, sink, resumed=False):
+        super().__init__(path)
+        self.sink = sink
+        self.crc32 = 0
+        self.size = 0
+        if resumed:
+            # The output was truncated at the last checkpoint: count what is left of it.
+            with open_source(path) as f:
+                for line in f:
+                    self.count_record(json.loads(line))
+            if not hasattr(sink, 'crc32'):
+                self.crc32, self.size = get_file_crc32(path)
+
+    def write(self, data):
+        # data is bytes when a file is appended as is, e.g. the backup of a shard (see collect_shards.py).
+        if not hasattr(self.sink, 'crc32'):
+            encoded = data.encode('utf-8') if isinstance(data, str) else data
+            self.crc32 = zlib.crc32(encoded, self.crc32)
+            self.size += len(encoded)
+        return self.sink.write(data)
+
+    def checkpoint(self):
+        if hasattr(self.sink, 'checkpoint'):
+            return self.sink.checkpoint()
+        self.sink.flush()
+        return self.sink.tell()
+
+    def close(self):
+        self.sink.close()
+
+    def to_dict(self):
+        if hasattr(self.sink, 'crc32'):
+            return super().to_dict(self.sink.crc32, self.sink.size)
+        return super().to_dict(self.crc32, self.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Manifest:
+    def __init__(self, creation_date, period):
+        self.creation_date = creation_date
+        self.period = period
+        self.tables = {}
+
+    def open(self, table, path, sink, resumed=False):
+        # path is the file of the sink on disk, e.g. ./backup.json.bz2.
+        self.tables[table] = ManifestWriter(path, sink, resumed=resumed)
+        return self.tables[table]
+
+    def to_dict(self):
+        return {'creation_date': self.creation_date, 'period': self.period,
+                'tables': {table: writer.to_dict() for table, writer in self.tables.items()}}
+
+    def save(self, path=MANIFEST_FILE):
+        save_manifest(self.to_dict(), path)
+
+
+class SegmentsManifest(FileManifest):
+    # The segments of a table.
+    def __init__(self, table):
+        super().__init__(table)
+        self.segments = []
+
+    def add(self, other):
+        super().add(other)
+        self.segments.append(other)
+
+    def to_dict(self):
+        return {'records': self.records, 'bytes': sum(segment['bytes'] for segment in self.segments),
+                'regions': dict(sorted(self.regions.items())), 'categories': dict(sorted(self.categories.items())),
+                'segments': self.segments}
+
+
+def get_segments_manifest(creation_date, period, segments):
+    # segments are the manifests of the segments of a run, in any order.
+    tables = {}
+    for segment in sorted(segments, key=lambda segment: segment['file']):
+        tables.setdefault(segment['table'], SegmentsManifest(segment['table'])).add(segment)
+    return {'creation_date': creation_date, 'period': period,
+            'tables': {table: manifest.to_dict() for table, manifest in tables.items()}}
+
+
+def save_manifest(manifest, path=MANIFEST_FILE):
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def load_manifest(path=MANIFEST_FILE):
+    with open(path) as f:
+        return json.load(f)
+
+
+def get_manifest_key(creation_date, period):
+    return f"{MANIFEST_PREFIX}/creation_date={creation_date}/period={period}/manifest.json"
+
+
+def upload_manifest(manifest, creation_date, period, s3=None):
+    key = get_manifest_key(creation_date, period)
+    (s3 or boto3.resource('s3')).Object(MANIFEST_BUCKET, key).put(Body=json.dumps(manifest, indent=1).encode('utf-8'))
+    return key
+
+
+def download_manifest(creation_date, period, s3=None):
+    # None until the outputs of the period are uploaded.
+    s3 = s3 or boto3.resource('s3')
+    try:
+        content = s3.Object(MANIFEST_BUCKET, get_manifest_key(creation_date, period)).get()['Body'].read()
+    except s3.meta.client.exceptions.NoSuchKey:
+        return None
+    return json.loads(content.decode('utf-8'))
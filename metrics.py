@@ -0,0 +1,138 @@
+# Run metrics of the collect/convert/upload pipeline.
+#
+# Every script records into the module-level `metrics` object and publishes a summary at the end of
+# the run, as JSON and as a Prometheus textfile, next to the data in S3:
+# s3://youtube-trends-uiuc-v2/run_metrics/creation_date=.../period=.../<script>.{json,prom}
+
+import json
+import time
+import threading
+import contextlib
+import boto3
+
+METRICS_BUCKET = 'youtube-trends-uiuc-v2'
+METRIC_PREFIX = 'youtube_trends'
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in sorted(labels.items())) + '}'
+
+
+class Metrics:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.started_at = clock()
+        self.latencies = {}
+        self.counters = {}
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def observe_latency(self, response_type, seconds):
+        with self.lock:
+            histogram = self.latencies.setdefault(response_type, {
+                'buckets': [0] * len(LATENCY_BUCKETS),
+                'sum': 0.0,
+                'count': 0
+            })
+            for i, upper_bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= upper_bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def sleep(self, seconds, reason):
+        # Every backoff goes through here, so the time lost waiting shows up in the summary.
+        self.increment('backoff_seconds_total', seconds, reason=reason)
+        time.sleep(seconds)
+
+    def record_stage(self, name, seconds, size=None):
+        with self.lock:
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'bytes': 0, 'runs': 0})
+            stage['seconds'] += seconds
+            stage['runs'] += 1
+            if size is not None:
+                stage['bytes'] += size
+            stage['bytes_per_second'] = stage['bytes'] / stage['seconds'] if stage['seconds'] else 0.0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # Usage: with metrics.stage('convert_regions') as stage: ...; stage['bytes'] = size
+        stage = {'bytes': None}
+        started = self.clock()
+        try:
+            yield stage
+        finally:
+            self.record_stage(name, self.clock() - started, stage['bytes'])
+
+    def summary(self, script=None, creation_date=None, period=None):
+        with self.lock:
+            return {
+                'script': script,
+                'creation_date': creation_date,
+                'period': period,
+                'run_seconds': self.clock() - self.started_at,
+                'latency_buckets': list(LATENCY_BUCKETS),
+                'latencies': json.loads(json.dumps(self.latencies)),
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                'stages': json.loads(json.dumps(self.stages))
+            }
+
+    def to_prometheus(self, script=None, creation_date=None, period=None):
+        summary = self.summary(script, creation_date, period)
+        run_labels = {'script': script, 'creation_date': creation_date, 'period': period}
+        lines = [
+            f'# TYPE {METRIC_PREFIX}_run_seconds gauge',
+            f'{METRIC_PREFIX}_run_seconds{format_labels(run_labels)} {summary["run_seconds"]:.3f}',
+            f'# TYPE {METRIC_PREFIX}_request_duration_seconds histogram'
+        ]
+        for response_type, histogram in sorted(summary['latencies'].items()):
+            for upper_bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+                labels = format_labels({'response_type': response_type, 'le': upper_bound})
+                lines.append(f'{METRIC_PREFIX}_request_duration_seconds_bucket{labels} {count}')
+            labels = format_labels({'response_type': response_type, 'le': '+Inf'})
+            lines.append(f'{METRIC_PREFIX}_request_duration_seconds_bucket{labels} {histogram["count"]}')
+            labels = format_labels({'response_type': response_type})
+            lines.append(f'{METRIC_PREFIX}_request_duration_seconds_sum{labels} {histogram["sum"]:.6f}')
+            lines.append(f'{METRIC_PREFIX}_request_duration_seconds_count{labels} {histogram["count"]}')
+        for name in sorted({counter['name'] for counter in summary['counters']}):
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} counter')
+            for counter in summary['counters']:
+                if counter['name'] == name:
+                    lines.append(f'{METRIC_PREFIX}_{name}{format_labels(counter["labels"])} {counter["value"]}')
+        for name, field in (('stage_duration_seconds', 'seconds'), ('stage_bytes', 'bytes'),
+                            ('stage_throughput_bytes_per_second', 'bytes_per_second')):
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} gauge')
+            for stage, values in sorted(summary['stages'].items()):
+                lines.append(f'{METRIC_PREFIX}_{name}{format_labels({"stage": stage})} {values[field]}')
+        return '\n'.join(lines) + '\n'
+
+    def publish(self, script, creation_date, period, s3=None):
+        prefix = f"run_metrics/creation_date={creation_date}/period={period}"
+        files = {
+            f'./{script}_metrics.json': json.dumps(self.summary(script, creation_date, period), indent=2),
+            f'./{script}_metrics.prom': self.to_prometheus(script, creation_date, period),
+        }
+        s3 = s3 or boto3.resource('s3')
+        for path, content in files.items():
+            with open(path, 'w') as f:
+                f.write(content)
+            s3.Bucket(METRICS_BUCKET).upload_file(path, f"{prefix}/{path[2:]}")
+
+    def try_publish(self, script, creation_date, period, log=print):
+        # Metrics are best effort, they must not hide the outcome of the run: an error is only logged.
+        try:
+            self.publish(script, creation_date, period)
+        except Exception as e:
+            log(f"Could not publish the run metrics: {e}")
+
+
+metrics = Metrics()
@@ -0,0 +1,191 @@
+# In-process replacement for "java -jar orc-tools-uber.jar convert".
+# It reads the same JSON lines files and the same struct<...> schemas used by upload_most_popular.py.
+
+import re
+import json
+import calendar
+import datetime
+import argparse
+import pyarrow as pa
+import pyarrow.orc
+import pyarrow.parquet
+
+BATCH_SIZE = 10000
+# The tables in athena.sql are declared with 'orc.compress'='ZLIB', which is also the orc-tools default.
+ORC_COMPRESSION = 'zlib'
+PARQUET_COMPRESSION = 'snappy'
+
+PRIMITIVE_TYPES = {
+    'string': pa.string(),
+    'int': pa.int32(),
+    'bigint': pa.int64(),
+    'boolean': pa.bool_(),
+    'double': pa.float64(),
+    'timestamp': pa.timestamp('ns'),
+}
+
+TOKEN = re.compile(r'\s*([<>,:]|[A-Za-z_][A-Za-z0-9_]*)')
+
+# Same semantics as the "yyyy-MM-dd HH:mm:ss.nX" orc-tools format: up to nine fraction digits and a zone.
+TIMESTAMP = re.compile(r'^(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})(?:\.(\d{1,9}))?(Z|[+-]\d{2}(?::?\d{2})?)?$')
+
+
+def tokenize(struct):
+    position = 0
+    tokens = []
+    while position < len(struct):
+        match = TOKEN.match(struct, position)
+        if match is None:
+            raise ValueError(f"Invalid type at position {position}: {struct}")
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+def parse_type(tokens, position=0):
+    name = tokens[position].lower()
+    if name == 'struct':
+        fields = []
+        position += 2  # struct <
+        while tokens[position] != '>':
+            field_name = tokens[position]
+            field_type, position = parse_type(tokens, position + 2)  # name :
+            fields.append(pa.field(field_name, field_type))
+            if tokens[position] == ',':
+                position += 1
+        return pa.struct(fields), position + 1
+    elif name == 'array':
+        value_type, position = parse_type(tokens, position + 2)  # array <
+        return pa.list_(value_type), position + 1
+    elif name in PRIMITIVE_TYPES:
+        return PRIMITIVE_TYPES[name], position + 1
+    else:
+        raise ValueError(f"Unsupported type: {name}")
+
+
+def get_schema(struct):
+    struct_type, _ = parse_type(tokenize(struct))
+    return pa.schema(list(struct_type))
+
+
+def get_orc_column_id(schema, path):
+    # ORC numbers the columns of the type tree in pre-order, the root struct being 0, and writer options
+    # such as bloom_filter_columns take these ids: get_orc_column_id(schema, ('snippet', 'channelId')).
+    def walk(data_type, path, column_id):
+        if not path:
+            return column_id, None
+        for field in data_type:
+            column_id += 1
+            if field.name == path[0]:
+                return walk(field.type, path[1:], column_id)
+            column_id = count_columns(field.type, column_id)
+        raise ValueError(f"Unknown column: {path[0]}")
+
+    def count_columns(data_type, column_id):
+        # Id of the last column under data_type, whose own id is column_id.
+        if pa.types.is_struct(data_type):
+            for field in data_type:
+                column_id = count_columns(field.type, column_id + 1)
+        elif pa.types.is_list(data_type):
+            column_id = count_columns(data_type.value_type, column_id + 1)
+        return column_id
+
+    return walk(pa.struct(list(schema)), tuple(path), 0)[0]
+
+
+def parse_timestamp(value):
+    match = TIMESTAMP.match(value)
+    if match is None:
+        raise ValueError(f"Invalid timestamp: {value}")
+    date, time_of_day, fraction, zone = match.groups()
+    seconds = calendar.timegm(datetime.datetime.strptime(f"{date} {time_of_day}", "%Y-%m-%d %H:%M:%S").timetuple())
+    if zone and zone != 'Z':
+        sign = 1 if zone[0] == '+' else -1
+        digits = zone[1:].replace(':', '')
+        seconds -= sign * (int(digits[:2]) * 3600 + int(digits[2:4] or 0) * 60)
+    nanoseconds = int((fraction or '0').ljust(9, '0'))
+    # Stored as UTC wall-clock time, which is what orc-tools writes on the (UTC) instances.
+    return seconds * 1000000000 + nanoseconds
+
+
+def coerce(value, data_type):
+    if value is None:
+        return None
+    if pa.types.is_struct(data_type):
+        if not isinstance(value, dict):
+            return None
+        return {field.name: coerce(value.get(field.name), field.type) for field in data_type}
+    elif pa.types.is_list(data_type):
+        if not isinstance(value, list):
+            return None
+        return [coerce(item, data_type.value_type) for item in value]
+    elif pa.types.is_timestamp(data_type):
+        return parse_timestamp(value)
+    elif pa.types.is_integer(data_type):
+        # The API returns statistics as strings, e.g. "viewCount": "12345".
+        return int(value)
+    elif pa.types.is_boolean(data_type):
+        return value if isinstance(value, bool) else str(value).lower() == 'true'
+    elif pa.types.is_floating(data_type):
+        return float(value)
+    else:
+        return value if isinstance(value, str) else json.dumps(value)
+
+
+def read_batches(json_file, schema, batch_size=BATCH_SIZE):
+    struct_type = pa.struct(list(schema))
+    rows = []
+    with open(json_file, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            rows.append(coerce(json.loads(line), struct_type))
+            if len(rows) >= batch_size:
+                yield pa.RecordBatch.from_pylist(rows, schema=schema)
+                rows = []
+    if rows:
+        yield pa.RecordBatch.from_pylist(rows, schema=schema)
+
+
+def write_columnar(json_file, struct, orc_file=None, parquet_file=None, batch_size=BATCH_SIZE, **orc_options):
+    schema = get_schema(struct)
+    orc_writer = None
+    parquet_writer = None
+    rows = 0
+    try:
+        if orc_file is not None:
+            orc_options.setdefault('compression', ORC_COMPRESSION)
+            orc_writer = pyarrow.orc.ORCWriter(orc_file, **orc_options)
+        if parquet_file is not None:
+            parquet_writer = pyarrow.parquet.ParquetWriter(parquet_file, schema, compression=PARQUET_COMPRESSION)
+        for batch in read_batches(json_file, schema, batch_size=batch_size):
+            table = pa.Table.from_batches([batch], schema=schema)
+            if orc_writer is not None:
+                orc_writer.write(table)
+            if parquet_writer is not None:
+                parquet_writer.write_table(table)
+            rows += batch.num_rows
+        if rows == 0 and orc_writer is not None:
+            # Like orc-tools, an empty input still produces a valid file with the schema.
+            orc_writer.write(schema.empty_table())
+    finally:
+        if orc_writer is not None:
+            orc_writer.close()
+        if parquet_writer is not None:
+            parquet_writer.close()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a JSON lines file to ORC and/or Parquet.")
+    parser.add_argument("json_file")
+    parser.add_argument("struct", help="struct<...> schema, as in upload_most_popular.py")
+    parser.add_argument("-o", "--orc", help="ORC output file")
+    parser.add_argument("-p", "--parquet", help="Parquet output file")
+    args = parser.parse_args()
+    rows = write_columnar(args.json_file, args.struct, orc_file=args.orc, parquet_file=args.parquet)
+    print(f"{rows} rows written.")
+
+
+if __name__ == '__main__':
+    main()
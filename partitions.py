@@ -0,0 +1,13 @@
+# Days and periods of the partitions of the tables: every day is collected four times, one period every six hours.
+
+import datetime
+
+PERIODS = ('00', '06', '12', '18')
+
+
+def get_days(start_date, end_date):
+    # YYYY-MM-DD, from start_date to end_date included.
+    day = datetime.date.fromisoformat(start_date)
+    while day <= datetime.date.fromisoformat(end_date):
+        yield day.isoformat()
+        day += datetime.timedelta(days=1)
@@ -0,0 +1,220 @@
+# Rebuilds the regions/, categories/ and most_popular/ partitions of past periods from their archived backups.
+#
+# Every backup record is a raw API response with its request params and retrieved_at, so the tables are
+# rebuilt with the collector's own transformations: the unspecified category added to every region, the
+# publishedAt rewrite, and the metadata and rank of every video. Ranks continue across the pages of a
+# chart, which are chained by pageToken. Partitions collected with --normalized get their videos/ and
+# rankings/ back instead of most_popular/.
+# The manifest of a rebuilt partition is replaced by one that lists its new files, with their row counts as
+# checks, so compact_partitions.py takes the partition as uploaded and compacts its day again.
+# Partitions are rebuilt in parallel, one per process. A worker streams its backup to JSON lines and
+# converts them to ORC in batches, so its memory does not grow with the size of the partition.
+#
+# python rebuild_partitions.py 2025-01-01 2025-12-31 --workers 8
+
+import os
+import json
+import time
+import shutil
+import argparse
+import contextlib
+import concurrent.futures
+import boto3
+import pyarrow.orc
+import orc_writer
+from collect_most_popular import add_dict_to_file, add_category_metadata, add_video_metadata, \
+    get_unspecified_category, split_video
+from segment_uploader import DATA_BUCKET, BACKUP_BUCKET, TRANSFER_CONFIG
+from schemas import get_struct
+from sinks import open_sink, open_source, EXTENSIONS
+from partitions import PERIODS, get_days
+from manifest import Manifest, download_manifest, upload_manifest
+
+LAYOUTS = ('auto', 'most_popular', 'normalized')
+REBUILD_DIRECTORY = './rebuild'
+REBUILD_WORKERS = os.cpu_count() or 1
+# Workers are replaced after this many partitions, to give back the memory pyarrow's allocator keeps.
+PARTITIONS_PER_WORKER = 10
+
+
+def get_partitions(start_date, end_date, periods=PERIODS):
+    for day in get_days(start_date, end_date):
+        for period in periods:
+            yield day, period
+
+
+def get_backup_keys(s3, partition):
+    # backup.json.bz2, or backup-00001.json.bz2, backup-00002.json.bz2... when segments were uploaded.
+    extensions = tuple('.json' + extension for extension in EXTENSIONS.values())
+    return sorted(obj.key for obj in s3.Bucket(BACKUP_BUCKET).objects.filter(Prefix=f"{partition}/")
+                  if os.path.basename(obj.key).startswith('backup') and obj.key.endswith(extensions))
+
+
+def is_normalized(s3, partition):
+    return any(True for _ in s3.Bucket(DATA_BUCKET).objects.filter(Prefix=f"rankings/{partition}/").limit(1))
+
+
+def read_backup(s3, keys, directory):
+    for key in keys:
+        path = os.path.join(directory, os.path.basename(key))
+        s3.Bucket(BACKUP_BUCKET).download_file(key, path, Config=TRANSFER_CONFIG)
+        try:
+            with open_source(path) as backup:
+                for line in backup:
+                    yield json.loads(line)
+        finally:
+            os.remove(path)
+
+
+def rebuild_records(records, outputs, normalized=False):
+    # Writes the records of a backup the way crawl_most_popular writes the responses it gets.
+    next_ranks = {}
+    video_ids = set()
+    for record in records:
+        metadata = record.pop('metadata')
+        retrieved_at = metadata['retrieved_at']
+        request_params = metadata.get('request_params', {})
+        kind = record.get('kind')
+        if kind == 'youtube#i18nRegionListResponse':
+            for region in record.get('items', []):
+                add_dict_to_file(outputs['regions'], region, retrieved_at)
+        elif kind == 'youtube#videoCategoryListResponse':
+            region_code = request_params['regionCode']
+            add_dict_to_file(outputs['categories'], get_unspecified_category(region_code), retrieved_at)
+            for category in record.get('items', []):
+                add_dict_to_file(outputs['categories'], add_category_metadata(category, region_code), retrieved_at)
+        elif kind == 'youtube#videoListResponse':
+            region_code = request_params['regionCode']
+            category_id = request_params['videoCategoryId']
+            page_token = request_params.get('pageToken')
+            if page_token is None:
+                rank = 1
+            elif (region_code, category_id, page_token) in next_ranks:
+                rank = next_ranks.pop((region_code, category_id, page_token))
+            else:
+                raise Exception(f"Page {page_token} of {region_code}/{category_id} has no previous page in the backup.")
+            for video in record.get('items', []):
+                video = add_video_metadata(video, region_code, category_id, rank)
+                if normalized:
+                    video, ranking = split_video(video)
+                    if video['id'] not in video_ids:
+                        video_ids.add(video['id'])
+                        add_dict_to_file(outputs['videos'], video, retrieved_at)
+                    add_dict_to_file(outputs['rankings'], ranking, retrieved_at)
+                else:
+                    add_dict_to_file(outputs['most_popular'], video, retrieved_at)
+                rank = rank + 1
+            if record.get('nextPageToken'):
+                next_ranks[(region_code, category_id, record['nextPageToken'])] = rank
+        else:
+            raise Exception(f"Unknown record in the backup: {kind}")
+
+
+def replace_table(s3, table, partition, orc_file):
+    key = f"{table}/{partition}/{table}.orc"
+    bucket = s3.Bucket(DATA_BUCKET)
+    bucket.upload_file(orc_file, key, Config=TRANSFER_CONFIG)
+    # Partitions uploaded in segments hold one file per segment, which Athena would now read twice.
+    for obj in bucket.objects.filter(Prefix=f"{table}/{partition}/"):
+        if obj.key != key:
+            obj.delete()
+    return key
+
+
+def get_rebuilt_manifest(s3, manifest, checks):
+    # The backup is not rebuilt: what the manifest in S3 says of it still holds.
+    rebuilt = dict(manifest.to_dict(), checks=checks)
+    previous = download_manifest(manifest.creation_date, manifest.period, s3=s3) or {}
+    for table in ('backup', 'compressed_backup'):
+        if table in previous.get('tables', {}):
+            rebuilt['tables'][table] = previous['tables'][table]
+        if table in previous.get('checks', {}):
+            rebuilt['checks'][table] = previous['checks'][table]
+    return rebuilt
+
+
+def rebuild_partition(creation_date, period, layout='auto', dry_run=False, directory=REBUILD_DIRECTORY, keep=False):
+    s3 = boto3.resource('s3')
+    partition = f"creation_date={creation_date}/period={period}"
+    started = time.perf_counter()
+    keys = get_backup_keys(s3, partition)
+    if not keys:
+        return {'partition': partition, 'skipped': 'no backup'}
+    normalized = is_normalized(s3, partition) if layout == 'auto' else layout == 'normalized'
+    tables = ['regions', 'categories'] + (['videos', 'rankings'] if normalized else ['most_popular'])
+    work_directory = os.path.join(directory, partition)
+    os.makedirs(work_directory, exist_ok=True)
+    manifest = Manifest(creation_date, period)
+    try:
+        with contextlib.ExitStack() as stack:
+            outputs = {}
+            for table in tables:
+                path = os.path.join(work_directory, f'{table}.json')
+                outputs[table] = stack.enter_context(manifest.open(table, path, open_sink(path)))
+            rebuild_records(read_backup(s3, keys, work_directory), outputs, normalized=normalized)
+        rows = {}
+        checks = {}
+        for table in tables:
+            orc_file = os.path.join(work_directory, f'{table}.orc')
+            orc_writer.write_columnar(os.path.join(work_directory, f'{table}.json'), get_struct(table),
+                                      orc_file=orc_file)
+            rows[table] = pyarrow.orc.ORCFile(orc_file).nrows
+            records = manifest.tables[table].records
+            checks[table] = {'rows': rows[table], 'bytes': os.path.getsize(orc_file), 'valid': rows[table] == records}
+            if rows[table] != records:
+                raise Exception(f"{table}.orc has {rows[table]} rows, {records} records were rebuilt.")
+        if not dry_run:
+            for table in tables:
+                replace_table(s3, table, partition, os.path.join(work_directory, f'{table}.orc'))
+            upload_manifest(get_rebuilt_manifest(s3, manifest, checks), creation_date, period, s3=s3)
+    finally:
+        # A dry run keeps its files, to be compared with what is in S3.
+        if not keep and not dry_run:
+            shutil.rmtree(work_directory, ignore_errors=True)
+    return {'partition': partition, 'backups': len(keys), 'rows': rows, 'seconds': time.perf_counter() - started}
+
+
+def rebuild_partitions(partitions, workers=REBUILD_WORKERS, layout='auto', dry_run=False,
+                       directory=REBUILD_DIRECTORY, keep=False):
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                max_tasks_per_child=PARTITIONS_PER_WORKER) as executor:
+        futures = {executor.submit(rebuild_partition, creation_date, period, layout, dry_run, directory, keep):
+                   (creation_date, period) for creation_date, period in partitions}
+        for future in concurrent.futures.as_completed(futures):
+            creation_date, period = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"creation_date={creation_date}/period={period} failed: {e}", flush=True)
+                failed.append(f"creation_date={creation_date}/period={period}")
+                continue
+            if 'skipped' in result:
+                print(f"{result['partition']} skipped: {result['skipped']}", flush=True)
+            else:
+                print(f"{result['partition']} rebuilt from {result['backups']} backup files in "
+                      f"{result['seconds']:.1f}s: {result['rows']}", flush=True)
+    if failed:
+        raise Exception(f"{len(failed)} partitions could not be rebuilt: {', '.join(sorted(failed))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild ORC partitions from the archived backups.")
+    parser.add_argument("start_date", help="YYYY-MM-DD")
+    parser.add_argument("end_date", nargs="?", help="YYYY-MM-DD, included (default: start_date)")
+    parser.add_argument("--periods", nargs="+", choices=PERIODS, default=list(PERIODS))
+    parser.add_argument("--workers", type=int, default=REBUILD_WORKERS, help="Partitions rebuilt at the same time")
+    parser.add_argument("--layout", choices=LAYOUTS, default='auto',
+                        help="most_popular/ or videos/ + rankings/ (auto: whatever the partition has now)")
+    parser.add_argument("--dry-run", action="store_true", help="Write the ORC files locally without uploading them")
+    parser.add_argument("--directory", default=REBUILD_DIRECTORY, help="Where partitions are rebuilt")
+    parser.add_argument("--keep", action="store_true", help="Keep the local files of every partition")
+    args = parser.parse_args()
+
+    partitions = list(get_partitions(args.start_date, args.end_date or args.start_date, args.periods))
+    rebuild_partitions(partitions, workers=args.workers, layout=args.layout, dry_run=args.dry_run,
+                       directory=args.directory, keep=args.keep)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# Persistent cache of YouTube API responses, keyed by response type and request params.
+#
+# A cached response younger than the TTL of its type is used without calling the API. An older one is
+# revalidated with a conditional request (If-None-Match: <etag>), and a 304 Not Modified reuses its body.
+# The cache lives in the admin bucket, because every run starts on a fresh instance.
+
+import copy
+import json
+import time
+import logging
+import threading
+import boto3
+
+CACHE_BUCKET = 'youtube-trends-uiuc-admin'
+CACHE_OBJECT = 'response_cache.json'
+CACHE_FILE = './response_cache.json'
+# Regions and categories almost never change. Charts change all the time, so they are not cached by default.
+CACHE_TTL = 24 * 60 * 60
+CACHED_RESPONSE_TYPES = ('regions', 'categories')
+
+
+def get_cache_key(response_type, request_params):
+    return json.dumps([response_type, request_params], sort_keys=True)
+
+
+class ResponseCache:
+    def __init__(self, entries=None, ttl=CACHE_TTL, response_types=CACHED_RESPONSE_TYPES, clock=time.time):
+        self.entries = entries or {}
+        self.ttl = ttl
+        self.response_types = response_types
+        self.clock = clock
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, **kwargs):
+        try:
+            content_object = boto3.resource('s3').Object(CACHE_BUCKET, CACHE_OBJECT)
+            entries = json.loads(content_object.get()['Body'].read().decode('utf-8'))
+        except Exception as e:
+            logging.info(f"No response cache found in S3 ({e}), trying the local copy.")
+            try:
+                with open(CACHE_FILE) as f:
+                    entries = json.load(f)
+            except (OSError, ValueError):
+                entries = {}
+        return cls(entries, **kwargs)
+
+    def save(self):
+        with self.lock:
+            content = json.dumps(self.entries)
+        with open(CACHE_FILE, 'w') as f:
+            f.write(content)
+        boto3.resource('s3').Object(CACHE_BUCKET, CACHE_OBJECT).put(Body=content.encode('utf-8'))
+
+    def get_fresh(self, response_type, request_params):
+        # Returns a copy, since the collector adds metadata to the responses it writes.
+        if response_type not in self.response_types:
+            return None
+        with self.lock:
+            entry = self.entries.get(get_cache_key(response_type, request_params))
+            if entry is not None and self.clock() - entry['stored_at'] < self.ttl:
+                self.stats['hits'] += 1
+                return copy.deepcopy(entry['body'])
+        return None
+
+    def get_etag(self, response_type, request_params):
+        if response_type not in self.response_types:
+            return None
+        with self.lock:
+            entry = self.entries.get(get_cache_key(response_type, request_params))
+        return entry['body'].get('etag') if entry is not None else None
+
+    def revalidated(self, response_type, request_params):
+        # The API answered 304 Not Modified to a conditional request.
+        with self.lock:
+            entry = self.entries[get_cache_key(response_type, request_params)]
+            entry['stored_at'] = self.clock()
+            self.stats['revalidated'] += 1
+            return copy.deepcopy(entry['body'])
+
+    def store(self, response_type, request_params, body):
+        if response_type not in self.response_types:
+            return
+        with self.lock:
+            self.entries[get_cache_key(response_type, request_params)] = {
+                'stored_at': self.clock(),
+                'body': copy.deepcopy(body)
+            }
+            self.stats['misses'] += 1
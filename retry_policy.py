@@ -0,0 +1,200 @@
+# Retry policy of the YouTube API calls: which errors are retried, how long to wait, and when to give up.
+#
+# Errors are classified from the HttpError status and reason, not from their message. The wait before a
+# retry grows exponentially with full jitter (a random time between 0 and base * 2^attempt, capped), and is
+# never shorter than a Retry-After sent by the API. Every endpoint has a circuit breaker: after
+# CIRCUIT_FAILURES consecutive failures, its calls wait until one probe call gets through, instead of
+# piling retries on an endpoint that is down. The run has a time budget: a wait that would end after the
+# deadline raises RetryBudgetExceeded.
+# The clock, the sleep and the random source can be replaced, so the policy can be tested without sleeping.
+
+import json
+import time
+import errno
+import random
+import logging
+import datetime
+import threading
+import collections
+import email.utils
+from googleapiclient.errors import HttpError
+from metrics import metrics
+
+Backoff = collections.namedtuple('Backoff', ['base', 'cap', 'attempts'])
+BACKOFFS = {
+    'rate_limited': Backoff(base=1, cap=60, attempts=10),       # 429, 403 rateLimitExceeded
+    'unavailable': Backoff(base=2, cap=120, attempts=10),       # 500, 502, 503, 504
+    'connection_reset': Backoff(base=1, cap=60, attempts=10),   # ECONNRESET
+    'unknown': Backoff(base=10, cap=600, attempts=8),           # Anything else that is not an HttpError
+}
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+UNAVAILABLE_STATUSES = (500, 502, 503, 504)
+# Retries stop 5 hours after the start of the run, so the upload still fits in the six hours of a period.
+RETRY_BUDGET = 5 * 60 * 60
+CIRCUIT_FAILURES = 5
+CIRCUIT_RESET_TIMEOUT = 30
+CIRCUIT_MAX_RESET_TIMEOUT = 600
+# How often the calls waiting on a half-open circuit check whether the probe call got through.
+CIRCUIT_PROBE_WAIT = 1
+
+
+class RetryBudgetExceeded(Exception):
+    pass
+
+
+def get_error_reason(e):
+    # The first reason of the error body, e.g. quotaExceeded or rateLimitExceeded.
+    try:
+        error = json.loads(e.content.decode('utf-8'))['error']
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+    for detail in error.get('errors', []) + error.get('details', []):
+        if isinstance(detail, dict) and detail.get('reason'):
+            return detail['reason']
+    return None
+
+
+def classify_error(e):
+    if isinstance(e, HttpError):
+        status = e.resp.status
+        if status == 304:
+            return 'not_modified'
+        elif status == 404:
+            return 'not_found'
+        elif status == 429:
+            return 'rate_limited'
+        elif status == 403:
+            return 'rate_limited' if get_error_reason(e) in RATE_LIMIT_REASONS else 'quota'
+        elif status in UNAVAILABLE_STATUSES:
+            return 'unavailable'
+        return 'fatal'
+    elif isinstance(e, OSError):
+        # Timeouts and other socket errors are not retried.
+        return 'connection_reset' if e.errno == errno.ECONNRESET else 'fatal'
+    return 'unknown'
+
+
+def get_error_label(e):
+    # Label of the error in the metrics: the HTTP status, ECONNRESET or unknown.
+    if isinstance(e, HttpError):
+        return str(e.resp.status)
+    elif isinstance(e, OSError) and e.errno == errno.ECONNRESET:
+        return 'ECONNRESET'
+    return 'unknown'
+
+
+def get_retry_after(e, now=None):
+    # Seconds asked by a Retry-After header (delay-seconds or HTTP-date), None without one.
+    value = e.resp.get('retry-after') if isinstance(e, HttpError) else None
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = now or datetime.datetime.now(datetime.UTC)
+    return max(0.0, (retry_at - now).total_seconds())
+
+
+class CircuitBreaker:
+    def __init__(self, failures=CIRCUIT_FAILURES, reset_timeout=CIRCUIT_RESET_TIMEOUT,
+                 max_reset_timeout=CIRCUIT_MAX_RESET_TIMEOUT, probe_wait=CIRCUIT_PROBE_WAIT):
+        self.max_failures = failures
+        self.initial_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.probe_wait = probe_wait
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def get_wait(self, now):
+        # Seconds before a call may go, 0 when it can go now. The first call after the reset timeout is the probe.
+        if self.state == 'open':
+            if now < self.opened_at + self.reset_timeout:
+                return self.opened_at + self.reset_timeout - now
+            self.state = 'half_open'
+            self.probing = False
+        if self.state == 'half_open':
+            if self.probing:
+                return self.probe_wait
+            self.probing = True
+        return 0
+
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.probing = False
+        self.reset_timeout = self.initial_reset_timeout
+
+    def record_failure(self, now):
+        # True when the circuit opens.
+        self.failures += 1
+        if self.state == 'half_open':
+            # The probe failed: wait twice as long before the next one.
+            self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+        elif self.state == 'open' or self.failures < self.max_failures:
+            return False
+        self.state = 'open'
+        self.opened_at = now
+        self.probing = False
+        return True
+
+
+class RetryPolicy:
+    def __init__(self, budget=RETRY_BUDGET, backoffs=None, circuit_failures=CIRCUIT_FAILURES,
+                 circuit_reset_timeout=CIRCUIT_RESET_TIMEOUT, circuit_max_reset_timeout=CIRCUIT_MAX_RESET_TIMEOUT,
+                 clock=time.monotonic, sleep=None, random=random.random):
+        self.backoffs = backoffs or BACKOFFS
+        self.clock = clock
+        # sleep(seconds, reason), metrics.sleep by default so the time lost in backoff is reported.
+        self.sleep = sleep or metrics.sleep
+        self.random = random
+        self.deadline = clock() + budget
+        self.breakers = collections.defaultdict(lambda: CircuitBreaker(circuit_failures, circuit_reset_timeout,
+                                                                       circuit_max_reset_timeout))
+        self.lock = threading.Lock()
+
+    def get_delay(self, error_class, attempt, retry_after=None):
+        # Full jitter: anything between 0 and the exponential backoff of the attempt (1 for the first retry).
+        backoff = self.backoffs[error_class]
+        delay = self.random() * min(backoff.cap, backoff.base * 2 ** (attempt - 1))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def wait(self, seconds, reason):
+        if self.clock() + seconds > self.deadline:
+            raise RetryBudgetExceeded(f"Waiting {seconds:.0f}s more ({reason}) would go past the retry budget of the run.")
+        self.sleep(seconds, reason)
+
+    def before_call(self, endpoint):
+        while True:
+            with self.lock:
+                seconds = self.breakers[endpoint].get_wait(self.clock())
+            if seconds <= 0:
+                return
+            self.wait(seconds, 'circuit_open')
+
+    def record_success(self, endpoint):
+        with self.lock:
+            self.breakers[endpoint].record_success()
+
+    def record_failure(self, endpoint):
+        with self.lock:
+            opened = self.breakers[endpoint].record_failure(self.clock())
+        if opened:
+            logging.info(f"Circuit of {endpoint} opened after {self.breakers[endpoint].failures} failures.")
+            metrics.increment('circuit_opened_total', endpoint=endpoint)
+
+    def backoff(self, error_class, attempt, reason, retry_after=None):
+        # Waits before retry number `attempt` of an error of this class. False when there are no retries left.
+        if attempt > self.backoffs[error_class].attempts:
+            return False
+        self.wait(self.get_delay(error_class, attempt, retry_after), reason)
+        return True
@@ -0,0 +1,18 @@
+# ORC schemas of the tables, in the struct<...> notation of orc-tools, for every writer of ORC files.
+
+STRUCT_MOST_POPULAR = 'struct<kind:string,etag:string,id:string,snippet:struct<publishedAt:timestamp,title:string,description:string,channelId:string,channelTitle:string,categoryId:string,tags:array<string>,liveBroadcastContent:string,defaultLanguage:string,defaultAudioLanguage:string,localized:struct<title:string,description:string>,thumbnails:struct<default:struct<url:string,width:int,height:int>,medium:struct<url:string,width:int,height:int>,high:struct<url:string,width:int,height:int>,standard:struct<url:string,width:int,height:int>,maxres:struct<url:string,width:int,height:int>>>,statistics:struct<viewCount:bigint,likeCount:bigint,dislikeCount:bigint,favoriteCount:bigint,commentCount:bigint>,metadata:struct<region_code:string,category_id:string,retrieved_at:timestamp,rank:int>>'
+STRUCT_REGION = 'struct<id:string,snippet:struct<name:string>,metadata:struct<retrieved_at:timestamp>>'
+STRUCT_CATEGORIES = 'struct<id:string,snippet:struct<title:string,assignable:boolean>,metadata:struct<region_code:string,retrieved_at:timestamp>>'
+# Normalized output: STRUCT_MOST_POPULAR split into a videos dimension and a rankings fact table.
+STRUCT_VIDEOS = 'struct<kind:string,id:string,snippet:struct<publishedAt:timestamp,title:string,description:string,channelId:string,channelTitle:string,categoryId:string,tags:array<string>,liveBroadcastContent:string,defaultLanguage:string,defaultAudioLanguage:string,localized:struct<title:string,description:string>,thumbnails:struct<default:struct<url:string,width:int,height:int>,medium:struct<url:string,width:int,height:int>,high:struct<url:string,width:int,height:int>,standard:struct<url:string,width:int,height:int>,maxres:struct<url:string,width:int,height:int>>>,metadata:struct<retrieved_at:timestamp>>'
+STRUCT_RANKINGS = 'struct<id:string,etag:string,statistics:struct<viewCount:bigint,likeCount:bigint,dislikeCount:bigint,favoriteCount:bigint,commentCount:bigint>,metadata:struct<region_code:string,category_id:string,retrieved_at:timestamp,rank:int>,snippet_creation_date:string,snippet_period:string>'
+
+
+def get_struct(table):
+    return {
+        'most_popular': STRUCT_MOST_POPULAR,
+        'regions': STRUCT_REGION,
+        'categories': STRUCT_CATEGORIES,
+        'videos': STRUCT_VIDEOS,
+        'rankings': STRUCT_RANKINGS,
+    }[table]
@@ -0,0 +1,215 @@
+# Rolls the collector outputs into segments and ships every finished segment to S3 while the crawl goes on.
+#
+# Table segments are converted to ORC in-process and uploaded next to each other in the usual
+# <table>/creation_date=/period=/ prefixes (Athena reads every file of a partition). Backup segments are
+# uploaded as they are, already compressed, to the backup bucket.
+#
+# Every segment has a manifest of its own (see manifest.py), checked before the segment is uploaded: the
+# rows of the ORC file, or the CRC32 of a file uploaded as written. It is uploaded after the segment, under
+# manifests/creation_date=/period=/segments/, so the manifest of the run can be put together from S3 at the
+# end, including the segments of the instances it resumed.
+#
+# A checkpoint of the journal (see checkpoint.py) rolls the open segments once one of them is full, and its
+# line is appended by the uploader once every segment submitted before it is uploaded, so the crawl does not
+# wait for the conversions and uploads, and a period is not split into a file per table and per checkpoint.
+#
+# With a location, every segment is uploaded as it was written, under that prefix with its manifest, for
+# someone else to merge: the workers of a sharded run keep their outputs there (see collect_shards.py).
+
+import os
+import json
+import logging
+import concurrent.futures
+import boto3
+from boto3.s3.transfer import TransferConfig
+from sinks import open_sink, get_sink_path, get_file_crc32
+from manifest import ManifestWriter, get_segments_manifest, MANIFEST_BUCKET, MANIFEST_PREFIX
+from schemas import get_struct
+
+DATA_BUCKET = 'youtube-trends-uiuc-v2'
+BACKUP_BUCKET = 'youtube-trends-uiuc-backup-v2'
+SEGMENTS_DIRECTORY = './segments'
+SEGMENT_SIZE = 16 * 1024 * 1024
+UPLOAD_WORKERS = 2
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                 multipart_chunksize=8 * 1024 * 1024,
+                                 max_concurrency=8)
+
+
+class SegmentUploader:
+    def __init__(self, creation_date, period, s3=None, max_workers=UPLOAD_WORKERS,
+                 transfer_config=TRANSFER_CONFIG, keep_files=False, location=None):
+        # location is a (bucket, key prefix) that takes the segments instead of the partitions.
+        self.creation_date = creation_date
+        self.period = period
+        self.location = location
+        self.s3 = s3 or boto3.resource('s3')
+        self.transfer_config = transfer_config
+        self.keep_files = keep_files
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        # One thread, so that checkpoints are committed in order.
+        self.committer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+        self.commits = []
+
+    def get_location(self, table):
+        # (bucket, key prefix) of the segments of a table.
+        if self.location is not None:
+            bucket, prefix = self.location
+            return bucket, f"{prefix}/"
+        partition = f"creation_date={self.creation_date}/period={self.period}"
+        if table == 'backup':
+            return BACKUP_BUCKET, f"{partition}/"
+        return DATA_BUCKET, f"{table}/{partition}/"
+
+    def get_manifest_location(self):
+        if self.location is not None:
+            bucket, prefix = self.location
+            return bucket, f"{prefix}/manifests/"
+        return MANIFEST_BUCKET, f"{MANIFEST_PREFIX}/creation_date={self.creation_date}/period={self.period}/segments/"
+
+    def discard(self, table, after=0):
+        # A run that stopped may have uploaded segments after its last checkpoint. What they hold is collected
+        # again on resume, in segments numbered from after + 1, so the copies of the stopped run are removed.
+        for bucket, prefix in (self.get_location(table), self.get_manifest_location()):
+            for summary in self.s3.Bucket(bucket).objects.filter(Prefix=f"{prefix}{table}-"):
+                number = os.path.basename(summary.key)[len(table) + 1:].split('.')[0]
+                if number.isdigit() and int(number) > after:
+                    summary.delete()
+                    logging.info(f"Removed s3://{bucket}/{summary.key}, written after the last checkpoint.")
+
+    def submit(self, table, path, manifest):
+        self.check()
+        self.futures.append(self.executor.submit(self.ship, table, path, manifest))
+
+    def ship(self, table, path, manifest):
+        # manifest is what the SegmentedWriter wrote to the segment at path.
+        import orc_writer
+        import pyarrow.orc
+        bucket, prefix = self.get_location(table)
+        if table == 'backup' or self.location is not None:
+            upload_path = path
+            crc32, size = get_file_crc32(path)
+            if crc32 != manifest['crc32'] or size != manifest['bytes']:
+                raise Exception(f"{path} ({size} bytes, crc32 {crc32}) is not what was written to it "
+                                f"({manifest['bytes']} bytes, crc32 {manifest['crc32']}).")
+        else:
+            upload_path = os.path.splitext(path)[0] + '.orc'
+            orc_writer.write_columnar(path, get_struct(table), orc_file=upload_path)
+            # The footer of the file must agree with the records written to the segment before it is uploaded.
+            rows = pyarrow.orc.ORCFile(upload_path).nrows
+            if rows != manifest['records']:
+                raise Exception(f"{upload_path} has {rows} rows, {manifest['records']} records were written to {path}.")
+            manifest = dict(manifest, rows=rows)
+        key = f"{prefix}{os.path.basename(upload_path)}"
+        self.s3.Bucket(bucket).upload_file(upload_path, key, Config=self.transfer_config)
+        logging.info(f"Uploaded s3://{bucket}/{key}")
+        manifest_bucket, manifest_prefix = self.get_manifest_location()
+        self.s3.Object(manifest_bucket, f"{manifest_prefix}{manifest['file'].split('.')[0]}.json").put(
+            Body=json.dumps(dict(manifest, table=table, key=key)).encode('utf-8'))
+        if not self.keep_files:
+            for file in {path, upload_path}:
+                os.remove(file)
+        return key
+
+    def after_uploads(self, function):
+        # Runs function once every segment submitted so far is uploaded, without waiting for it here.
+        self.check()
+        self.commits.append(self.committer.submit(self.run_after, list(self.futures), function))
+
+    @staticmethod
+    def run_after(futures, function):
+        for future in futures:
+            future.result()
+        return function()
+
+    def check(self):
+        # Fails the crawl as soon as one upload or commit fails, instead of finding out at the end.
+        for future in self.futures + self.commits:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def wait(self):
+        keys = [future.result() for future in self.futures]
+        for future in self.commits:
+            future.result()
+        return keys
+
+    def close(self):
+        try:
+            return self.wait()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            self.committer.shutdown(cancel_futures=True)
+
+    def get_manifest(self):
+        # The manifest of every segment in S3, once the uploads are done.
+        bucket, prefix = self.get_manifest_location()
+        segments = [json.loads(summary.get()['Body'].read().decode('utf-8'))
+                    for summary in self.s3.Bucket(bucket).objects.filter(Prefix=prefix)]
+        return get_segments_manifest(self.creation_date, self.period, segments)
+
+
+class SegmentedWriter:
+    def __init__(self, table, uploader, compression='none', compression_workers=1,
+                 segment_size=SEGMENT_SIZE, directory=SEGMENTS_DIRECTORY, start_number=0):
+        self.table = table
+        self.uploader = uploader
+        self.compression = compression
+        self.compression_workers = compression_workers
+        self.segment_size = segment_size
+        self.directory = directory
+        self.number = start_number
+        self.sink = None
+        self.path = None
+        self.written = 0
+        # Segments rolled because they were full since the last checkpoint.
+        self.full_segments = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, data):
+        # A full segment is rolled at the next write rather than at this one, so that the records of this
+        # write are counted (see count_record) in the segment that holds them.
+        if self.sink is not None and self.written >= self.segment_size:
+            self.roll()
+            self.full_segments += 1
+        if self.sink is None:
+            self.number += 1
+            name = os.path.join(self.directory, f"{self.table}-{self.number:05d}.json")
+            self.path = get_sink_path(name, self.compression)
+            self.sink = ManifestWriter(self.path, open_sink(name, self.compression, workers=self.compression_workers))
+            self.written = 0
+        self.sink.write(data)
+        self.written += len(data)
+        return len(data)
+
+    def count_record(self, record):
+        self.sink.count_record(record)
+
+    def roll(self):
+        if self.sink is None:
+            return
+        self.sink.close()
+        self.uploader.submit(self.table, self.path, self.sink.to_dict())
+        self.sink = None
+
+    def checkpoint(self):
+        # Everything up to the returned segment number is in S3 once the uploads submitted so far are done
+        # (see SegmentUploader.after_uploads).
+        self.roll()
+        self.full_segments = 0
+        return self.number
+
+    def close(self):
+        self.roll()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.sink is not None:
+            # A failed crawl leaves its last, incomplete segment on disk instead of uploading it.
+            self.sink.close()
+            self.sink = None
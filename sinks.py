@@ -0,0 +1,249 @@
+# Output files that are compressed while they are written, so the uncompressed data never reaches the disk.
+#
+# With workers > 1 the data is cut into blocks and every block is compressed as an independent stream on
+# its own thread (bz2, zlib and zstandard release the GIL while compressing). The streams are written in
+# order, one after the other. bzip2, gzip and zstd all read such multi-stream files as one file.
+#
+# Outputs take bytes. Records are serialized by dump_record, with orjson when it is installed (straight to
+# UTF-8 bytes, several times faster than json.dumps), and a response whose raw bytes the client kept goes to
+# the backup as it was received (see dump_response), so it is never serialized again.
+
+import io
+import os
+import bz2
+import gzip
+import json
+import zlib
+import collections
+import concurrent.futures
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+COMPRESSIONS = ('none', 'bz2', 'gzip', 'zstd')
+EXTENSIONS = {'none': '', 'bz2': '.bz2', 'gzip': '.gz', 'zstd': '.zst'}
+DEFAULT_LEVELS = {'bz2': 9, 'gzip': 6, 'zstd': 10}
+# bz2 works on 900k blocks at level 9, so 8Mb blocks lose almost nothing to the stream boundaries.
+BLOCK_SIZE = 8 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+# Uncompressed outputs reach the disk in writes of this size.
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+class RawResponse(dict):
+    # A parsed API response that keeps the bytes it was parsed from, one line of compact JSON.
+    raw = None
+
+
+def dump_json(value):
+    # Compact and UTF-8 with or without orjson, so an output does not depend on what is installed.
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def dump_record(record):
+    # One line of an output.
+    if orjson is not None:
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+    return dump_json(record) + b'\n'
+
+
+def dump_response(response, metadata):
+    # One line of the backup: the raw bytes of the response with its metadata spliced in before the last
+    # brace, as if it were its last key. Responses without raw bytes (e.g. from the cache) are serialized.
+    raw = getattr(response, 'raw', None)
+    if raw is None or not response or not raw.endswith(b'}') or b'\n' in raw:
+        return dump_record(dict(response, metadata=metadata))
+    return b''.join((memoryview(raw)[:-1], b',"metadata":', dump_json(metadata), b'}\n'))
+
+
+def get_compressor(compression, level=None):
+    level = level or DEFAULT_LEVELS.get(compression)
+    if compression == 'bz2':
+        return bz2.BZ2Compressor(level)
+    elif compression == 'gzip':
+        # wbits=31 writes a gzip header and trailer instead of a raw zlib stream.
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("zstd compression needs the zstandard package (pip install zstandard).")
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    else:
+        raise Exception(f"Unknown compression: {compression}")
+
+
+def compress_block(compression, data, level=None):
+    compressor = get_compressor(compression, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def get_sink_path(path, compression):
+    return path + EXTENSIONS[compression]
+
+
+def open_sink(path, compression='none', level=None, workers=1, block_size=BLOCK_SIZE, offset=None):
+    # With an offset, the file is truncated at that position (see checkpoint_sink) and appended to.
+    if offset is not None:
+        truncate_file(get_sink_path(path, compression), offset)
+    if compression == 'none':
+        return open(path, 'wb' if offset is None else 'ab', buffering=WRITE_BUFFER_SIZE)
+    return CompressedSink(get_sink_path(path, compression), compression, level=level, workers=workers,
+                          block_size=block_size, append=offset is not None)
+
+
+def truncate_file(path, offset):
+    with open(path, 'ab') as f:
+        f.truncate(offset)
+
+
+def get_file_crc32(path):
+    # (crc32, size) of a file, read in one streaming pass.
+    crc32 = 0
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                return crc32, size
+            crc32 = zlib.crc32(data, crc32)
+            size += len(data)
+
+
+def checkpoint_sink(sink):
+    # Makes everything written so far readable from the file and returns the position to truncate at on resume.
+    if hasattr(sink, 'checkpoint'):
+        return sink.checkpoint()
+    sink.flush()
+    return sink.tell()
+
+
+class CompressedSink:
+    def __init__(self, path, compression, level=None, workers=1, block_size=BLOCK_SIZE, append=False):
+        self.path = path
+        self.compression = compression
+        self.level = level
+        self.block_size = block_size
+        # What is already in the file counts, when it is appended to after a resume.
+        self.crc32, self.size = get_file_crc32(path) if append and os.path.exists(path) else (0, 0)
+        self.file = open(path, 'ab' if append else 'wb')
+        self.buffer = []
+        self.buffered = 0
+        self.executor = None
+        self.pending = collections.deque()
+        self.compressor = None
+        if workers > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+            # Bounds the memory used by blocks waiting to be compressed or written.
+            self.max_pending = workers * 2
+        else:
+            self.compressor = get_compressor(compression, level)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._flush_buffer()
+        return len(data)
+
+    def _flush_buffer(self):
+        if not self.buffer:
+            return
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        if self.executor is None:
+            self._write(self.compressor.compress(data))
+        else:
+            self.pending.append(self.executor.submit(compress_block, self.compression, data, self.level))
+            while len(self.pending) >= self.max_pending:
+                self._write(self.pending.popleft().result())
+
+    def _write(self, data):
+        self.file.write(data)
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self.size += len(data)
+
+    def _drain(self):
+        while self.pending:
+            self._write(self.pending.popleft().result())
+
+    def checkpoint(self):
+        # Ends the current compressed stream, so the file can be cut here and continued with a new stream.
+        self._flush_buffer()
+        if self.executor is None:
+            self._write(self.compressor.flush())
+            self.compressor = get_compressor(self.compression, self.level)
+        else:
+            self._drain()
+        self.file.flush()
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            self._flush_buffer()
+            if self.executor is None:
+                self._write(self.compressor.flush())
+            else:
+                self._drain()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def compress_file(filename, compression='bz2', level=None, workers=None, block_size=BLOCK_SIZE):
+    # Returns the compressed file, with the size and the CRC32 of the bytes written to it.
+    workers = workers or os.cpu_count() or 1
+    compressed_filename = get_sink_path(filename, compression)
+    with open(filename, 'rb') as source_file, \
+            CompressedSink(compressed_filename, compression, level=level, workers=workers,
+                           block_size=block_size) as compressed_file:
+        while True:
+            data = source_file.read(block_size)
+            if not data:
+                break
+            compressed_file.write(data)
+    return compressed_filename, compressed_file.size, compressed_file.crc32
+
+
+def get_compression(path):
+    for compression, extension in EXTENSIONS.items():
+        if extension and path.endswith(extension):
+            return compression
+    return 'none'
+
+
+def open_source(path):
+    # Reads back, as text, a file written by open_sink or compress_file, every stream of it.
+    compression = get_compression(path)
+    if compression == 'bz2':
+        return bz2.open(path, 'rt', encoding='utf-8')
+    elif compression == 'gzip':
+        return gzip.open(path, 'rt', encoding='utf-8')
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("zstd compression needs the zstandard package (pip install zstandard).")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True,
+                                                            closefd=True)
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    return open(path, encoding='utf-8')
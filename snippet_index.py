@@ -0,0 +1,85 @@
+# Index of the snippets already stored in videos/, for the incremental output (collect_most_popular.py --incremental).
+#
+# Most videos of a chart were in the previous period's charts with the same snippet; only their statistics
+# and rank changed. The index maps every video id to the hash of its last stored snippet and to the
+# partition (creation_date, period) of videos/ that holds it. An incremental run writes the snippet of a
+# video only when it is new or its hash changed, and every row of rankings/ points at the partition of its
+# snippet (snippet_creation_date, snippet_period), which is what the youtube_trends_normalized view joins on.
+#
+# The index is a SQLite file with a copy in the admin bucket. The collector updates the local file at the
+# end of a run, and the copy is replaced only once videos/ holds the new snippets (after the upload),
+# so the index never points at a snippet that is not in S3. Videos not seen for INDEX_RETENTION_DAYS are
+# dropped: if one comes back, its snippet is simply written again.
+
+import os
+import json
+import logging
+import hashlib
+import sqlite3
+import datetime
+import boto3
+
+INDEX_BUCKET = 'youtube-trends-uiuc-admin'
+INDEX_OBJECT = 'snippet_index.sqlite'
+INDEX_FILE = './snippet_index.sqlite'
+INDEX_RETENTION_DAYS = 30
+
+
+def get_snippet_hash(snippet):
+    content = json.dumps(snippet, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class SnippetIndex:
+    def __init__(self, path=INDEX_FILE):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS snippets (id TEXT PRIMARY KEY, hash TEXT NOT NULL, "
+                                "creation_date TEXT NOT NULL, period TEXT NOT NULL, last_seen TEXT NOT NULL) "
+                                "WITHOUT ROWID")
+        self.connection.commit()
+
+    @classmethod
+    def load(cls, path=INDEX_FILE):
+        try:
+            boto3.client('s3').download_file(INDEX_BUCKET, INDEX_OBJECT, path)
+        except Exception as e:
+            # Without an index every snippet is written, as in a normalized run.
+            logging.info(f"No snippet index found in S3 ({e}), using the local copy if there is one.")
+        return cls(path)
+
+    def get(self, video_id):
+        # [hash, creation_date, period] of the stored snippet of a video, None when there is none.
+        row = self.connection.execute("SELECT hash, creation_date, period FROM snippets WHERE id = ?",
+                                      (video_id,)).fetchone()
+        return list(row) if row is not None else None
+
+    def update(self, videos, creation_date):
+        # videos maps the ids seen in a run to their [hash, creation_date, period].
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO snippets (id, hash, creation_date, period, last_seen) VALUES (?, ?, ?, ?, ?)",
+            ((video_id, *snippet, creation_date) for video_id, snippet in videos.items() if snippet is not None))
+        oldest = (datetime.date.fromisoformat(creation_date) -
+                  datetime.timedelta(days=INDEX_RETENTION_DAYS)).isoformat()
+        self.connection.execute("DELETE FROM snippets WHERE last_seen < ?", (oldest,))
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT count(*) FROM snippets").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+def upload_index(path=INDEX_FILE, s3=None):
+    # A consistent copy, even if a connection is still open on the file.
+    snapshot = f"{path}.upload"
+    source = sqlite3.connect(path)
+    target = sqlite3.connect(snapshot)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    (s3 or boto3.resource('s3')).Bucket(INDEX_BUCKET).upload_file(snapshot, INDEX_OBJECT)
+    os.remove(snapshot)
@@ -0,0 +1,133 @@
+# Runs the stages of a pipeline as a DAG: every stage starts as soon as the stages it depends on are done and
+# the resources it needs are free.
+#
+# A stage names the stages it requires (added before it, so there are no cycles) and the resources it holds
+# while it runs, e.g. cpu=1 for a conversion, network=1 for an upload, memory=<bytes> for what it may use.
+# A stage runs when all the stages it requires returned a true value. If one of them returned a false
+# value, raised, or was skipped, the stage is skipped. A stage that needs more of a resource than its
+# limit gets all of it and runs alone on that resource, rather than never running. Ready stages are
+# started in the order they were added, and a stage that fits starts even if an earlier one is still
+# waiting for resources.
+# One failing stage does not stop the stages that do not depend on it. run() returns once every stage is
+# done or skipped. check() then raises the error of the first stage that raised.
+
+import time
+import concurrent.futures
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class Stage:
+    def __init__(self, name, function, requires, resources):
+        self.name = name
+        self.function = function
+        self.requires = requires
+        self.resources = resources
+        self.state = PENDING
+        self.result = None
+        self.error = None
+        self.ready_at = None
+        self.started_at = None
+        self.finished_at = None
+
+    def succeeded(self):
+        return self.state == DONE and bool(self.result)
+
+
+class StageScheduler:
+    def __init__(self, clock=time.perf_counter, **limits):
+        # limits maps every resource to the amount the running stages can hold at once, e.g. cpu=2.
+        self.clock = clock
+        self.limits = limits
+        self.used = {resource: 0 for resource in limits}
+        self.stages = {}
+        self.started_at = None
+
+    def add(self, name, function, requires=(), **resources):
+        if name in self.stages:
+            raise Exception(f"Stage {name} was already added.")
+        unknown = [required for required in requires if required not in self.stages]
+        if unknown:
+            raise Exception(f"Stage {name} requires stages that were not added before it: {', '.join(unknown)}")
+        for resource in resources:
+            if resource not in self.limits:
+                raise Exception(f"Stage {name} needs {resource}, which has no limit.")
+        # A stage never waits for more than there is.
+        resources = {resource: min(amount, self.limits[resource]) for resource, amount in resources.items()}
+        self.stages[name] = Stage(name, function, tuple(requires), resources)
+        return name
+
+    def fits(self, stage):
+        return all(self.used[resource] + amount <= self.limits[resource]
+                   for resource, amount in stage.resources.items())
+
+    def hold(self, stage, sign):
+        for resource, amount in stage.resources.items():
+            self.used[resource] += sign * amount
+
+    def run(self):
+        self.started_at = self.clock()
+        pending = list(self.stages.values())
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(pending), 1)) as executor:
+            while pending or running:
+                for stage in list(pending):
+                    requires = [self.stages[name] for name in stage.requires]
+                    if any(required.state not in (PENDING, RUNNING) and not required.succeeded()
+                           for required in requires):
+                        stage.state = SKIPPED
+                        pending.remove(stage)
+                    elif all(required.state == DONE for required in requires):
+                        if stage.ready_at is None:
+                            stage.ready_at = self.clock()
+                        if self.fits(stage):
+                            self.hold(stage, 1)
+                            stage.state = RUNNING
+                            stage.started_at = self.clock()
+                            running[executor.submit(stage.function)] = stage
+                            pending.remove(stage)
+                if not running:
+                    # Every stage left was skipped in this pass.
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    stage.finished_at = self.clock()
+                    self.hold(stage, -1)
+                    try:
+                        stage.result = future.result()
+                        stage.state = DONE
+                    except Exception as e:
+                        stage.error = e
+                        stage.state = FAILED
+        return self
+
+    def result(self, name):
+        # None when the stage raised or was skipped.
+        return self.stages[name].result
+
+    def succeeded(self, name):
+        return self.stages[name].succeeded()
+
+    def check(self):
+        for stage in self.stages.values():
+            if stage.error is not None:
+                raise stage.error
+
+    def timings(self):
+        # Seconds since run() started, for every stage in the order they were added.
+        timings = []
+        for stage in self.stages.values():
+            timing = {'stage': stage.name, 'state': stage.state}
+            if stage.started_at is not None:
+                timing['waited'] = stage.started_at - stage.ready_at
+                timing['started'] = stage.started_at - self.started_at
+                timing['seconds'] = stage.finished_at - stage.started_at
+            if stage.error is not None:
+                timing['error'] = str(stage.error)
+            timings.append(timing)
+        return timings
@@ -0,0 +1,133 @@
+# Tests of retry_policy.py, with a clock that only moves when the policy sleeps.
+#
+# python -m unittest discover tests
+
+import os
+import sys
+import json
+import errno
+import unittest
+import httplib2
+from googleapiclient.errors import HttpError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from retry_policy import RetryPolicy, RetryBudgetExceeded, Backoff, classify_error, get_retry_after
+
+
+def get_http_error(status, reason=None, retry_after=None):
+    headers = {'status': status}
+    if retry_after is not None:
+        headers['retry-after'] = retry_after
+    errors = [{'reason': reason}] if reason else []
+    content = json.dumps({'error': {'code': status, 'errors': errors}}).encode('utf-8')
+    return HttpError(httplib2.Response(headers), content, uri='https://youtube.googleapis.com/youtube/v3/videos?key=KEY')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds, reason):
+        self.sleeps.append((seconds, reason))
+        self.now += seconds
+
+
+def get_policy(clock, budget=3600, random=lambda: 1.0):
+    return RetryPolicy(budget=budget, backoffs={'unavailable': Backoff(base=2, cap=10, attempts=3)},
+                       circuit_failures=2, circuit_reset_timeout=30, circuit_max_reset_timeout=100,
+                       clock=clock, sleep=clock.sleep, random=random)
+
+
+class ClassifyErrorTest(unittest.TestCase):
+    def test_http_errors(self):
+        self.assertEqual(classify_error(get_http_error(304)), 'not_modified')
+        self.assertEqual(classify_error(get_http_error(404)), 'not_found')
+        self.assertEqual(classify_error(get_http_error(429)), 'rate_limited')
+        self.assertEqual(classify_error(get_http_error(403, 'rateLimitExceeded')), 'rate_limited')
+        self.assertEqual(classify_error(get_http_error(403, 'quotaExceeded')), 'quota')
+        self.assertEqual(classify_error(get_http_error(403)), 'quota')
+        self.assertEqual(classify_error(get_http_error(503)), 'unavailable')
+        self.assertEqual(classify_error(get_http_error(400)), 'fatal')
+
+    def test_other_errors(self):
+        self.assertEqual(classify_error(ConnectionResetError(errno.ECONNRESET, 'reset')), 'connection_reset')
+        self.assertEqual(classify_error(TimeoutError('timed out')), 'fatal')
+        self.assertEqual(classify_error(ValueError('bad response')), 'unknown')
+
+
+class BackoffTest(unittest.TestCase):
+    def test_delay_grows_to_the_cap(self):
+        policy = get_policy(Clock())
+        self.assertEqual([policy.get_delay('unavailable', attempt) for attempt in range(1, 5)], [2, 4, 8, 10])
+
+    def test_retry_after_floors_the_delay(self):
+        error = get_http_error(429, retry_after='30')
+        self.assertEqual(get_retry_after(error), 30)
+        policy = get_policy(Clock(), random=lambda: 0.0)
+        self.assertEqual(policy.get_delay('unavailable', 1, get_retry_after(error)), 30)
+        # A shorter Retry-After leaves the backoff as it is.
+        self.assertEqual(get_policy(Clock()).get_delay('unavailable', 3, 1), 8)
+        self.assertIsNone(get_retry_after(get_http_error(429)))
+
+    def test_no_retries_left(self):
+        clock = Clock()
+        policy = get_policy(clock)
+        self.assertTrue(all(policy.backoff('unavailable', attempt, '503') for attempt in range(1, 4)))
+        self.assertFalse(policy.backoff('unavailable', 4, '503'))
+        self.assertEqual(clock.sleeps, [(2, '503'), (4, '503'), (8, '503')])
+
+    def test_budget_exhausted(self):
+        clock = Clock()
+        policy = get_policy(clock, budget=5)
+        policy.backoff('unavailable', 1, '503')
+        with self.assertRaises(RetryBudgetExceeded):
+            policy.backoff('unavailable', 2, '503')
+        self.assertEqual(clock.now, 2)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_open_half_open_close(self):
+        clock = Clock()
+        policy = get_policy(clock)
+        policy.before_call('videos')
+        policy.record_failure('videos')
+        self.assertEqual(policy.breakers['videos'].state, 'closed')
+        policy.record_failure('videos')
+        self.assertEqual(policy.breakers['videos'].state, 'open')
+
+        # The next call waits for the reset timeout, then goes as the probe.
+        policy.before_call('videos')
+        self.assertEqual(clock.sleeps, [(30, 'circuit_open')])
+        self.assertEqual(policy.breakers['videos'].state, 'half_open')
+        # Other calls wait for the probe, and other endpoints do not.
+        self.assertEqual(policy.breakers['videos'].get_wait(clock()), 1)
+        policy.before_call('channels')
+
+        # A failed probe opens the circuit for twice as long.
+        policy.record_failure('videos')
+        self.assertEqual(policy.breakers['videos'].state, 'open')
+        policy.before_call('videos')
+        self.assertEqual(clock.sleeps[-1], (60, 'circuit_open'))
+
+        policy.record_success('videos')
+        self.assertEqual(policy.breakers['videos'].state, 'closed')
+        self.assertEqual(policy.breakers['videos'].reset_timeout, 30)
+        policy.before_call('videos')
+        self.assertEqual(len(clock.sleeps), 2)
+
+    def test_open_circuit_past_the_budget(self):
+        clock = Clock()
+        policy = get_policy(clock, budget=10)
+        policy.record_failure('videos')
+        policy.record_failure('videos')
+        with self.assertRaises(RetryBudgetExceeded):
+            policy.before_call('videos')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+# Tests of the segment mode of the collector against the S3 stand-in and the fake YouTube API of the benchmark.
+#
+# python -m unittest discover tests
+
+import os
+import sys
+import bz2
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+TESTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY = os.path.dirname(TESTS_DIRECTORY)
+sys.path.insert(0, REPOSITORY)
+sys.path.insert(0, os.path.join(REPOSITORY, 'benchmark'))
+
+import boto3
+import pyarrow.orc
+from run_benchmark import start_server, get_environment, seed_s3, write_discovery_document
+from segment_uploader import SegmentUploader, SegmentedWriter, DATA_BUCKET, BACKUP_BUCKET
+from manifest import MANIFEST_BUCKET
+
+CREATION_DATE = '2025-01-01'
+RETRIEVED_AT = '2025-01-01 00:00:00.000000000Z'
+# Runs the collector of a period in the current directory. With a third argument, the process dies as soon
+# as that many checkpoints are in the journal, as an instance that is lost would.
+COLLECT = """
+import os, sys, logging
+sys.path.insert(0, %r)
+logging.basicConfig(level=logging.INFO)
+import checkpoint
+from collect_most_popular import collect_most_popular
+if len(sys.argv) > 2:
+    append = checkpoint.Journal.append
+    def crash(journal, entry):
+        append(journal, entry)
+        with open(journal.path) as f:
+            if sum(1 for _ in f) > int(sys.argv[2]):
+                os._exit(1)
+    checkpoint.Journal.append = crash
+collect_most_popular(creation_date=%r, period=sys.argv[1], use_cache=False, use_key_pool=False, max_workers=2,
+                     batch_size=2, upload_segments=True, segment_size=20000, resume=True, journal_s3=True)
+""" % (REPOSITORY, CREATION_DATE)
+
+
+def get_region(code):
+    return {'id': code, 'snippet': {'name': f'Region {code}'}, 'metadata': {'retrieved_at': RETRIEVED_AT}}
+
+
+class SegmentModeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix='segment_mode_test_')
+        cls.servers = []
+        api, cls.api_url = start_server('fake_youtube_api.py', ['--regions', '3', '--categories', '2', '--pages', '2',
+                                                                '--videos', '100', '--latency-ms', '5'], cls.directory)
+        cls.servers.append(api)
+        s3, s3_url = start_server('fake_s3.py', ['--directory', os.path.join(cls.directory, 's3')], cls.directory)
+        cls.servers.append(s3)
+        cls.environment = get_environment(s3_url)
+        seed_s3(cls.environment)
+        cls.saved_environment = dict(os.environ)
+        os.environ.update(cls.environment)
+        cls.s3 = boto3.resource('s3')
+
+    @classmethod
+    def tearDownClass(cls):
+        os.environ.clear()
+        os.environ.update(cls.saved_environment)
+        for server in cls.servers:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(cls.directory)
+
+    def get_keys(self, bucket, prefix):
+        return sorted(summary.key for summary in self.s3.Bucket(bucket).objects.filter(Prefix=prefix))
+
+    def write_segments(self, period, table, segments, records_per_segment):
+        uploader = SegmentUploader(CREATION_DATE, period)
+        directory = os.path.join(self.directory, f'segments-{period}-{table}')
+        compression = 'bz2' if table == 'backup' else 'none'
+        with SegmentedWriter(table, uploader, compression=compression, segment_size=1, directory=directory) as writer:
+            for i in range(segments):
+                region = get_region(f'R{i:03d}')
+                # Every write fills a segment, which is rolled at the next one.
+                writer.write(b''.join(json.dumps(region).encode('utf-8') + b'\n' for _ in range(records_per_segment)))
+                for _ in range(records_per_segment):
+                    writer.count_record(region)
+        uploader.close()
+        return uploader
+
+    def test_segments_are_checked_and_uploaded(self):
+        uploader = self.write_segments('00', 'regions', segments=3, records_per_segment=2)
+        prefix = f'regions/creation_date={CREATION_DATE}/period=00/'
+        keys = self.get_keys(DATA_BUCKET, prefix)
+        self.assertEqual(keys, [f'{prefix}regions-{number:05d}.orc' for number in (1, 2, 3)])
+        path = os.path.join(self.directory, 'regions.orc')
+        self.s3.Bucket(DATA_BUCKET).download_file(keys[0], path)
+        self.assertEqual(pyarrow.orc.ORCFile(path).nrows, 2)
+
+        manifest = uploader.get_manifest()['tables']['regions']
+        self.assertEqual(manifest['records'], 6)
+        self.assertEqual([segment['key'] for segment in manifest['segments']], keys)
+        self.assertTrue(all(segment['rows'] == 2 for segment in manifest['segments']))
+
+    def test_backup_segments_are_uploaded_as_written(self):
+        self.write_segments('06', 'backup', segments=2, records_per_segment=3)
+        prefix = f'creation_date={CREATION_DATE}/period=06/'
+        keys = self.get_keys(BACKUP_BUCKET, prefix)
+        self.assertEqual(keys, [f'{prefix}backup-{number:05d}.json.bz2' for number in (1, 2)])
+        path = os.path.join(self.directory, 'backup.json.bz2')
+        self.s3.Bucket(BACKUP_BUCKET).download_file(keys[1], path)
+        with bz2.open(path, 'rt') as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+    def test_discard_removes_the_segments_after_a_checkpoint(self):
+        self.write_segments('12', 'regions', segments=3, records_per_segment=1)
+        uploader = SegmentUploader(CREATION_DATE, '12')
+        uploader.discard('regions', after=1)
+        uploader.close()
+        prefix = f'regions/creation_date={CREATION_DATE}/period=12/'
+        self.assertEqual(self.get_keys(DATA_BUCKET, prefix), [f'{prefix}regions-00001.orc'])
+        manifests = self.get_keys(MANIFEST_BUCKET, f'manifests/creation_date={CREATION_DATE}/period=12/segments/')
+        self.assertEqual([os.path.basename(key) for key in manifests], ['regions-00001.json'])
+
+    def collect(self, name, period, crash_after=None):
+        # Every run has a directory of its own, as an instance would.
+        directory = os.path.join(self.directory, name)
+        os.makedirs(directory)
+        write_discovery_document(directory, self.api_url)
+        arguments = [sys.executable, '-c', COLLECT, period] + ([str(crash_after)] if crash_after else [])
+        return subprocess.run(arguments, cwd=directory, env=dict(os.environ), capture_output=True, text=True)
+
+    def get_partition(self, period):
+        # The records of every table of a partition, without their retrieved_at.
+        partition = {}
+        for table in ('regions', 'categories', 'most_popular', 'backup'):
+            records = []
+            if table == 'backup':
+                keys = self.get_keys(BACKUP_BUCKET, f'creation_date={CREATION_DATE}/period={period}/')
+            else:
+                keys = self.get_keys(DATA_BUCKET, f'{table}/creation_date={CREATION_DATE}/period={period}/')
+            for key in keys:
+                path = os.path.join(self.directory, os.path.basename(key))
+                self.s3.Bucket(BACKUP_BUCKET if table == 'backup' else DATA_BUCKET).download_file(key, path)
+                if table == 'backup':
+                    with bz2.open(path, 'rt') as f:
+                        rows = [json.loads(line) for line in f]
+                else:
+                    rows = pyarrow.orc.ORCFile(path).read().to_pylist()
+                for row in rows:
+                    row['metadata'].pop('retrieved_at')
+                    records.append(json.dumps(row, sort_keys=True, default=str))
+            partition[table] = sorted(records)
+        return partition
+
+    def test_crashed_run_resumed_from_s3(self):
+        clean = self.collect('clean', '18')
+        self.assertEqual(clean.returncode, 0, clean.stderr[-2000:])
+
+        crashed = self.collect('crashed', '00', crash_after=2)
+        self.assertNotEqual(crashed.returncode, 0)
+        journal = self.get_keys('youtube-trends-uiuc-admin', f'journals/creation_date={CREATION_DATE}/period=00/')
+        self.assertEqual(len(journal), 1)
+        # Another instance, without the files of the crashed one.
+        resumed = self.collect('resumed', '00')
+        self.assertEqual(resumed.returncode, 0, resumed.stderr[-2000:])
+        self.assertIn('Resuming from 2 checkpoints', resumed.stderr)
+
+        expected = self.get_partition('18')
+        self.assertTrue(all(expected.values()))
+        self.assertEqual(self.get_partition('00'), expected)
+        manifests = [json.loads(self.s3.Object(MANIFEST_BUCKET, f'manifests/creation_date={CREATION_DATE}/'
+                                                                f'period={period}/manifest.json').get()['Body'].read())
+                     for period in ('00', '18')]
+        for table, entry in manifests[1]['tables'].items():
+            self.assertEqual(manifests[0]['tables'][table]['records'], entry['records'])
+            self.assertEqual(manifests[0]['tables'][table]['categories'], entry['categories'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,18 @@
-import bz2
-import shutil
 import boto3
 import os
 import subprocess
+import sys
+import time
 import argparse
 import datetime
+import functools
 from collect_most_popular import send_gmail
+from sinks import compress_file, get_sink_path, get_file_crc32, COMPRESSIONS, BLOCK_SIZE
+from stage_scheduler import StageScheduler
+from metrics import metrics
+from snippet_index import upload_index, INDEX_FILE
+from manifest import load_manifest, upload_manifest, MANIFEST_FILE
+from schemas import STRUCT_MOST_POPULAR, STRUCT_REGION, STRUCT_CATEGORIES, STRUCT_VIDEOS, STRUCT_RANKINGS
 
 def get_period():
     period = int(datetime.datetime.now(datetime.UTC).strftime("%H"))
@@ -18,100 +25,298 @@ def get_period():
     else:
         return '18'
 
-STRUCT_MOST_POPULAR = 'struct<kind:string,etag:string,id:string,snippet:struct<publishedAt:timestamp,title:string,description:string,channelId:string,channelTitle:string,categoryId:string,tags:array<string>,liveBroadcastContent:string,defaultLanguage:string,defaultAudioLanguage:string,localized:struct<title:string,description:string>,thumbnails:struct<default:struct<url:string,width:int,height:int>,medium:struct<url:string,width:int,height:int>,high:struct<url:string,width:int,height:int>,standard:struct<url:string,width:int,height:int>,maxres:struct<url:string,width:int,height:int>>>,statistics:struct<viewCount:bigint,likeCount:bigint,dislikeCount:bigint,favoriteCount:bigint,commentCount:bigint>,metadata:struct<region_code:string,category_id:string,retrieved_at:timestamp,rank:int>>'
-STRUCT_REGION = 'struct<id:string,snippet:struct<name:string>,metadata:struct<retrieved_at:timestamp>>'
-STRUCT_CATEGORIES = 'struct<id:string,snippet:struct<title:string,assignable:boolean>,metadata:struct<region_code:string,retrieved_at:timestamp>>'
+ORC_BACKENDS = ('java', 'pyarrow')
+# Limits of the stage scheduler: stages that need cpu, network or memory only run together within them.
+CPU_WORKERS = os.cpu_count() or 1
+NETWORK_SLOTS = 4
+# Peak RSS of a conversion, JVM or pyarrow (see --compare-orc-backends).
+CONVERSION_MEMORY = 256 * 1024 * 1024
+# boto3's default transfers send up to 10 parts of 8Mb at once.
+UPLOAD_MEMORY = 80 * 1024 * 1024
 
-def convert_to_orc(file, struct, min_size = 0):
+
+def get_conversion_command(backend, file, struct, output):
     # Build the command as a list to avoid shell-quoting issues on any OS
-    cmd = [
-        "java", "-jar", "./orc-tools-uber.jar",
-        "convert", f"./{file}.json",
-        "-s", struct,
-        "-o", f"./{file}.orc",
-        "-t", "yyyy-MM-dd HH:mm:ss.nX",
-        "--overwrite"
-    ]
-
-    file_created = False
-    small_file = False
-    attempt = 0
-
-    while (not file_created or small_file) and attempt < 3:
-        # Stream stdout and stderr to the log file in real time
-        with open(f"./orc_{file}_output.log", "a", encoding="utf-8") as log:
-            log.write("Running command:\n" + " ".join(cmd) + "\n\n")
-            proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
-            return_code = proc.wait()
-            log.write(f"\nProcess exited with code {return_code}\n")
-
-        if return_code == 0:
-            file_created = True
-            file_size = os.path.getsize(f"./{file}.orc")
-            if file_size <= min_size:
-                small_file = True
-                attempt += 1
-            else:
-                small_file = False
-        else:
-            attempt += 1
-
-    return file_created, small_file
-
-
-def compress_bzip2(filename, min_size = 0):
-    compressed_filename = filename + '.bz2'
-    file_created = False
-    small_file = False
-    attempt = 0
-    while (not file_created or small_file) and attempt < 3:
-        with open(filename, 'rb') as source_file, bz2.BZ2File(compressed_filename, 'wb', compresslevel=9) as compressed_file:
-            shutil.copyfileobj(source_file, compressed_file)
-        file_created = True
-        file_size = os.path.getsize(compressed_filename)
-        if file_size <= min_size:
-            small_file = True
-            attempt += 1
+    if backend == 'java':
+        return [
+            "java", "-jar", "./orc-tools-uber.jar",
+            "convert", f"./{file}.json",
+            "-s", struct,
+            "-o", output,
+            "-t", "yyyy-MM-dd HH:mm:ss.nX",
+            "--overwrite"
+        ]
+    elif backend == 'pyarrow':
+        return [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "orc_writer.py"),
+                f"./{file}.json", struct, "-o", output]
+    else:
+        raise Exception(f"Unknown ORC backend: {backend}")
+
+
+def run_conversion(cmd, log):
+    # Returns the exit code, the elapsed time and the peak memory (in Kb) of the conversion process.
+    log.write("Running command:\n" + " ".join(cmd) + "\n\n")
+    log.flush()
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+    _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    return_code = os.waitstatus_to_exitcode(status)
+    log.write(f"\nProcess exited with code {return_code} after {elapsed:.1f}s, peak memory {usage.ru_maxrss} Kb\n")
+    return return_code, elapsed, usage.ru_maxrss
+
+
+def convert_in_process(file, struct, log, orc=True, parquet=False):
+    import orc_writer
+    log.write(f"Converting ./{file}.json with pyarrow\n")
+    start = time.perf_counter()
+    try:
+        rows = orc_writer.write_columnar(f"./{file}.json", struct, orc_file=f"./{file}.orc" if orc else None,
+                                         parquet_file=f"./{file}.parquet" if parquet else None)
+        return_code = 0
+        log.write(f"{rows} rows written.\n")
+    except Exception as e:
+        log.write(f"{e}\n")
+        return_code = 1
+    log.write(f"Finished with code {return_code} after {time.perf_counter() - start:.1f}s\n")
+    return return_code
+
+
+def convert_to_orc(file, struct, backend='java', parquet=False):
+    # A single attempt: converting the same input again gives the same output. check_orc says if it is right.
+    with open(f"./orc_{file}_output.log", "a", encoding="utf-8") as log:
+        if backend == 'pyarrow':
+            return_code = convert_in_process(file, struct, log, parquet=parquet)
         else:
-            small_file = False
-    return compressed_filename, small_file
+            cmd = get_conversion_command(backend, file, struct, f"./{file}.orc")
+            return_code, _, _ = run_conversion(cmd, log)
+            if return_code == 0 and parquet:
+                return_code = convert_in_process(file, struct, log, orc=False, parquet=True)
+    return return_code == 0
 
 
-def upload_most_popular(creation_date, period):
-    s3 = boto3.resource('s3')
+def compress_bzip2(filename, workers=None):
+    # Multi-stream bz2, compressed on every core by default.
+    return compress_file(filename, 'bz2', workers=workers)
+
+
+def get_memory_limit():
+    # Three quarters of the memory of the instance, the rest is for the system and the uploader itself.
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') * 3 // 4
+    except (ValueError, OSError, AttributeError):
+        return float('inf')
+
+
+def check_orc(file, manifest):
+    # The row count in the footer of the ORC file must be the number of records the collector wrote.
+    import pyarrow.orc
+    rows = pyarrow.orc.ORCFile(f"./{file}.orc").nrows
+    records = manifest['tables'][file]['records']
+    if rows != records:
+        print(f"{file}.orc has {rows} rows, the manifest says {records}.")
+    return {'rows': rows, 'bytes': os.path.getsize(f"./{file}.orc"), 'valid': rows == records}
+
+
+def check_backup(path, manifest, table='backup'):
+    # One streaming pass over the file as it was written, compressed or not.
+    entry = manifest['tables'][table]
+    crc32, size = get_file_crc32(path)
+    valid = os.path.basename(path) == entry['file'] and crc32 == entry['crc32'] and size == entry['bytes']
+    if not valid:
+        print(f"{path} ({size} bytes, crc32 {crc32}) does not match the manifest "
+              f"({entry['file']}, {entry['bytes']} bytes, crc32 {entry['crc32']}).")
+    return {'bytes': size, 'crc32': crc32, 'valid': valid}
+
+
+def upload_parquet(s3, file, creation_date, period):
+    print(f'Uploading {file}.parquet')
+    s3.Bucket('youtube-trends-uiuc-v2').upload_file(f"./{file}.parquet",
+                                                    f"{file}_parquet/creation_date={creation_date}/period={period}/{file}.parquet")
+
+
+def compare_orc_backends(file, struct):
+    # Runs every backend on the same input, each in its own process so their peak memory can be compared.
+    import pyarrow.orc
+    results = {}
+    with open(f"./orc_{file}_comparison.log", "a", encoding="utf-8") as log:
+        for backend in ORC_BACKENDS:
+            output = f"./{file}.{backend}.orc"
+            try:
+                return_code, elapsed, peak_memory = run_conversion(get_conversion_command(backend, file, struct, output), log)
+            except OSError as e:
+                print(f"{file} {backend}: could not run ({e})")
+                continue
+            if return_code == 0:
+                table = pyarrow.orc.ORCFile(output).read()
+                results[backend] = table
+                print(f"{file} {backend}: {elapsed:.1f}s, peak memory {peak_memory / 1024:.0f} Mb, "
+                      f"{os.path.getsize(output) / 1024 / 1024:.1f} Mb, {table.num_rows} rows")
+            else:
+                print(f"{file} {backend}: failed with code {return_code}, see ./orc_{file}_comparison.log")
+    if len(results) == len(ORC_BACKENDS):
+        same_rows = results['java'].to_pylist() == results['pyarrow'].to_pylist()
+        print(f"{file}: outputs are {'identical' if same_rows else 'different'}")
+
+
+def find_compressed_backup(filename):
+    # The collector compresses backup.json while writing it, unless it was run with --backup-compression none.
+    for compression in COMPRESSIONS:
+        if compression != 'none' and os.path.exists(get_sink_path(filename, compression)):
+            return get_sink_path(filename, compression)
+    return None
+
+
+def convert_and_check(file, struct, manifest, checks, orc_backend='java', parquet=False):
+    print(f'Converting {file}.json')
+    with metrics.stage(f'convert_{file}') as stage:
+        created = convert_to_orc(file, struct, backend=orc_backend, parquet=parquet)
+        stage['bytes'] = os.path.getsize(f"./{file}.json")
+    if not created:
+        return False
+    checks[file] = check_orc(file, manifest)
+    return checks[file]['valid']
+
+
+def upload_table(s3, file, creation_date, period, parquet=False):
+    print(f'Uploading {file}.orc')
+    with metrics.stage(f'upload_{file}') as stage:
+        s3.Bucket('youtube-trends-uiuc-v2').upload_file(f"./{file}.orc",
+                                                        f"{file}/creation_date={creation_date}/period={period}/{file}.orc")
+        stage['bytes'] = os.path.getsize(f"./{file}.orc")
+    if parquet:
+        upload_parquet(s3, file, creation_date, period)
+    return True
+
+
+def verify_backup(path, manifest, checks, table='backup'):
+    checks[table] = check_backup(path, manifest, table=table)
+    return checks[table]['valid']
+
+
+def compress_backup(workers, manifest):
     print('Compressing backup.json.')
-    compressed_backup, small_backup = compress_bzip2('./backup.json', min_size=30 * 1024 * 1024)
+    with metrics.stage('compress_backup') as stage:
+        compressed_backup, size, crc32 = compress_bzip2('./backup.json', workers=workers)
+        stage['bytes'] = os.path.getsize('./backup.json')
+    # The file that is uploaded is the compressed one: it is checked against what the compression wrote, as
+    # the collector's own compressed backup is against what the collector wrote.
+    manifest['tables']['compressed_backup'] = dict(manifest['tables']['backup'], bytes=size, crc32=crc32,
+                                                   file=os.path.basename(compressed_backup))
+    return True
+
+
+def upload_backup(s3, compressed_backup, creation_date, period):
     print('Uploading backup.json')
-    s3.Bucket('youtube-trends-uiuc-backup-v2').upload_file(compressed_backup,
-                                                           f"creation_date={creation_date}/period={period}/backup.json.bz2")
-    print('Converting regions.json')
-    regions_created, small_regions = convert_to_orc('regions', STRUCT_REGION)
-    if regions_created:
-        print('Uploading regions.orc')
-        s3.Bucket('youtube-trends-uiuc-v2').upload_file("./regions.orc",
-                                                        f"regions/creation_date={creation_date}/period={period}/regions.orc")
-    print('Converting categories.json')
-    categories_created, small_categories = convert_to_orc('categories', STRUCT_CATEGORIES)
-    if categories_created:
-        print('Uploading categories.orc')
-        s3.Bucket('youtube-trends-uiuc-v2').upload_file("./categories.orc",
-                                                        f"categories/creation_date={creation_date}/period={period}/categories.orc")
-    print('Converting most_popular.json')
-    most_popular_created, small_most_popular = convert_to_orc('most_popular',
-                                                              STRUCT_MOST_POPULAR,
-                                                              min_size=30 * 1024 * 1024) # 30 Mb... the normal size is ~60 Mb.
-    if most_popular_created:
-        print('Uploading most_popular.orc')
-        s3.Bucket('youtube-trends-uiuc-v2').upload_file("./most_popular.orc",
-                                                        f"most_popular/creation_date={creation_date}/period={period}/most_popular.orc")
-
-    if not most_popular_created or small_most_popular:
+    with metrics.stage('upload_backup') as stage:
+        s3.Bucket('youtube-trends-uiuc-backup-v2').upload_file(compressed_backup,
+                                                               f"creation_date={creation_date}/period={period}/{os.path.basename(compressed_backup)}")
+        stage['bytes'] = os.path.getsize(compressed_backup)
+    return True
+
+
+def upload_snippet_index():
+    # Incremental output: videos/ now holds the snippets the updated index points at.
+    print('Uploading the snippet index')
+    upload_index()
+    return True
+
+
+def add_table_stages(scheduler, s3, file, struct, creation_date, period, manifest, checks, orc_backend='java',
+                     parquet=False):
+    scheduler.add(f'convert_{file}', functools.partial(convert_and_check, file, struct, manifest, checks,
+                                                       orc_backend=orc_backend, parquet=parquet),
+                  cpu=1, memory=CONVERSION_MEMORY)
+    return scheduler.add(f'upload_{file}', functools.partial(upload_table, s3, file, creation_date, period,
+                                                             parquet=parquet),
+                         requires=[f'convert_{file}'], network=1, memory=UPLOAD_MEMORY)
+
+
+def report_timings(scheduler):
+    print(f"{'stage':<24} {'state':<8} {'started':>8} {'waited':>8} {'seconds':>8}")
+    for timing in scheduler.timings():
+        if 'seconds' not in timing:
+            print(f"{timing['stage']:<24} {timing['state']:<8}")
+            continue
+        # The time a stage was ready but waited for resources, e.g. for a conversion to give back a core.
+        metrics.increment('stage_wait_seconds_total', timing['waited'], stage=timing['stage'])
+        print(f"{timing['stage']:<24} {timing['state']:<8} {timing['started']:>8.1f} {timing['waited']:>8.1f} "
+              f"{timing['seconds']:>8.1f}")
+
+
+def upload_most_popular(creation_date, period, orc_backend='java', parquet=False, cpu_workers=CPU_WORKERS,
+                        network_slots=NETWORK_SLOTS, memory_limit=None):
+    # Compressions, conversions and uploads are independent stages, run as soon as what they need is done
+    # and their cpu, network and memory fit (see stage_scheduler.py). They are added in the order they used to
+    # run one after the other, which is the order their errors are raised in.
+    s3 = boto3.resource('s3')
+    if not os.path.exists(MANIFEST_FILE):
+        raise Exception(f"{MANIFEST_FILE} not found: the outputs cannot be checked.")
+    manifest = load_manifest()
+    checks = {}
+    scheduler = StageScheduler(cpu=cpu_workers, network=network_slots,
+                               memory=memory_limit if memory_limit is not None else get_memory_limit())
+    compressed_backup = find_compressed_backup('./backup.json')
+    if compressed_backup is None:
+        scheduler.add('check_backup', functools.partial(verify_backup, './backup.json', manifest, checks), cpu=1)
+        # Every block being compressed, or waiting to be written, is held in memory (see CompressedSink).
+        scheduler.add('compress_backup', functools.partial(compress_backup, cpu_workers, manifest),
+                      requires=['check_backup'], cpu=cpu_workers, memory=(2 * cpu_workers + 2) * BLOCK_SIZE)
+        compressed_backup = get_sink_path('./backup.json', 'bz2')
+        backup_stage = scheduler.add('check_compressed_backup',
+                                     functools.partial(verify_backup, compressed_backup, manifest, checks,
+                                                       table='compressed_backup'),
+                                     requires=['compress_backup'], cpu=1)
+    else:
+        print(f'{compressed_backup} was already compressed by the collector.')
+        backup_stage = scheduler.add('check_backup', functools.partial(verify_backup, compressed_backup, manifest,
+                                                                       checks), cpu=1)
+    scheduler.add('upload_backup', functools.partial(upload_backup, s3, compressed_backup, creation_date, period),
+                  requires=[backup_stage], network=1, memory=UPLOAD_MEMORY)
+    add_table_stages(scheduler, s3, 'regions', STRUCT_REGION, creation_date, period, manifest, checks,
+                     orc_backend=orc_backend, parquet=parquet)
+    add_table_stages(scheduler, s3, 'categories', STRUCT_CATEGORIES, creation_date, period, manifest, checks,
+                     orc_backend=orc_backend, parquet=parquet)
+    normalized = os.path.exists('./videos.json')
+    if normalized:
+        # Normalized output (collect_most_popular.py --normalized): one snippet per video plus slim rankings.
+        add_table_stages(scheduler, s3, 'videos', STRUCT_VIDEOS, creation_date, period, manifest, checks,
+                         orc_backend=orc_backend, parquet=parquet)
+        add_table_stages(scheduler, s3, 'rankings', STRUCT_RANKINGS, creation_date, period, manifest, checks,
+                         orc_backend=orc_backend, parquet=parquet)
+        if os.path.exists(INDEX_FILE):
+            scheduler.add('upload_snippet_index', upload_snippet_index, requires=['upload_videos', 'upload_rankings'],
+                          network=1)
+    else:
+        add_table_stages(scheduler, s3, 'most_popular', STRUCT_MOST_POPULAR, creation_date, period, manifest,
+                         checks, orc_backend=orc_backend, parquet=parquet)
+    try:
+        with metrics.stage('upload_stages'):
+            scheduler.run()
+    finally:
+        report_timings(scheduler)
+        try:
+            # Counts and checksums of the partition, with what the upload found, for audits.
+            upload_manifest(dict(manifest, checks=checks), creation_date, period, s3=s3)
+        except Exception as e:
+            print(f"Could not upload the manifest: {e}")
+
+    # A stage that raised would have stopped the upload when the stages ran one after the other.
+    scheduler.check()
+    if normalized:
+        if not scheduler.succeeded('upload_videos'):
+            raise Exception("Error generating videos.orc.")
+        elif not scheduler.succeeded('upload_rankings'):
+            raise Exception("Error generating rankings.orc.")
+    most_popular_uploaded = normalized or scheduler.succeeded('upload_most_popular')
+
+    if not most_popular_uploaded:
         raise Exception("Error generating most_popular.orc.")
-    elif not categories_created or small_categories:
+    elif not scheduler.succeeded('upload_categories'):
         raise Exception("Error generating categories.orc.")
-    elif not regions_created or small_regions:
+    elif not scheduler.succeeded('upload_regions'):
         raise Exception("Error generating regions.orc.")
-    elif small_backup:
+    elif not scheduler.succeeded('upload_backup'):
         raise Exception("Backup file is too small.")
 
 
@@ -120,12 +325,33 @@ def main():
         parser = argparse.ArgumentParser(description="Upload most popular items.")
         parser.add_argument("creation_date", nargs="?", help="YYYY-MM-DD")
         parser.add_argument("period", nargs="?", help="00, 06, 12, 18")
+        parser.add_argument("--orc-backend", choices=ORC_BACKENDS, default='java',
+                            help="java runs orc-tools-uber.jar, pyarrow writes the ORC files in-process")
+        parser.add_argument("--parquet", action="store_true", help="Also write and upload Parquet files")
+        parser.add_argument("--compare-orc-backends", action="store_true",
+                            help="Convert the local JSON files with every backend, print a comparison and exit")
+        parser.add_argument("--cpu-workers", type=int, default=CPU_WORKERS,
+                            help="Cores used by the compressions and conversions running at the same time")
+        parser.add_argument("--network-slots", type=int, default=NETWORK_SLOTS, help="Uploads running at the same time")
+        parser.add_argument("--memory-mb", type=int,
+                            help="Memory of the stages running at the same time (default: 3/4 of the instance)")
         args = parser.parse_args()
 
+        if args.compare_orc_backends:
+            for file, struct in (('regions', STRUCT_REGION), ('categories', STRUCT_CATEGORIES),
+                                 ('most_popular', STRUCT_MOST_POPULAR)):
+                compare_orc_backends(file, struct)
+            return
+
         creation_date = args.creation_date or datetime.datetime.now(datetime.UTC).strftime("%Y-%m-%d")
         period = args.period or get_period()
 
-        upload_most_popular(creation_date, period)
+        try:
+            upload_most_popular(creation_date, period, orc_backend=args.orc_backend, parquet=args.parquet,
+                                cpu_workers=args.cpu_workers, network_slots=args.network_slots,
+                                memory_limit=args.memory_mb * 1024 * 1024 if args.memory_mb else None)
+        finally:
+            metrics.try_publish('upload_most_popular', creation_date, period)
     except Exception as e:
         send_gmail('Error! Please check AWS', f'Hi, my friend!\n\nThe script upload_most_popular.py has just failed with this error:\n\n{str(e)}\n\nYou need to visit AWS EC2 to see what happened.\n\nAll the best,\nAdmin.')
         raise e
@@ -0,0 +1,223 @@
+# Where the shards of a sharded run (see collect_shards.py) are crawled.
+#
+# A queue runs a list of tasks (JSON-serializable dicts with a 'shard' number) with a worker function, and
+# returns the result of every task: a dict with the local 'directory' that holds the output 'files' of the
+# task. LocalWorkQueue runs every task in a process of this machine, for tests and for machines with cores
+# and bandwidth to spare. Ec2WorkQueue writes every task to S3 and starts an instance per task through
+# the create_ec2_instance Lambda. The instance runs `collect_shards.py worker <task url>`, which keeps its
+# state under the prefix of the task (the worker gets it as 'location'), uploads the outputs and then a
+# result.json next to the task. The queue polls for result.json and downloads the outputs, and the
+# 'segments' the worker uploaded while it ran.
+# A task that fails is run again, up to max_attempts times, with what its earlier attempts left: the worker
+# resumes from it. What is left from an earlier run of the period is cleared before the first attempt.
+# An instance can also be lost without writing result.json (out of memory, terminated): its worker puts a
+# heartbeat.json every HEARTBEAT_INTERVAL, and a task whose heartbeat did not change for HEARTBEAT_TIMEOUT
+# (which covers the boot of the instance) fails as if it had raised. Instances are only started while
+# fewer than max_instances are running, since failed instances are kept to be looked at.
+
+import os
+import json
+import time
+import shutil
+import logging
+import datetime
+import threading
+import concurrent.futures
+import boto3
+from segment_uploader import TRANSFER_CONFIG
+
+SHARDS_BUCKET = 'youtube-trends-uiuc-admin'
+SHARDS_PREFIX = 'shards'
+SHARDS_DIRECTORY = './shards'
+POLL_INTERVAL = 60
+# A shard without a result by then is considered lost, and the run fails.
+TASK_TIMEOUT = 5 * 60 * 60
+MAX_ATTEMPTS = 3
+HEARTBEAT_INTERVAL = 60
+# From the launch for the first heartbeat: the instance installs its packages before the worker starts.
+HEARTBEAT_TIMEOUT = 30 * 60
+
+
+def get_shard_directory(directory, shard):
+    return os.path.join(directory, f"shard={shard:03d}")
+
+
+class LocalWorkQueue:
+    def __init__(self, worker, max_workers=None, directory=SHARDS_DIRECTORY, max_attempts=MAX_ATTEMPTS):
+        # worker must be a module-level function, so it can be sent to the worker processes.
+        self.worker = worker
+        self.max_workers = max_workers
+        self.directory = directory
+        self.max_attempts = max_attempts
+
+    def run(self, tasks):
+        for task in tasks:
+            shutil.rmtree(get_shard_directory(self.directory, task['shard']), ignore_errors=True)
+        # One fresh process per task, since a crawl keeps per-process state (clients, metrics).
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers or len(tasks),
+                                                    max_tasks_per_child=1) as executor:
+            def submit(task):
+                return executor.submit(self.worker, dict(task, directory=get_shard_directory(self.directory,
+                                                                                             task['shard'])))
+
+            futures = {submit(task): task for task in tasks}
+            attempts = {task['shard']: 1 for task in tasks}
+            results = {}
+            while futures:
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    task = futures.pop(future)
+                    try:
+                        results[task['shard']] = future.result()
+                    except Exception as e:
+                        if attempts[task['shard']] >= self.max_attempts:
+                            raise
+                        attempts[task['shard']] += 1
+                        logging.info(f"Shard {task['shard']} failed ({e}), attempt {attempts[task['shard']]} of "
+                                     f"{self.max_attempts}.")
+                        futures[submit(task)] = task
+            return [results[task['shard']] for task in tasks]
+
+
+class Ec2WorkQueue:
+    def __init__(self, creation_date, period, directory=SHARDS_DIRECTORY, poll_interval=POLL_INTERVAL,
+                 timeout=TASK_TIMEOUT, max_attempts=MAX_ATTEMPTS, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+                 count_instances=None, max_instances=None, s3=None, lambda_client=None, clock=time.monotonic,
+                 sleep=time.sleep):
+        # count_instances() returns the number of running instances, which must stay under max_instances.
+        self.prefix = f"{SHARDS_PREFIX}/creation_date={creation_date}/period={period}"
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.heartbeat_timeout = heartbeat_timeout
+        self.count_instances = count_instances
+        self.max_instances = max_instances
+        self.s3 = s3 or boto3.resource('s3')
+        self.lambda_client = lambda_client or boto3.client('lambda')
+        self.clock = clock
+        self.sleep = sleep
+
+    def get_task_prefix(self, shard):
+        return f"{self.prefix}/shard={shard:03d}"
+
+    def launch(self, task):
+        # False when there is no room for one more instance yet.
+        if self.count_instances is not None and self.count_instances() >= self.max_instances:
+            return False
+        key = f"{self.get_task_prefix(task['shard'])}/task.json"
+        self.s3.Object(SHARDS_BUCKET, key).put(Body=json.dumps(task).encode('utf-8'))
+        self.lambda_client.invoke(FunctionName='create_ec2_instance', InvocationType='Event',
+                                  Payload=json.dumps({'shard_task': f"s3://{SHARDS_BUCKET}/{key}"}).encode('utf-8'))
+        logging.info(f"Shard {task['shard']} sent to a new instance.")
+        return True
+
+    def run(self, tasks):
+        for task in tasks:
+            # The result, journal and outputs of an earlier run of this period must not be taken for the new one.
+            prefix = f"{self.get_task_prefix(task['shard'])}/"
+            for summary in self.s3.Bucket(SHARDS_BUCKET).objects.filter(Prefix=prefix):
+                summary.delete()
+        waiting = list(tasks)
+        # The last heartbeat seen of every launched task, and when it was first seen (or the task launched).
+        heartbeats = {}
+        attempts = {task['shard']: 1 for task in tasks}
+        results = {}
+        deadline = self.clock() + self.timeout
+        while True:
+            for task in list(waiting):
+                if not self.launch(task):
+                    logging.info(f"Shard {task['shard']} waits for fewer than {self.max_instances} instances running.")
+                    break
+                waiting.remove(task)
+                heartbeats[task['shard']] = (self.get_heartbeat(task['shard']), self.clock())
+            for task in tasks:
+                if task['shard'] not in results and task['shard'] in heartbeats:
+                    result = self.get_result(task['shard'])
+                    if result is None:
+                        heartbeat = self.get_heartbeat(task['shard'])
+                        if heartbeat != heartbeats[task['shard']][0]:
+                            heartbeats[task['shard']] = (heartbeat, self.clock())
+                            continue
+                        if self.clock() - heartbeats[task['shard']][1] <= self.heartbeat_timeout:
+                            continue
+                        result = {'shard': task['shard'],
+                                  'error': f"no heartbeat for {self.heartbeat_timeout:.0f} seconds"}
+                    if 'error' not in result:
+                        results[task['shard']] = self.download(result)
+                    elif attempts[task['shard']] < self.max_attempts:
+                        # The new instance resumes from the journal and the segments the failed one left.
+                        attempts[task['shard']] += 1
+                        logging.info(f"Shard {task['shard']} failed ({result['error']}), attempt "
+                                     f"{attempts[task['shard']]} of {self.max_attempts}.")
+                        self.s3.Object(SHARDS_BUCKET, f"{self.get_task_prefix(task['shard'])}/result.json").delete()
+                        del heartbeats[task['shard']]
+                        waiting.append(task)
+                    else:
+                        raise Exception(f"Shard {task['shard']} failed: {result['error']}")
+            if len(results) == len(tasks):
+                return [results[task['shard']] for task in tasks]
+            if self.clock() > deadline:
+                missing = sorted(task['shard'] for task in tasks if task['shard'] not in results)
+                raise Exception(f"Shards {missing} did not finish in {self.timeout / 3600:.1f} hours.")
+            self.sleep(self.poll_interval)
+
+    def get_result(self, shard):
+        try:
+            content = self.s3.Object(SHARDS_BUCKET, f"{self.get_task_prefix(shard)}/result.json").get()['Body'].read()
+        except self.s3.meta.client.exceptions.NoSuchKey:
+            return None
+        return json.loads(content.decode('utf-8'))
+
+    def get_heartbeat(self, shard):
+        # The time of the last beat of the task, as the instance saw it. None before the first one.
+        try:
+            heartbeat = self.s3.Object(SHARDS_BUCKET, f"{self.get_task_prefix(shard)}/heartbeat.json")
+            content = heartbeat.get()['Body'].read()
+        except self.s3.meta.client.exceptions.NoSuchKey:
+            return None
+        return json.loads(content.decode('utf-8'))['at']
+
+    def download(self, result):
+        directory = get_shard_directory(self.directory, result['shard'])
+        os.makedirs(directory, exist_ok=True)
+        for name in list(result['files']) + result.get('segments', []):
+            self.s3.Bucket(SHARDS_BUCKET).download_file(f"{self.get_task_prefix(result['shard'])}/{name}",
+                                                        os.path.join(directory, name), Config=TRANSFER_CONFIG)
+        return dict(result, directory=directory)
+
+
+def beat(s3, bucket, key, stopped, interval=HEARTBEAT_INTERVAL):
+    while True:
+        try:
+            at = datetime.datetime.now(datetime.UTC).isoformat()
+            s3.Object(bucket, key).put(Body=json.dumps({'at': at}).encode('utf-8'))
+        except Exception as e:
+            logging.info(f"Could not put the heartbeat: {e}")
+        if stopped.wait(interval):
+            return
+
+
+def run_ec2_task(task_url, worker, s3=None, heartbeat_interval=HEARTBEAT_INTERVAL):
+    # Runs on the instance of a shard: the counterpart of Ec2WorkQueue.run.
+    s3 = s3 or boto3.resource('s3')
+    bucket, _, key = task_url.replace('s3://', '', 1).partition('/')
+    prefix = os.path.dirname(key)
+    task = json.loads(s3.Object(bucket, key).get()['Body'].read().decode('utf-8'))
+    stopped = threading.Event()
+    threading.Thread(target=beat, args=(s3, bucket, f"{prefix}/heartbeat.json", stopped, heartbeat_interval),
+                     daemon=True).start()
+    try:
+        result = worker(dict(task, directory='.', location=[bucket, prefix]))
+    except Exception as e:
+        s3.Object(bucket, f"{prefix}/result.json").put(Body=json.dumps({'shard': task['shard'],
+                                                                         'error': str(e)}).encode('utf-8'))
+        raise
+    finally:
+        stopped.set()
+    for name in result['files']:
+        s3.Bucket(bucket).upload_file(os.path.join(result['directory'], name), f"{prefix}/{name}",
+                                      Config=TRANSFER_CONFIG)
+    # Written last: the coordinator takes it as the sign that the outputs are all there.
+    s3.Object(bucket, f"{prefix}/result.json").put(Body=json.dumps(result).encode('utf-8'))
+    return result